@@ -9,6 +9,8 @@ import preppipe.pipeline
 def main():
   parser = argparse.ArgumentParser(description="Asset Building helper")
   parser.add_argument("--export-built-embedded", metavar="<dir>", default=None, help="Copy the embedded assets to the specified directory")
+  parser.add_argument("-j", "--jobs", metavar="N", type=int, default=1, help="Number of asset packs to build in parallel (default: 1)")
+  parser.add_argument("--force", action="store_true", help="Rebuild all assets even if their inputs are unchanged")
   args = parser.parse_args()
 
   srcpath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets")
@@ -17,6 +19,10 @@ def main():
     "--build-embedded", srcpath,
     "--dump-json"
   ]
+  if args.jobs > 1:
+    assetmanager_args += ["--jobs", str(args.jobs)]
+  if args.force:
+    assetmanager_args.append("--force")
   if args.export_built_embedded:
     assetmanager_args += ["--export-built-embedded", args.export_built_embedded]
   preppipe.pipeline.pipeline_main(assetmanager_args)
@@ -3,6 +3,7 @@
 
 import dataclasses
 import shutil
+import threading
 import typing
 from ..language import *
 from ..exceptions import *
@@ -24,6 +25,14 @@ from ..exceptions import *
 # 4.  (可选) 一个静态方法 load_descriptors(descriptors : list[typing.Any]) -> None
 #     该方法用于从 AssetManager 的 Manifest 中加载素材的信息，列表中的对象均为 build_asset_archive 的返回值
 #     如果 build_asset_archive 只返回 None，则不需要提供该方法
+# 5.  (可选) 一个静态方法 get_asset_build_inputs(**kwargs) -> tuple[typing.Any, list[str]]
+#     kwargs 与 build_asset_archive 的构建参数相同（不含 name 和 destpath），返回 (构建配置, 构建时会读取的文件列表)
+#     文件列表中可以有目录（目录下所有文件都是输入）以及不存在的文件（之后出现的话也会重新构建）
+#     AssetManager 用它计算素材的输入指纹，指纹不变的素材在重新构建时会被跳过；构建配置应该是可以转为 JSON 的对象
+#     如果不提供该方法，则把构建参数中所有指向已存在的文件或目录的字符串视作输入
+# 6.  (可选) 成员函数 get_asset_data_size(self) -> int 和 prefetch_asset_data(self) -> None
+#     如果素材处理类的实例在创建后还会按需读取数据（比如图片包的图层），AssetManager.prefetch() 可以在后台预先读取这些数据
+#     前者返回读取后预计占用的内存字节数，用于控制预读的总量；后者执行读取，可能在任意线程中被调用
 
 _registered_asset_classes : dict[str, type] = {}
 
@@ -44,12 +53,22 @@ def AssetClassDecl(name : str): # pylint: disable=invalid-name
 # 1. 每个素材有一个可以引用的、可翻译（有 Translatable）的名称
 # 2. 每个素材的使用方式（包括名称）都可由一个对象记录（姑且称之为描述对象），且这类对象足够小、可以始终和程序一起分发
 # 3. 注册类的 build_asset_archive 方法返回的对象可以被用于创建描述对象
+# 描述对象可以延迟读取：AssetManager 从索引格式的清单中读取时只登记 ID 和可用于查找的名称（add_pending_descriptor()），
+# 描述对象在第一次被查询时才反序列化（同时注册其中的翻译）；直接访问 MANIFEST 等字典前需要先调用 load_pending_descriptors()
 class NamedAssetClassBase:
   # 继承的类需要定义以下成员：
   DESCRIPTOR_TYPE : typing.ClassVar[type] # 描述对象(记录素材使用方式和名称等信息的对象)的实际类型
   MANIFEST : typing.ClassVar[dict[str, typing.Any]] # 用于保存描述对象 (ID -> 描述对象)
   DESCRIPTOR_DICT : typing.ClassVar[TranslatableDict[list[typing.Any]]] # 用于保存描述对象的字典，键为描述对象的名称
   DESCRIPTOR_DICT_STRONLY : typing.ClassVar[dict[str, list[typing.Any]]] # 如果一些资源只使用固定名称、没有 Translatable 作为名称，则使用这个字典
+  # 以下由 _descriptor() 创建，用于延迟读取：
+  PENDING_DESCRIPTORS : typing.ClassVar[dict[str, tuple[tuple[str, ...], int, typing.Callable[[], typing.Any]]]] # ID -> (名称, 登记顺序, 读取描述对象的函数)
+  PENDING_NAME_INDEX : typing.ClassVar[dict[str, list[str]]] # 名称 -> 还没读取的描述对象的 ID （按登记顺序）
+  DESCRIPTOR_ORDER : typing.ClassVar[dict[str, int]] # ID -> 登记顺序，load_pending_descriptors() 用它把 MANIFEST 恢复成登记时的顺序
+
+  # 延迟读取可能在任意线程中发生，所有类共用一个锁
+  _pending_lock : typing.ClassVar[threading.RLock] = threading.RLock()
+  _pending_counter : typing.ClassVar[int] = 0
 
   @classmethod
   def get_candidate_name(cls, descriptor : typing.Any) -> Translatable | str:
@@ -61,10 +80,31 @@ class NamedAssetClassBase:
     # 从描述对象中获取素材的 ID, 此项不允许有重名
     raise PPNotImplementedError()
 
+  @staticmethod
+  def get_lookup_names(name : Translatable | str) -> tuple[str, ...]:
+    # get_descriptor_candidates() 可以用哪些字符串找到这个名称
+    if isinstance(name, Translatable):
+      return name.get_all_candidates()
+    return (name,)
+
   @classmethod
   def add_descriptor(cls, descriptor : typing.Any) -> None:
     name = cls.get_candidate_name(descriptor)
     identifier = cls.get_candidate_id(descriptor)
+    with NamedAssetClassBase._pending_lock:
+      if identifier in cls.PENDING_DESCRIPTORS:
+        raise PPInternalError(f"Duplicate descriptor ID {identifier}")
+      # 同名的描述对象的顺序会影响按名称查找的结果，所以先把之前登记的同名描述对象读进来
+      if len(cls.PENDING_NAME_INDEX) > 0:
+        for lookup_name in cls.get_lookup_names(name):
+          for pending_id in list(cls.PENDING_NAME_INDEX.get(lookup_name, ())):
+            cls._load_pending_descriptor(pending_id)
+      cls._add_descriptor_impl(descriptor, name, identifier)
+      cls.DESCRIPTOR_ORDER[identifier] = NamedAssetClassBase._pending_counter
+      NamedAssetClassBase._pending_counter += 1
+
+  @classmethod
+  def _add_descriptor_impl(cls, descriptor : typing.Any, name : Translatable | str, identifier : str) -> None:
     if identifier in cls.MANIFEST:
       raise PPInternalError(f"Duplicate descriptor ID {identifier}")
     cls.MANIFEST[identifier] = descriptor
@@ -78,8 +118,71 @@ class NamedAssetClassBase:
     else:
       raise PPInternalError(f"Invalid name type {type(name)}")
 
+  @classmethod
+  def add_pending_descriptor(cls, identifier : str, names : typing.Iterable[str], loader : typing.Callable[[], typing.Any]) -> None:
+    # 登记一个还没读取的描述对象，names 为 get_lookup_names() 的结果，loader 返回描述对象
+    with NamedAssetClassBase._pending_lock:
+      if identifier in cls.MANIFEST or identifier in cls.PENDING_DESCRIPTORS:
+        raise PPInternalError(f"Duplicate descriptor ID {identifier}")
+      names = tuple(names)
+      cls.PENDING_DESCRIPTORS[identifier] = (names, NamedAssetClassBase._pending_counter, loader)
+      cls.DESCRIPTOR_ORDER[identifier] = NamedAssetClassBase._pending_counter
+      NamedAssetClassBase._pending_counter += 1
+      for lookup_name in names:
+        cls.PENDING_NAME_INDEX.setdefault(lookup_name, []).append(identifier)
+
+  @classmethod
+  def _load_pending_descriptor(cls, identifier : str) -> None:
+    with NamedAssetClassBase._pending_lock:
+      if (entry := cls.PENDING_DESCRIPTORS.get(identifier, None)) is None:
+        return
+      names, order, loader = entry
+      # 按登记顺序读取同名的描述对象，这样按名称查找的结果与一开始就全部读取时相同
+      for lookup_name in names:
+        for pending_id in list(cls.PENDING_NAME_INDEX.get(lookup_name, ())):
+          if (pending_entry := cls.PENDING_DESCRIPTORS.get(pending_id, None)) is None:
+            continue
+          if pending_entry[1] >= order:
+            break
+          cls._load_pending_descriptor(pending_id)
+      cls._remove_pending_descriptor(identifier)
+      descriptor = loader()
+      if not isinstance(descriptor, cls.DESCRIPTOR_TYPE):
+        raise ValueError(f"Invalid descriptor type {type(descriptor)}")
+      if cls.get_candidate_id(descriptor) != identifier:
+        raise PPInternalError(f"Descriptor ID mismatch: expected {identifier}, got {cls.get_candidate_id(descriptor)}")
+      cls._add_descriptor_impl(descriptor, cls.get_candidate_name(descriptor), identifier)
+
+  @classmethod
+  def _remove_pending_descriptor(cls, identifier : str) -> bool:
+    if (entry := cls.PENDING_DESCRIPTORS.pop(identifier, None)) is None:
+      return False
+    for lookup_name in entry[0]:
+      idlist = cls.PENDING_NAME_INDEX[lookup_name]
+      idlist.remove(identifier)
+      if len(idlist) == 0:
+        del cls.PENDING_NAME_INDEX[lookup_name]
+    return True
+
+  @classmethod
+  def load_pending_descriptors(cls) -> None:
+    # 读取所有还没读取的描述对象
+    with NamedAssetClassBase._pending_lock:
+      if len(cls.PENDING_DESCRIPTORS) == 0:
+        return
+      while len(cls.PENDING_DESCRIPTORS) > 0:
+        cls._load_pending_descriptor(next(iter(cls.PENDING_DESCRIPTORS)))
+      # 之前按需读取的描述对象在 MANIFEST 中的顺序与登记顺序不同，这里恢复过来
+      ordered = sorted(cls.MANIFEST.items(), key=lambda item : cls.DESCRIPTOR_ORDER.get(item[0], 0))
+      cls.MANIFEST.clear()
+      cls.MANIFEST.update(ordered)
+
   @classmethod
   def get_descriptor_candidates(cls, name : str) -> list[typing.Any]:
+    if name in cls.PENDING_NAME_INDEX:
+      with NamedAssetClassBase._pending_lock:
+        for pending_id in list(cls.PENDING_NAME_INDEX.get(name, ())):
+          cls._load_pending_descriptor(pending_id)
     candidates = []
     if name in cls.DESCRIPTOR_DICT:
       candidates.extend(cls.DESCRIPTOR_DICT[name])
@@ -97,10 +200,13 @@ class NamedAssetClassBase:
 
   @classmethod
   def get_descriptor_by_id(cls, identifier : str) -> typing.Any | None:
+    if identifier in cls.PENDING_DESCRIPTORS:
+      cls._load_pending_descriptor(identifier)
     return cls.MANIFEST.get(identifier, None)
 
   @classmethod
   def get_candidate_names(cls) -> list[str]:
+    cls.load_pending_descriptors()
     f = lambda x : x.get() if isinstance(x, Translatable) else x
     return [f(cls.get_candidate_name(d)) for d in cls.MANIFEST.values()]
 
@@ -116,6 +222,11 @@ class NamedAssetClassBase:
   def remove_descriptors_by_identifiers(cls, identifiers: typing.Collection[str]) -> None:
     """Remove descriptors whose get_candidate_id is in identifiers (e.g. when unloading extra assets from a path)."""
     for identifier in identifiers:
+      # 还没读取的描述对象也没有注册翻译，直接去掉即可
+      with NamedAssetClassBase._pending_lock:
+        cls.DESCRIPTOR_ORDER.pop(identifier, None)
+        if cls._remove_pending_descriptor(identifier):
+          continue
       if identifier not in cls.MANIFEST:
         continue
       descriptor = cls.MANIFEST.pop(identifier)
@@ -142,6 +253,11 @@ class NamedAssetClassBase:
     cls.MANIFEST = {}
     cls.DESCRIPTOR_DICT = TranslatableDict()
     cls.DESCRIPTOR_DICT_STRONLY = {}
+    cls.PENDING_DESCRIPTORS = {}
+    cls.PENDING_NAME_INDEX = {}
+    cls.DESCRIPTOR_ORDER = {}
+    # 导出、导入翻译时需要所有描述对象中的翻译
+    TranslationDomain.add_pending_loader(cls.load_pending_descriptors)
     return descriptor_type
 
   @staticmethod
@@ -24,9 +24,14 @@ import typing
 import json
 import dataclasses
 import pickle
+import hashlib
 import collections
 import yaml
 import shutil
+import importlib
+import functools
+import threading
+import concurrent.futures
 import PIL.Image
 import PIL.ImageFont
 from ..language import *
@@ -34,6 +39,7 @@ from ..exceptions import *
 from ..tooldecl import ToolClassDecl
 from .assetclassdecl import _registered_asset_classes
 from .assetclassdecl import *
+from .manifestindex import ManifestIndex, ManifestIndexEntry
 from ..util.message import MessageHandler
 from ..util.nameconvert import *
 from .. import __version__
@@ -45,6 +51,9 @@ class AssetManifestObject:
   program_version : str
   descriptors : dict[str, list[typing.Any]]
   items_by_class : dict[str, list[str]]
+  # 素材相对路径 -> 构建时的输入指纹，用于在重新构建时跳过没有变化的素材
+  # 旧版本生成的 manifest 中没有这一项，读取时应使用 getattr(manifest, "fingerprints", {})
+  fingerprints : dict[str, str] = dataclasses.field(default_factory=dict)
 
 @ToolClassDecl("assetmanager")
 class AssetManager:
@@ -64,6 +73,9 @@ class AssetManager:
 
   # 素材包的清单文件名，如果有什么信息需要在没有素材时也能获取（比如程序的另一个部分如何引用这些素材），则在这个文件中保存
   MANIFEST_NAME : typing.ClassVar[str] = "manifest.pickle"
+  # 同样内容的索引格式（见 manifestindex.py），构建时与 MANIFEST_NAME 一起生成，读取时优先使用
+  # 描述对象在第一次被查询时才读取；该文件不存在或无法使用时再读取 MANIFEST_NAME
+  MANIFEST_INDEX_NAME : typing.ClassVar[str] = "manifest.ppidx"
 
   # 对于额外的素材目录，应该在每个目录下都有这么一个文件，包含类似 ASSET_MANIFEST 的内容
   MANIFEST_SRC_NAME : typing.ClassVar[str] = "preppipe_asset_manifest.yml"
@@ -77,6 +89,14 @@ class AssetManager:
     ASSETREF_DEFAULT_FONT,
   )
 
+  # prefetch() 在后台读取素材时使用的线程数
+  PREFETCH_WORKERS : typing.ClassVar[int] = 4
+  # prefetch(load_data=True) 最多预读多少字节的素材数据（以 get_asset_data_size() 的估算为准），超出的部分等到使用时再读取
+  # 用量从上次调用 reset_prefetch_data_budget() 开始累计（一般每次导出时重置一次）
+  # 预读的图片都放在 DecodedImageCache 中，这个值应该比它的上限小，否则预读的数据在使用前就会被淘汰
+  # 可以用环境变量 PREPPIPE_ASSET_PREFETCH_BUDGET_MB 指定（单位 MiB）
+  DEFAULT_PREFETCH_DATA_BUDGET : typing.ClassVar[int] = 256 * 1024 * 1024
+
   @staticmethod
   def decompose_asset_relpath(relpath : str) -> tuple[str, str]:
     # 每个 ASSET_MANIFEST 的键都应该是一个符合该函数逻辑的相对路径
@@ -91,26 +111,56 @@ class AssetManager:
     handle_class : type # 应该是一个由 AssetClassDecl 修饰的类
     handle : typing.Any | None # 应该是 handle_class 的一个实例
 
+  @dataclasses.dataclass
+  class AssetBuildTask:
+    # 构建单个素材包所需的所有信息，并行构建时会被传给子进程（handle_class 只传模块名和 classid）
+    classid : str
+    handle_class : type
+    name : str
+    relpath : str
+    installpath : str
+    buildargs : dict[str, typing.Any] # 已经替换过 {srcpath} 的构建参数
+    fingerprint : str = ''
+
   _assets : dict[str, AssetPackInfo]
 
+  # 已读取的索引格式清单，键为素材的安装目录；延迟读取描述对象时需要
+  _manifest_indices : dict[str, ManifestIndex]
+
   # 由于多个部分需要使用内嵌字体，我们在这里统一解决
   _font : PIL.ImageFont.FreeTypeFont | None
 
+  # 素材包的读取可以在任意线程中进行（包括 prefetch() 的后台线程）
+  # 正在读取的素材包记录在 _loading 中（键为安装路径），其他线程等待同一个读取完成而不是重复读取
+  _loading : dict[str, concurrent.futures.Future]
+  _loading_lock : threading.Lock
+  _prefetch_executor : concurrent.futures.ThreadPoolExecutor | None
+  _prefetch_data_used : int # 已经分配给预读的素材数据的字节数
+  _prefetch_data_paths : set[str] # 已经预读过数据的素材包（安装路径），不重复预读
+
   def __init__(self, load_manifest : bool = True) -> None:
     self._assets = {}
+    self._manifest_indices = {}
     self._font = None
+    self._loading = {}
+    self._loading_lock = threading.Lock()
+    self._prefetch_executor = None
+    self._prefetch_data_used = 0
+    self._prefetch_data_paths = set()
     if load_manifest:
       self.try_load_manifest()
 
   @staticmethod
   def is_builtin_manifest_exists() -> bool:
     manifest_filepath = os.path.join(AssetManager.get_embedded_asset_install_path(), AssetManager.MANIFEST_NAME)
-    return os.path.exists(manifest_filepath)
+    manifest_index_filepath = os.path.join(AssetManager.get_embedded_asset_install_path(), AssetManager.MANIFEST_INDEX_NAME)
+    return os.path.exists(manifest_filepath) or os.path.exists(manifest_index_filepath)
 
   def try_load_manifest(self):
     # 先尝试加载内嵌的素材列表
+    # 索引格式的清单无法使用（比如是旧版本生成的素材）时再读取 manifest.pickle
     manifest_filepath = os.path.join(AssetManager.get_embedded_asset_install_path(), AssetManager.MANIFEST_NAME)
-    if os.path.exists(manifest_filepath):
+    if not self._try_handle_manifest_index(AssetManager.get_embedded_asset_install_path()) and os.path.exists(manifest_filepath):
       with open(manifest_filepath, "rb") as f:
         manifest = pickle.load(f)
         res = self._handle_manifest(manifest, install_base=AssetManager.get_embedded_asset_install_path(), isbuiltin=True)
@@ -151,8 +201,10 @@ class AssetManager:
     install_dir = AssetManager.get_extra_asset_install_path(path)
     if not force_rebuild:
       manifest_mtime = os.path.getmtime(manifest_yml_path)
-      # 尝试读取现有的 manifest.pickle，一切顺利的话直接返回
+      # 尝试读取现有的 manifest.ppidx 或 manifest.pickle，一切顺利的话直接返回
       if os.path.isdir(install_dir):
+        if self._try_handle_manifest_index(install_dir, min_mtime=manifest_mtime):
+          return
         manifest_pickle_path = os.path.join(install_dir, AssetManager.MANIFEST_NAME)
         if os.path.exists(manifest_pickle_path):
           if os.path.getmtime(manifest_pickle_path) >= manifest_mtime:
@@ -165,7 +217,7 @@ class AssetManager:
     # （构建时 build_asset_archive 会再次 add_descriptor 并注册翻译，必须先清掉旧翻译）
     if force_rebuild:
       self.unload_extra_assets_from_path(path)
-    self.build_assets_extra(path)
+    self.build_assets_extra(path, force=force_rebuild)
 
   @staticmethod
   def lookup_asset_class(classid : str) -> type:
@@ -214,16 +266,165 @@ class AssetManager:
       handle_class.load_descriptors(descriptor_list)
     return True
 
-  def _load_asset(self, info : AssetPackInfo):
-    if info.handle is None:
-      asset_srcpath = info.installpath
-      if os.path.exists(asset_srcpath):
-        info.handle = info.handle_class.create_from_asset_archive(asset_srcpath)
+  @staticmethod
+  def _try_open_manifest_index(install_base : str, min_mtime : float | None = None) -> ManifestIndex | None:
+    # 索引文件不存在、比 min_mtime 旧、无法解析或者版本不匹配时返回 None
+    indexpath = os.path.join(install_base, AssetManager.MANIFEST_INDEX_NAME)
+    if not os.path.isfile(indexpath):
+      return None
+    if min_mtime is not None and os.path.getmtime(indexpath) < min_mtime:
+      return None
+    try:
+      index = ManifestIndex(indexpath)
+    except (OSError, ValueError, KeyError, TypeError, PPInternalError):
+      return None
+    if index.program_version != __version__:
+      return None
+    return index
+
+  def _try_handle_manifest_index(self, install_base : str, min_mtime : float | None = None) -> bool:
+    # 与 _handle_manifest() 相同，但支持延迟读取的描述对象只登记，不读取
+    index = AssetManager._try_open_manifest_index(install_base, min_mtime)
+    if index is None:
+      return False
+    for classid, path_list in index.items_by_class.items():
+      handle_class = AssetManager.lookup_asset_class(classid)
+      for relpath in path_list:
+        name = AssetManager.get_asset_name(relpath, install_base)
+        installpath = os.path.join(install_base, relpath)
+        self._add_asset_info(name, installpath, handle_class)
+    for classid, entries in index.descriptors.items():
+      handle_class = AssetManager.lookup_asset_class(classid)
+      eager_descriptors = []
+      for entry in entries:
+        if entry.identifier is not None and hasattr(handle_class, "add_pending_descriptor"):
+          handle_class.add_pending_descriptor(entry.identifier, entry.names, functools.partial(index.load_descriptor, entry))
+        else:
+          eager_descriptors.append(index.load_descriptor(entry))
+      if len(eager_descriptors) > 0:
+        handle_class.load_descriptors(eager_descriptors)
+    self._manifest_indices[os.path.normpath(install_base)] = index
+    return True
+
+  def _close_manifest_index(self, install_base : str) -> None:
+    if index := self._manifest_indices.pop(os.path.normpath(install_base), None):
+      index.close()
+
+  @staticmethod
+  def _write_manifest(install_base : str, manifestobj : AssetManifestObject) -> None:
+    # 同时写入 pickle 与索引两种格式
+    manifestpath = os.path.join(install_base, AssetManager.MANIFEST_NAME)
+    with open(manifestpath, "wb") as f:
+      pickle.dump(manifestobj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    index_descriptors : dict[str, list[tuple[str | None, tuple[str, ...], typing.Any]]] = {}
+    for classid, descriptor_list in manifestobj.descriptors.items():
+      handle_class = AssetManager.lookup_asset_class(classid)
+      lazy = hasattr(handle_class, "add_pending_descriptor")
+      class_entries = []
+      for d in descriptor_list:
+        if lazy:
+          class_entries.append((handle_class.get_candidate_id(d), handle_class.get_lookup_names(handle_class.get_candidate_name(d)), d))
+        else:
+          class_entries.append((None, (), d))
+      index_descriptors[classid] = class_entries
+    ManifestIndex.write(os.path.join(install_base, AssetManager.MANIFEST_INDEX_NAME), manifestobj.program_version, manifestobj.items_by_class, manifestobj.fingerprints, index_descriptors)
+
+  def _load_asset(self, info : AssetPackInfo) -> typing.Any | None:
+    # 读取素材包并返回其句柄，素材包不存在时返回 None；可以在任意线程中调用
+    with self._loading_lock:
+      if info.handle is not None:
+        return info.handle
+      future = self._loading.get(info.installpath)
+      is_owner = future is None
+      if future is None:
+        future = concurrent.futures.Future()
+        self._loading[info.installpath] = future
+    if not is_owner:
+      return future.result()
+    try:
+      handle = None
+      if os.path.exists(info.installpath):
+        handle = info.handle_class.create_from_asset_archive(info.installpath)
+    except BaseException as e:
+      with self._loading_lock:
+        del self._loading[info.installpath]
+      future.set_exception(e)
+      raise
+    with self._loading_lock:
+      info.handle = handle
+      del self._loading[info.installpath]
+    future.set_result(handle)
+    return handle
 
   def load_all_assets(self):
-    for name, info in self._assets.items():
-      if info.handle is None:
-        self._load_asset(info)
+    for future in self.prefetch(self._assets.keys()):
+      future.result()
+
+  @staticmethod
+  def get_prefetch_data_budget() -> int:
+    if budget_str := os.environ.get("PREPPIPE_ASSET_PREFETCH_BUDGET_MB"):
+      return int(budget_str) * 1024 * 1024
+    return AssetManager.DEFAULT_PREFETCH_DATA_BUDGET
+
+  def reset_prefetch_data_budget(self) -> None:
+    with self._loading_lock:
+      self._prefetch_data_used = 0
+      self._prefetch_data_paths.clear()
+
+  def prefetch(self, names : typing.Iterable[str], load_data : bool = False) -> list[concurrent.futures.Future]:
+    # 在后台线程中读取素材包，之后的 get_asset() 不需要再等待读取（正在读取的话会等待同一个读取完成）
+    # 返回各个素材包的 Future，结果为素材包的句柄（不存在时为 None）；不认识的名称会被忽略
+    # 调用者不需要等待返回的 Future；读取失败的话之后的 get_asset() 会重新读取并抛出异常
+    # load_data 为 True 时，如果素材处理类支持 prefetch_asset_data()，同时预读素材包的数据，总量不超过 get_prefetch_data_budget()；超出时只读取素材包本身
+    # 预读的数据量按素材包读取完成的先后分配
+    infos : list[AssetManager.AssetPackInfo] = []
+    for name in names:
+      if info := self._assets.get(name, None):
+        infos.append(info)
+    if len(infos) == 0:
+      return []
+    with self._loading_lock:
+      if self._prefetch_executor is None:
+        self._prefetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=AssetManager.PREFETCH_WORKERS, thread_name_prefix="AssetPrefetch")
+      executor = self._prefetch_executor
+    budget = AssetManager.get_prefetch_data_budget()
+    def prefetch_single(info : AssetManager.AssetPackInfo) -> typing.Any | None:
+      handle = self._load_asset(info)
+      if load_data and handle is not None and hasattr(handle, "prefetch_asset_data"):
+        size = handle.get_asset_data_size()
+        with self._loading_lock:
+          is_prefetch_data = info.installpath not in self._prefetch_data_paths and self._prefetch_data_used + size <= budget
+          if is_prefetch_data:
+            self._prefetch_data_used += size
+            self._prefetch_data_paths.add(info.installpath)
+        if is_prefetch_data:
+          handle.prefetch_asset_data()
+      return handle
+    result : list[concurrent.futures.Future] = []
+    for info in infos:
+      if info.handle is not None and not load_data:
+        # 已经读取的素材包不需要再提交
+        future = concurrent.futures.Future()
+        future.set_result(info.handle)
+        result.append(future)
+      else:
+        result.append(executor.submit(prefetch_single, info))
+    return result
+
+  def stop_prefetch(self) -> None:
+    # 等待所有已提交的预读完成并结束后台线程；之后再调用 prefetch() 会重新创建线程
+    # 需要 fork 子进程前调用，避免子进程继承预读线程持有的锁
+    with self._loading_lock:
+      executor = self._prefetch_executor
+      self._prefetch_executor = None
+    if executor is not None:
+      executor.shutdown(wait=True)
+
+  @staticmethod
+  def stop_prefetch_if_running() -> None:
+    # 与 stop_prefetch() 相同，但不会为此创建单例
+    if AssetManager._instance is not None:
+      AssetManager._instance.stop_prefetch()
 
   def get_assets_json(self) -> dict:
     result_dict = {}
@@ -238,14 +439,15 @@ class AssetManager:
     return result_dict
 
   def get_asset(self, name : str) -> typing.Any | None:
+    # 可以在任意线程中调用；素材包正在被 prefetch() 读取时会等待读取完成
     if info := self._assets.get(name, None):
       if info.handle is None:
-        self._load_asset(info)
+        return self._load_asset(info)
       return info.handle
     return None
 
   def get_asset_noload(self, name : str) -> typing.Any | None:
-    # 获取素材，但不加载；用于在多线程环境下获取素材的句柄
+    # 获取素材，但不加载；用于只想使用已经读取的素材、不想因为读取而等待的情况
     if info := self._assets.get(name, None):
       return info.handle
     return None
@@ -270,6 +472,7 @@ class AssetManager:
       handle_class.remove_descriptors_by_identifiers(names)
     for name, _ in to_remove:
       del self._assets[name]
+    self._close_manifest_index(install_base)
 
   def reload_extra_assets(self):
     """Reload extra assets (non-builtin) from environment variables.
@@ -289,6 +492,9 @@ class AssetManager:
       handle_class.remove_descriptors_by_identifiers(names)
     for name, _ in to_remove:
       del self._assets[name]
+    for install_base in list(self._manifest_indices.keys()):
+      if not install_base.startswith(os.path.normpath(embedded_path)):
+        self._close_manifest_index(install_base)
     # Reload extra assets from environment variables
     extra_assets_dirs_dict = collections.OrderedDict()
     if envval := os.getenv(AssetManager.EXTRA_ASSETS_PARENT_DIRS_ENV, None):
@@ -376,14 +582,108 @@ class AssetManager:
     zh_hk="{srcpath}: 素材包構建完成",
   )
 
-  def build_assets_impl(self, srcpath : str, install_base : str, manifest : dict[str, dict[str, dict[str, typing.Any]]]):
+  _tr_build_item_done = TR_assetmanager.tr("build_item_done",
+    en="({index}/{num}) Asset built: {installpath}",
+    zh_cn="({index}/{num})素材构建完成：{installpath}",
+    zh_hk="({index}/{num})素材構建完成：{installpath}",
+  )
+  _tr_build_item_failed = TR_assetmanager.tr("build_item_failed",
+    en="Failed to build asset {installpath}: {error}",
+    zh_cn="素材 {installpath} 构建失败：{error}",
+    zh_hk="素材 {installpath} 構建失敗：{error}",
+  )
+  _tr_build_failed = TR_assetmanager.tr("build_failed",
+    en="{srcpath}: {num} asset(s) failed to build: {installpaths}",
+    zh_cn="{srcpath}: 有 {num} 个素材构建失败：{installpaths}",
+    zh_hk="{srcpath}: 有 {num} 個素材構建失敗：{installpaths}",
+  )
+
+  _tr_build_item_unchanged = TR_assetmanager.tr("build_item_unchanged",
+    en="({index}/{num}) Asset unchanged, skipping: {installpath}",
+    zh_cn="({index}/{num})素材没有变化，跳过：{installpath}",
+    zh_hk="({index}/{num})素材沒有變化，跳過：{installpath}",
+  )
+
+  @staticmethod
+  def _get_file_hash(path : str, cache : dict[tuple[str, int, int], str]) -> str:
+    # 同一次构建中同一个文件可能被多个素材引用，按 (路径, 大小, 修改时间) 缓存结果
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime_ns)
+    if (result := cache.get(key, None)) is not None:
+      return result
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+      while chunk := f.read(1024 * 1024):
+        h.update(chunk)
+    result = h.hexdigest()
+    cache[key] = result
+    return result
+
+  @staticmethod
+  def get_asset_build_fingerprint(task : AssetBuildTask, file_hash_cache : dict[tuple[str, int, int], str]) -> str:
+    # 素材的输入指纹：程序版本、素材类型、构建参数、构建配置以及所有输入文件的内容
+    if hasattr(task.handle_class, "get_asset_build_inputs"):
+      config, inputs = task.handle_class.get_asset_build_inputs(**task.buildargs)
+    else:
+      config = None
+      inputs = [v for v in task.buildargs.values() if isinstance(v, str) and os.path.exists(v)]
+    # 不存在的输入（比如可选的选区图）也记录下来，这样之后添加该文件时也会重新构建
+    files : set[str] = set()
+    missing : set[str] = set()
+    for path in inputs:
+      if os.path.isdir(path):
+        for root, _, filenames in os.walk(path):
+          for filename in filenames:
+            files.add(os.path.join(root, filename))
+      elif os.path.isfile(path):
+        files.add(path)
+      else:
+        missing.add(path)
+    h = hashlib.sha256()
+    h.update(json.dumps([__version__, task.classid, task.buildargs, config], sort_keys=True, ensure_ascii=False, default=str).encode("utf-8"))
+    for path in sorted(files):
+      h.update(("\n" + path + ":" + AssetManager._get_file_hash(path, file_hash_cache)).encode("utf-8"))
+    for path in sorted(missing):
+      h.update(("\n" + path + ":").encode("utf-8"))
+    return h.hexdigest()
+
+  @staticmethod
+  def _read_previous_build(install_base : str, tasks : list[AssetBuildTask]) -> tuple[dict[str, str], dict[str, typing.Any]]:
+    # 读取上次构建生成的 manifest，返回 (素材相对路径 -> 输入指纹, 素材相对路径 -> 描述对象)
+    # 只读取索引中的指纹；描述对象只有在指纹相同、可以沿用时才反序列化（反序列化时会注册翻译）
+    # 没有索引、版本不同或者文件有问题的话当作没有上次的结果
+    index = AssetManager._try_open_manifest_index(install_base)
+    if index is None:
+      return ({}, {})
+    try:
+      fingerprints = index.fingerprints
+      # 描述对象按 ID （即素材名称）对应到素材
+      entries_by_name : dict[str, dict[str, ManifestIndexEntry]] = {}
+      for classid, entries in index.descriptors.items():
+        entries_by_name[classid] = {entry.identifier : entry for entry in entries if entry.identifier is not None}
+      descriptors : dict[str, typing.Any] = {}
+      for task in tasks:
+        if fingerprints.get(task.relpath, None) != task.fingerprint:
+          continue
+        if (entry := entries_by_name.get(task.classid, {}).get(task.name, None)) is not None:
+          descriptors[task.relpath] = index.load_descriptor(entry)
+    except Exception: # pylint: disable=broad-exception-caught
+      return ({}, {})
+    finally:
+      index.close()
+    return (fingerprints, descriptors)
+
+  def build_assets_impl(self, srcpath : str, install_base : str, manifest : dict[str, dict[str, dict[str, typing.Any]]], jobs : int = 1, force : bool = False):
+    # jobs 大于 1 时使用多个进程并行构建各个素材包
+    # 除非 force 为 True，输入指纹与上次构建时相同的素材不会重新构建
     if not os.path.isdir(install_base):
       os.makedirs(install_base, exist_ok=True)
     num_total_assets = sum(len(v) for v in manifest.values())
-    asset_index = 0
     descriptors : dict[str, list[typing.Any]] = {}
     items_by_class : dict[str, list[str]] = {}
     MessageHandler.info(AssetManager._tr_build_start.format(srcpath=srcpath, num=str(num_total_assets)))
+    tasks : list[AssetManager.AssetBuildTask] = []
+    file_hash_cache : dict[tuple[str, int, int], str] = {}
     for classid, class_manifest in manifest.items():
       handle_class = _registered_asset_classes.get(classid, None)
       if handle_class is None:
@@ -403,21 +703,90 @@ class AssetManager:
         install_parent = os.path.dirname(installpath)
         if not os.path.isdir(install_parent):
           os.makedirs(install_parent, exist_ok=True)
-        asset_index += 1
-        MessageHandler.info(AssetManager._tr_build_item.format(index=str(asset_index), num=str(num_total_assets), installpath=installpath))
-        descriptor = handle_class.build_asset_archive(name=name, destpath=installpath, **converted_args)
-        self._add_asset_info(name, installpath, handle_class, None)
-        if descriptor is not None:
-          if classid not in descriptors:
-            descriptors[classid] = []
-          descriptors[classid].append(descriptor)
-          if not hasattr(handle_class, "load_descriptors"):
-            raise PPInternalError(f"Asset class {classid} does not have a load_descriptors method while returning a manifest object")
+        task = AssetManager.AssetBuildTask(classid=classid, handle_class=handle_class, name=name, relpath=relpath, installpath=installpath, buildargs=converted_args)
+        task.fingerprint = AssetManager.get_asset_build_fingerprint(task, file_hash_cache)
+        tasks.append(task)
+
+    # 输入指纹与上次构建时相同、且输出还在的素材直接沿用上次的结果
+    built_descriptors : list[typing.Any] = [None] * len(tasks)
+    todo_indices : list[int] = []
+    previous_fingerprints, previous_descriptors = ({}, {}) if force else AssetManager._read_previous_build(install_base, tasks)
+    for index, task in enumerate(tasks):
+      previous_descriptor = previous_descriptors.get(task.relpath, None)
+      if previous_fingerprints.get(task.relpath, None) == task.fingerprint and os.path.exists(task.installpath):
+        if previous_descriptor is not None:
+          task.handle_class.load_descriptors([previous_descriptor])
+          built_descriptors[index] = previous_descriptor
+          MessageHandler.info(AssetManager._tr_build_item_unchanged.format(index=str(index + 1), num=str(num_total_assets), installpath=task.installpath))
+          continue
+        if not hasattr(task.handle_class, "load_descriptors"):
+          MessageHandler.info(AssetManager._tr_build_item_unchanged.format(index=str(index + 1), num=str(num_total_assets), installpath=task.installpath))
+          continue
+      todo_indices.append(index)
+
+    if jobs > 1 and len(todo_indices) > 1:
+      for index, descriptor in zip(todo_indices, self._build_assets_parallel(srcpath, [tasks[i] for i in todo_indices], jobs)):
+        built_descriptors[index] = descriptor
+    else:
+      for index in todo_indices:
+        task = tasks[index]
+        MessageHandler.info(AssetManager._tr_build_item.format(index=str(index + 1), num=str(num_total_assets), installpath=task.installpath))
+        built_descriptors[index] = task.handle_class.build_asset_archive(name=task.name, destpath=task.installpath, **task.buildargs)
+    # 按清单中的顺序整理结果，这样不管是否并行构建，生成的 manifest 都是一样的
+    fingerprints : dict[str, str] = {}
+    for task, descriptor in zip(tasks, built_descriptors):
+      fingerprints[task.relpath] = task.fingerprint
+      self._add_asset_info(task.name, task.installpath, task.handle_class, None)
+      if descriptor is not None:
+        if task.classid not in descriptors:
+          descriptors[task.classid] = []
+        descriptors[task.classid].append(descriptor)
+        if not hasattr(task.handle_class, "load_descriptors"):
+          raise PPInternalError(f"Asset class {task.classid} does not have a load_descriptors method while returning a manifest object")
     MessageHandler.info(AssetManager._tr_build_finish.format(srcpath=srcpath))
-    manifestpath = os.path.join(install_base, AssetManager.MANIFEST_NAME)
-    manifestobj = AssetManifestObject(program_version=__version__, descriptors=descriptors, items_by_class=items_by_class)
-    with open(manifestpath, "wb") as f:
-      pickle.dump(manifestobj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    manifestobj = AssetManifestObject(program_version=__version__, descriptors=descriptors, items_by_class=items_by_class, fingerprints=fingerprints)
+    self._close_manifest_index(install_base)
+    AssetManager._write_manifest(install_base, manifestobj)
+
+  @staticmethod
+  def _build_asset_in_subprocess(classid : str, modulename : str, name : str, installpath : str, buildargs : dict[str, typing.Any]) -> typing.Any:
+    # 在子进程中构建单个素材包，返回描述对象
+    # 子进程不一定是 fork 出来的（比如 Windows 上），所以先导入定义素材处理类的模块以确保该类已经注册
+    importlib.import_module(modulename)
+    handle_class = _registered_asset_classes.get(classid, None)
+    if handle_class is None:
+      raise PPInternalError(f"Asset class {classid} not found")
+    return handle_class.build_asset_archive(name=name, destpath=installpath, **buildargs)
+
+  def _build_assets_parallel(self, srcpath : str, tasks : list[AssetBuildTask], jobs : int) -> list[typing.Any]:
+    # 返回与 tasks 一一对应的描述对象
+    # 单个素材构建失败不影响其他素材，所有素材都处理完后如果有失败的再报错（此时不会写入 manifest）
+    results : list[typing.Any] = [None] * len(tasks)
+    failed_indices : list[int] = []
+    num_done = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+      futures : dict[concurrent.futures.Future, int] = {}
+      for index, task in enumerate(tasks):
+        MessageHandler.info(AssetManager._tr_build_item.format(index=str(index + 1), num=str(len(tasks)), installpath=task.installpath))
+        futures[executor.submit(AssetManager._build_asset_in_subprocess, task.classid, task.handle_class.__module__, task.name, task.installpath, task.buildargs)] = index
+      for future in concurrent.futures.as_completed(futures):
+        index = futures[future]
+        num_done += 1
+        try:
+          results[index] = future.result()
+        except Exception as e:
+          failed_indices.append(index)
+          MessageHandler.error(AssetManager._tr_build_item_failed.format(installpath=tasks[index].installpath, error=str(e)))
+          continue
+        MessageHandler.info(AssetManager._tr_build_item_done.format(index=str(num_done), num=str(len(tasks)), installpath=tasks[index].installpath))
+    if len(failed_indices) > 0:
+      failed_indices.sort()
+      raise PPInvalidOperationError(AssetManager._tr_build_failed.format(srcpath=srcpath, num=str(len(failed_indices)), installpaths=", ".join(tasks[i].installpath for i in failed_indices)))
+    # 子进程中注册的描述对象不会出现在当前进程中，这里按顺序重新注册（与读取 manifest 时相同）
+    for task, descriptor in zip(tasks, results):
+      if descriptor is not None:
+        task.handle_class.load_descriptors([descriptor])
+    return results
 
   _tr_asset_dir_not_found = TR_assetmanager.tr("asset_dir_not_found",
     en="Asset directory {path} not found",
@@ -515,18 +884,18 @@ class AssetManager:
     handle_subdirs_recursive(result, manifest_src, "")
     return result
 
-  def build_assets_embedded(self, srcpath : str):
+  def build_assets_embedded(self, srcpath : str, jobs : int = 1, force : bool = False):
     manifest_src = AssetManager.read_manifest_src(srcpath)
     install_base = AssetManager.get_embedded_asset_install_path()
-    self.build_assets_impl(srcpath, install_base, manifest_src)
+    self.build_assets_impl(srcpath, install_base, manifest_src, jobs=jobs, force=force)
     for ref in AssetManager.ASSETREF_CHECKLIST:
       if ref not in self._assets:
         raise PPInternalError(f"Embedded asset {ref} not found in manifest")
 
-  def build_assets_extra(self, srcpath : str):
+  def build_assets_extra(self, srcpath : str, jobs : int = 1, force : bool = False):
     manifest_src = AssetManager.read_manifest_src(srcpath)
     install_base = AssetManager.get_extra_asset_install_path(srcpath)
-    self.build_assets_impl(srcpath, install_base, manifest_src)
+    self.build_assets_impl(srcpath, install_base, manifest_src, jobs=jobs, force=force)
 
   _tr_assetlistings_title = TR_assetmanager.tr("assetlistings_title",
     en="Embedded Assets",
@@ -620,6 +989,8 @@ class AssetManager:
     parser.add_argument("--export-docs", metavar="<yml>", help="Export asset documentation accoding to the specified YAML file")
     parser.add_argument("--export-built-embedded", metavar="<dir>", help="Copy the embedded assets to the specified directory")
     parser.add_argument("--dump-json", action="store_true", help="Dump all asset info as a JSON string")
+    parser.add_argument("-j", "--jobs", metavar="N", type=int, default=1, help="Number of asset packs to build in parallel (default: 1)")
+    parser.add_argument("--force", action="store_true", help="Rebuild all assets even if their inputs are unchanged")
     if args is None:
       args = sys.argv[1:]
     parsed_args = parser.parse_args(args)
@@ -628,10 +999,10 @@ class AssetManager:
       AssetManager._debug = True
     if parsed_args.build_embedded is not None or parsed_args.build_extra is not None:
       if parsed_args.build_embedded is not None:
-        AssetManager.get_instance().build_assets_embedded(parsed_args.build_embedded)
+        AssetManager.get_instance().build_assets_embedded(parsed_args.build_embedded, jobs=parsed_args.jobs, force=parsed_args.force)
       if parsed_args.build_extra is not None:
         for p in parsed_args.build_extra:
-          AssetManager.get_instance().build_assets_extra(p)
+          AssetManager.get_instance().build_assets_extra(p, jobs=parsed_args.jobs, force=parsed_args.force)
     else:
       AssetManager.get_instance().try_load_manifest()
 
@@ -0,0 +1,129 @@
+# SPDX-FileCopyrightText: 2025 PrepPipe's Contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# 素材清单的索引格式
+# manifest.pickle 在启动时需要整个反序列化，包括所有描述对象（图片包的描述对象中有翻译、组合等不少内容），即使这次运行根本用不到素材
+# 该格式把每个描述对象单独 pickle，打开时只解析索引，描述对象在第一次被查询时才从映射的文件中反序列化
+#
+# 文件结构：
+#   8 字节魔数 MANIFEST_INDEX_MAGIC
+#   8 字节小端无符号整数：索引的长度
+#   索引（UTF-8 JSON）:
+#     {
+#       "program_version": <版本>,
+#       "items_by_class": {<classid>: [<相对路径>, ...]},
+#       "fingerprints": {<相对路径>: <输入指纹>},
+#       "descriptors": {<classid>: [[<ID>, [<可用于查找的名称>, ...], <偏移>, <长度>], ...]}
+#     }
+#     偏移是相对于文件开头的字节数；素材类不支持延迟读取时 ID 为 null，名称为空
+#   各描述对象 pickle 后的数据
+
+import json
+import mmap
+import pickle
+import struct
+import threading
+import typing
+
+from ..exceptions import *
+
+MANIFEST_INDEX_MAGIC = b"PPAMIDX1"
+
+_HEADER_STRUCT = struct.Struct("<8sQ")
+
+class ManifestIndexEntry(typing.NamedTuple):
+  identifier : str | None
+  names : tuple[str, ...]
+  offset : int
+  length : int
+
+class ManifestIndex:
+  path : str
+  program_version : str
+  items_by_class : dict[str, list[str]]
+  fingerprints : dict[str, str]
+  descriptors : dict[str, list[ManifestIndexEntry]]
+  _file : typing.BinaryIO | None
+  _mapped : mmap.mmap | None
+  _lock : threading.Lock
+
+  def __init__(self, path : str) -> None:
+    self.path = path
+    self._file = None
+    self._mapped = None
+    self._lock = threading.Lock()
+    with open(path, "rb") as f:
+      header = f.read(_HEADER_STRUCT.size)
+      if len(header) != _HEADER_STRUCT.size:
+        raise PPInternalError("Invalid asset manifest index (file too short): " + path)
+      magic, index_size = _HEADER_STRUCT.unpack(header)
+      if magic != MANIFEST_INDEX_MAGIC:
+        raise PPInternalError("Invalid asset manifest index (unknown magic " + str(magic) + "): " + path)
+      index = json.loads(f.read(index_size).decode("utf-8"))
+    if not isinstance(index, dict):
+      raise PPInternalError("Invalid asset manifest index: " + path)
+    self.program_version = index["program_version"]
+    self.items_by_class = index["items_by_class"]
+    self.fingerprints = index["fingerprints"]
+    self.descriptors = {}
+    for classid, entries in index["descriptors"].items():
+      self.descriptors[classid] = [ManifestIndexEntry(identifier, tuple(names), offset, length) for identifier, names, offset, length in entries]
+
+  def _get_mapped(self) -> mmap.mmap:
+    # 第一次读取描述对象时才映射文件，之后一直保留到 close()
+    with self._lock:
+      if self._mapped is None:
+        self._file = open(self.path, "rb")
+        self._mapped = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+      return self._mapped
+
+  def load_descriptor(self, entry : ManifestIndexEntry) -> typing.Any:
+    return pickle.loads(self._get_mapped()[entry.offset:entry.offset+entry.length])
+
+  def close(self) -> None:
+    # 之后不能再读取描述对象；重新构建素材前需要关闭，否则在 Windows 上无法覆盖该文件
+    with self._lock:
+      if self._mapped is not None:
+        self._mapped.close()
+        self._mapped = None
+      if self._file is not None:
+        self._file.close()
+        self._file = None
+
+  @staticmethod
+  def write(path : str, program_version : str, items_by_class : dict[str, list[str]], fingerprints : dict[str, str], descriptors : dict[str, list[tuple[str | None, tuple[str, ...], typing.Any]]]) -> None:
+    # descriptors: classid -> [(ID, 可用于查找的名称, 描述对象), ...]
+    blocks : list[bytes] = []
+    entries : dict[str, list[list]] = {}
+    for classid, descriptor_list in descriptors.items():
+      class_entries : list[list] = []
+      entries[classid] = class_entries
+      for identifier, names, descriptor in descriptor_list:
+        class_entries.append([identifier, list(names), 0, 0])
+        blocks.append(pickle.dumps(descriptor, protocol=pickle.HIGHEST_PROTOCOL))
+    # 与 LayerStore 一样，索引中的偏移会影响索引的长度，所以先估算索引长度，不够的话加长再算一遍，多出来的部分用空格填充
+    index_size = 0
+    while True:
+      offset = _HEADER_STRUCT.size + index_size
+      block_iter = iter(blocks)
+      for class_entries in entries.values():
+        for entry in class_entries:
+          data = next(block_iter)
+          entry[2] = offset
+          entry[3] = len(data)
+          offset += len(data)
+      index_bytes = json.dumps({
+        "program_version": program_version,
+        "items_by_class": items_by_class,
+        "fingerprints": fingerprints,
+        "descriptors": entries,
+      }, ensure_ascii=False, separators=(',', ':')).encode("utf-8")
+      if len(index_bytes) <= index_size:
+        index_bytes += b" " * (index_size - len(index_bytes))
+        break
+      index_size = len(index_bytes) + 64
+    with open(path, "wb") as f:
+      f.write(_HEADER_STRUCT.pack(MANIFEST_INDEX_MAGIC, index_size))
+      f.write(index_bytes)
+      for data in blocks:
+        f.write(data)
@@ -8,6 +8,7 @@ from ..vnmodel import *
 from ..util.imagepackexportop import *
 from ..util.imageexprexportop import *
 from ..util.nameconvert import *
+from ..assets.assetmanager import AssetManager
 
 SelfType = typing.TypeVar('SelfType', bound='BackendCodeGenHelperBase') # pylint: disable=invalid-name
 NodeType = typing.TypeVar('NodeType', bound=BackendASTNodeBase) # pylint: disable=invalid-name
@@ -68,7 +69,10 @@ class BackendCodeGenHelperBase(typing.Generic[NodeType]):
 
   # --------------------------------------------------------------------------
   # 这个类自己用的成员
-  anon_asset_index_dict : collections.OrderedDict[str, int] # parent dir -> anon index
+  # 生成导出路径用：(parent dir, basename, ext) -> 下一个要尝试的后缀编号
+  # 匿名资源的 ext 为空字符串，即同一目录下不同后缀名的匿名资源共用一个编号
+  asset_export_index_dict : dict[tuple[str, str, str], int]
+  asset_export_path_dict : dict[Value, dict[tuple[str, str, str], str]] # 资源 -> {(parent dir, basename, ext): 导出路径}
   asset_decl_info_dict : collections.OrderedDict[Value, list[NamedAssetInfo]]
 
   # --------------------------------------------------------------------------
@@ -76,7 +80,8 @@ class BackendCodeGenHelperBase(typing.Generic[NodeType]):
   def __init__(self, model : VNModel, imagepack_handler : ImagePackExportDataBuilder | None) -> None:
     self.model = model
     self.imagepack_handler = imagepack_handler if imagepack_handler is not None else ImagePackExportDataBuilder()
-    self.anon_asset_index_dict = collections.OrderedDict()
+    self.asset_export_index_dict = {}
+    self.asset_export_path_dict = {}
     self.asset_decl_info_dict = collections.OrderedDict()
 
   @property
@@ -296,24 +301,33 @@ class BackendCodeGenHelperBase(typing.Generic[NodeType]):
       baseext = oldext[1:]
     if export_format_ext is not None:
       baseext = export_format_ext
-    # 找到一个没被用上的名字
+    # 如果同一个资源已经在同样的名字下导出过（之前生成的路径上已经有引用它的资源）就直接报错（不应该尝试生成导出路径）
+    # 只生成了路径、没有加到资源列表里的（比如 lower_imageexpr_image_impl() 的可缓存导出）不算
+    # 匿名资源的编号是接着上次的，之前的编号本来就不会再检查，所以只看不带编号的路径
+    name_key = (parentdir, basename, baseext)
     cur_path = parentdir + '/' + basename + '.' + baseext
-    if existing := self.get_result().get_asset(cur_path):
-      # 如果内容一样就直接报错（不应该尝试生成导出路径）
-      # 不然的话加后缀直到不重名
-      if existing.get_asset_value() is duplicate_check_item:
-        raise RuntimeError('Trying to export an asset that is already exported (not resolving aliases correctly?)')
-      suffix = 0
-      if basename == NAME_ANON and parentdir in self.anon_asset_index_dict:
-        suffix = self.anon_asset_index_dict[parentdir]
-      cur_path = parentdir + '/' + basename + '_' + str(suffix) + '.' + baseext
-      while existing := self.get_result().get_asset(cur_path):
-        if existing.get_asset_value() is duplicate_check_item:
+    existing_paths = self.asset_export_path_dict.get(duplicate_check_item, None)
+    if existing_paths is not None and (existing_path := existing_paths.get(name_key, None)) is not None:
+      if basename != NAME_ANON or existing_path == cur_path:
+        if (existing := self.get_result().get_asset(existing_path)) and existing.get_asset_value() is duplicate_check_item:
           raise RuntimeError('Trying to export an asset that is already exported (not resolving aliases correctly?)')
+    # 找到一个没被用上的名字
+    if self.get_result().get_asset(cur_path):
+      # 加后缀直到不重名
+      # 资源只增不减，所以之前试过的后缀现在一定还被占用着，从上次停下的地方继续即可，每个名字的总开销是线性的
+      # 生成的路径不一定会被加到资源列表里（比如可缓存导出），所以有名字的资源下次从这次返回的编号开始试
+      # 匿名资源与原来一样，不管是否被占用都用下一个编号
+      index_key = (parentdir, basename, '' if basename == NAME_ANON else baseext)
+      suffix = self.asset_export_index_dict.get(index_key, 0)
+      cur_path = parentdir + '/' + basename + '_' + str(suffix) + '.' + baseext
+      while self.get_result().get_asset(cur_path):
         suffix += 1
         cur_path = parentdir + '/' + basename + '_' + str(suffix) + '.' + baseext
-      if basename == NAME_ANON:
-        self.anon_asset_index_dict[parentdir] = suffix + 1
+      self.asset_export_index_dict[index_key] = suffix + 1 if basename == NAME_ANON else suffix
+    if existing_paths is None:
+      existing_paths = {}
+      self.asset_export_path_dict[duplicate_check_item] = existing_paths
+    existing_paths[name_key] = cur_path
     return cur_path
 
   def get_asset_export_format(self, v : AssetData) -> str:
@@ -381,6 +395,28 @@ class BackendCodeGenHelperBase(typing.Generic[NodeType]):
       value = a.get_value()
       self._add_asset_name(value, self.NamedAssetInfo(value=value, kind=self.NamedAssetKind.NAMED_MISC, self_symbol=a))
 
+  def prefetch_imagepacks(self, n : VNNamespace):
+    # 角色立绘、背景等声明中用到的图片包在生成代码（检查混合模式等）和导出时都要读取，这里先让 AssetManager 在后台开始读取
+    # 只在后端中这样做，前端解析时不启动后台线程
+    pack_ids : list[str] = []
+    def add_value(value : Value):
+      if isinstance(value, ImagePackElementLiteralExpr):
+        pack_id = value.pack_id.get_string()
+        if pack_id not in pack_ids:
+          pack_ids.append(pack_id)
+    for c in n.characters:
+      for symb in c.sprites:
+        add_value(symb.get_value())
+      for symb in c.sideimages:
+        add_value(symb.get_value())
+    for b in n.scenes:
+      for bg in b.backgrounds:
+        add_value(bg.get_value())
+    for a in n.assets:
+      add_value(a.get_value())
+    if len(pack_ids) > 0:
+      AssetManager.get_instance().prefetch(pack_ids)
+
   def get_handle_value_and_device(self, handlein : Value) -> tuple[Value, VNDeviceSymbol]:
     assert isinstance(handlein, (VNCreateInst, VNModifyInst, BlockArgument))
     if isinstance(handlein, BlockArgument):
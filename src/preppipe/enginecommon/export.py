@@ -1,17 +1,236 @@
 # SPDX-FileCopyrightText: 2024 PrepPipe's Contributors
 # SPDX-License-Identifier: Apache-2.0
 
+import sys
+import filecmp
+import threading
+import multiprocessing
+import concurrent.futures
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
 from .ast import *
+from .. import __version__
 from ..exportcache import CacheableOperationSymbol
+from ..assets.assetmanager import AssetManager
+
+# 素材的放置方式：
+#   copy: 复制（默认）
+#   hardlink: 硬链接，不支持时（比如跨文件系统）退回到复制
+#   reflink: 写时复制的克隆（目前只支持 Linux 上 btrfs、XFS 等文件系统的 FICLONE），不支持时退回到复制
+# 只有原样导出的素材（导出就是复制一个已有的文件）才会使用硬链接或克隆，需要转换格式或者数据在内存中的素材总是直接写入
+# 注意使用硬链接时修改输出目录中的文件也会改动源文件
+ASSET_PLACEMENT_MODES : tuple[str, ...] = ("copy", "hardlink", "reflink")
+
+# 记录上次导出的非原样导出素材的内容标识（AssetData.get_export_source_key()），格式如下：
+# {
+#   "version": <__version__>,
+#   "assets": {<相对路径>: <内容标识>, ...}
+# }
+# 与 CacheableOperationSymbol 的缓存一样，标识相同且目标文件存在时就不再导出，不检查目标文件是否被改动过
+# 原样导出的素材不需要记录，直接比较源文件与目标文件的大小和修改时间（以及放置方式，见 _is_placed_file_up_to_date()）
+ASSET_EXPORT_CACHE_FILE_NAME = '.preppipe_asset_export_cache.json'
+
+_FICLONE = 0x40049409
+
+def _try_reflink(src : str, dest : str) -> bool:
+  if fcntl is None or not sys.platform.startswith("linux"):
+    return False
+  try:
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdst:
+      fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+  except OSError:
+    if os.path.exists(dest):
+      os.remove(dest)
+    return False
+  # 克隆不会保留修改时间，这里补上，下次导出时才能判断出文件没有变化
+  shutil.copystat(src, dest)
+  return True
+
+def _remove_existing_file(path : str) -> None:
+  # 目标文件可能是上次以硬链接方式导出的，直接覆盖写入会改动源文件，所以总是先删掉
+  if os.path.lexists(path) and not os.path.isdir(path):
+    os.remove(path)
+
+def _place_file(src : str, dest : str, placement : str) -> None:
+  _remove_existing_file(dest)
+  if placement == "hardlink":
+    try:
+      os.link(src, dest)
+      return
+    except OSError:
+      pass
+  elif placement == "reflink":
+    if _try_reflink(src, dest):
+      return
+  shutil.copy2(src, dest, follow_symlinks=False)
+
+def _is_placed_file_up_to_date(src_stat : os.stat_result, dest_stat : os.stat_result, placement : str) -> bool:
+  # 判断上次放置的目标文件是否可以保留：除了大小和修改时间相同之外，放置方式也要与这次的一致
+  # 硬链接与源文件是同一个 inode；复制或克隆的文件是独立的，不应该与其他文件共用 inode
+  # 这样在 hardlink 与 copy/reflink 之间切换后，已有的文件会被替换，而不是因为大小和修改时间相同而被跳过
+  if os.path.samestat(src_stat, dest_stat):
+    return placement == "hardlink"
+  if dest_stat.st_size != src_stat.st_size or dest_stat.st_mtime_ns != src_stat.st_mtime_ns:
+    return False
+  if placement == "hardlink":
+    # 跨文件系统时无法创建硬链接，_place_file() 会退回到复制，此时复制的文件就是最终结果
+    return dest_stat.st_dev != src_stat.st_dev
+  # 目标文件是其他文件的硬链接（比如之前以硬链接方式导出、源文件已经换过）时，修改它会改动别的文件，需要替换
+  return dest_stat.st_nlink == 1
+
+def _read_asset_export_cache(out_path : str) -> dict[str, str]:
+  cache_file_path = os.path.join(out_path, ASSET_EXPORT_CACHE_FILE_NAME)
+  if not os.path.exists(cache_file_path):
+    return {}
+  try:
+    with open(cache_file_path, 'r', encoding="utf-8") as f:
+      json_content = json.load(f)
+  except (OSError, ValueError):
+    return {}
+  if not isinstance(json_content, dict) or json_content.get('version', None) != __version__:
+    return {}
+  assets = json_content.get('assets', None)
+  if not isinstance(assets, dict):
+    return {}
+  return {k : v for k, v in assets.items() if isinstance(k, str) and isinstance(v, str)}
+
+def _export_asset(assetdata : AssetData, out_path : str, relpath : str, placement : str, previous_key : str | None) -> str | None:
+  # 导出单个素材，返回需要记录的内容标识（没有的话返回 None）
+  filepath = os.path.join(out_path, relpath)
+  parentdir = os.path.dirname(filepath)
+  os.makedirs(parentdir, exist_ok=True)
+  if srcpath := assetdata.get_export_passthrough_path(filepath):
+    src_stat = os.stat(srcpath)
+    try:
+      if _is_placed_file_up_to_date(src_stat, os.stat(filepath), placement):
+        return None
+    except FileNotFoundError:
+      pass
+    _place_file(srcpath, filepath, placement)
+    return None
+  key = assetdata.get_export_source_key()
+  if key is not None and key == previous_key and os.path.isfile(filepath):
+    return key
+  _remove_existing_file(filepath)
+  assetdata.export(filepath)
+  return key
+
+def write_bytes_if_changed(path : str, data : bytes) -> bool:
+  # 内容与现有文件相同时不写入，这样不会改变修改时间（Ren'Py 会根据修改时间判断是否需要重新编译脚本，其他工具也可能在监视输出目录）
+  # 需要写入时先写临时文件再替换，不会留下写了一半的文件；返回是否写入了文件
+  try:
+    if os.path.getsize(path) == len(data):
+      with open(path, 'rb') as f:
+        if f.read() == data:
+          return False
+  except OSError:
+    pass
+  tmppath = path + '.tmp'
+  with open(tmppath, 'wb') as f:
+    f.write(data)
+  os.replace(tmppath, path)
+  return True
+
+def write_text_if_changed(path : str, content : str) -> bool:
+  # 与以文本模式 open(path, 'w', encoding="utf-8") 写入的结果相同（换行符转换为 os.linesep）
+  if os.linesep != '\n':
+    content = content.replace('\n', os.linesep)
+  return write_bytes_if_changed(path, content.encode('utf-8'))
+
+def copy_template_dir(template_dir : str, out_path : str) -> None:
+  # 效果与 shutil.copytree(template_dir, out_path, dirs_exist_ok=True) 相同，但内容相同的文件不会再复制一遍
+  for root, _, filenames in os.walk(template_dir):
+    relpath = os.path.relpath(root, template_dir)
+    destdir = out_path if relpath == os.curdir else os.path.join(out_path, relpath)
+    os.makedirs(destdir, exist_ok=True)
+    for filename in filenames:
+      srcpath = os.path.join(root, filename)
+      destpath = os.path.join(destdir, filename)
+      if os.path.isfile(destpath) and filecmp.cmp(srcpath, destpath, shallow=False):
+        continue
+      _remove_existing_file(destpath)
+      shutil.copy2(srcpath, destpath)
+
+_ScriptTV = typing.TypeVar('_ScriptTV')
+
+# 用多进程导出脚本时，父进程把要导出的内容放在这里，fork 出来的子进程直接继承，不需要序列化 IR
+# 子进程只把生成的文本传回来
+_forked_script_render_state : tuple[typing.Callable, list] | None = None
+
+def _render_script_in_forked_process(index : int) -> str:
+  assert _forked_script_render_state is not None
+  render, scripts = _forked_script_render_state
+  return render(scripts[index])
+
+def _render_and_write_script(path : str, script : typing.Any, render : typing.Callable[[typing.Any], str]) -> None:
+  write_text_if_changed(path, render(script))
+
+def export_scripts(scripts : list[tuple[str, _ScriptTV]], render : typing.Callable[[_ScriptTV], str], num_workers : int = 0, use_processes : bool = False) -> None:
+  # 生成并写入所有脚本文件，scripts 中每一项为 (输出路径, 脚本)，render 把一个脚本转换为文本
+  # render 只能读取 IR，不能修改
+  # num_workers: 0 表示使用默认值，1 表示在当前线程中逐个导出
+  # use_processes: 使用多进程生成文本（只在支持 fork 且没有其他线程在运行时有效，否则仍使用多线程），适合脚本很多的情况；文件总是在当前进程中写入
+  global _forked_script_render_state
+  for path, _ in scripts:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+  if num_workers == 1 or len(scripts) <= 1:
+    for path, script in scripts:
+      _render_and_write_script(path, script, render)
+    return
+  max_workers = num_workers if num_workers > 0 else None
+  if use_processes and "fork" not in multiprocessing.get_all_start_methods():
+    use_processes = False
+  if use_processes:
+    # IR 无法序列化，所以只能用 fork；fork 时其他线程持有的锁在子进程中永远不会被释放
+    # 因此先停止素材的后台预读，如果还有其他线程在运行（比如在 GUI 中）就退回到多线程
+    AssetManager.stop_prefetch_if_running()
+    use_processes = threading.active_count() == 1
+  if use_processes:
+    _forked_script_render_state = (render, [script for _, script in scripts])
+    try:
+      with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("fork")) as executor:
+        # 子进程生成文本的同时在当前进程中写入已经完成的文件
+        for (path, _), text in zip(scripts, executor.map(_render_script_in_forked_process, range(len(scripts)), chunksize=4)):
+          write_text_if_changed(path, text)
+    finally:
+      _forked_script_render_state = None
+    return
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+    futures = [executor.submit(_render_and_write_script, path, script, render) for path, script in scripts]
+    for f in futures:
+      f.result()
 
 # export functions for engine common
-def export_assets_and_cacheable(m : BackendProjectModelBase, out_path : str):
+def export_assets_and_cacheable(m : BackendProjectModelBase, out_path : str, num_workers : int = 0, placement : str = "copy"):
+  # num_workers: 导出素材时使用的线程数，0 表示使用默认值（与 CPU 数量相关），1 表示不使用多线程
+  # placement: 素材的放置方式，见 ASSET_PLACEMENT_MODES
+  if placement not in ASSET_PLACEMENT_MODES:
+    raise PPInternalError("Unknown asset placement mode: " + placement)
+  previous_keys = _read_asset_export_cache(out_path)
+  assets : list[tuple[str, AssetData]] = []
   for file in m.assets():
     assetdata = file.get_asset_value()
     assert isinstance(assetdata, AssetData)
-    filepath = os.path.join(out_path, file.name)
-    parentdir = os.path.dirname(filepath)
-    os.makedirs(parentdir, exist_ok=True)
-    assetdata.export(filepath)
+    assets.append((file.name, assetdata))
+  keys : list[str | None] = []
+  if num_workers == 1 or len(assets) <= 1:
+    for relpath, assetdata in assets:
+      keys.append(_export_asset(assetdata, out_path, relpath, placement, previous_keys.get(relpath, None)))
+  else:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers if num_workers > 0 else None) as executor:
+      futures = [executor.submit(_export_asset, assetdata, out_path, relpath, placement, previous_keys.get(relpath, None)) for relpath, assetdata in assets]
+      keys = [f.result() for f in futures]
+  current_keys = {relpath : key for (relpath, _), key in zip(assets, keys) if key is not None}
+  if current_keys != previous_keys:
+    if len(current_keys) > 0 or os.path.exists(os.path.join(out_path, ASSET_EXPORT_CACHE_FILE_NAME)):
+      # 与其他输出文件一样先写临时文件再替换，中途中断时不会留下写了一半的缓存文件
+      write_text_if_changed(os.path.join(out_path, ASSET_EXPORT_CACHE_FILE_NAME), json.dumps({
+        "version": __version__,
+        "assets": current_keys,
+      }, ensure_ascii=False, indent=2, sort_keys=True))
   if len(m._cacheable_export_region) > 0:
     CacheableOperationSymbol.run_export_all(m._cacheable_export_region, out_path)
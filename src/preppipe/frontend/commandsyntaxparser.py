@@ -7,6 +7,8 @@ import typing
 import collections
 import dataclasses
 import re
+import argparse
+import threading
 
 import antlr4
 from antlr4.error.ErrorListener import ErrorListener
@@ -22,7 +24,8 @@ from ._antlr_generated.CommandParseVisitor   import CommandParseVisitor
 
 from ..irbase import *
 from ..inputmodel import *
-from ..pipeline import TransformBase, MiddleEndDecl
+from ..pipeline import TransformBase, MiddleEndDecl, TransformArgumentGroup
+from ..util.message import MessageHandler
 from ..exceptions import *
 from ..language import *
 
@@ -284,17 +287,45 @@ def _visit_block(hostblock : Block, prev_command : GeneralCommandOp, blocks_to_r
     deadop.erase_from_parent()
   return last_command
 
+_tr_cache_stats = TR_parser.tr("cache_stats",
+  en="Command parse cache: scanning {scan_hits} hits / {scan_misses} misses, parsing {parse_hits} hits / {parse_misses} misses (hit rate {rate})",
+  zh_cn="命令解析缓存：扫描命中 {scan_hits} 次 / 未命中 {scan_misses} 次，解析命中 {parse_hits} 次 / 未命中 {parse_misses} 次 （命中率 {rate}）",
+  zh_hk="命令解析緩存：掃描命中 {scan_hits} 次 / 未命中 {scan_misses} 次，解析命中 {parse_hits} 次 / 未命中 {parse_misses} 次 （命中率 {rate}）",
+)
+
+@TransformArgumentGroup('cmdsyntax', 'Options for command syntax analysis')
 @MiddleEndDecl('cmdsyntax', input_decl=IMDocumentOp, output_decl=IMDocumentOp)
 class CommandSyntaxAnalysisTransform(TransformBase):
+  verbose : typing.ClassVar[bool] = False
+
+  @staticmethod
+  def install_arguments(argument_group : argparse._ArgumentGroup):
+    argument_group.add_argument('--cmdsyntax-cache-size', nargs=1, type=int, help='Number of distinct command texts whose parse results are cached (0 to disable)')
+
+  @staticmethod
+  def handle_arguments(args : argparse.Namespace):
+    CommandSyntaxAnalysisTransform.verbose = args.verbose
+    if cache_size := args.cmdsyntax_cache_size:
+      assert isinstance(cache_size, list) and len(cache_size) == 1
+      set_command_parse_cache_capacity(cache_size[0])
+
   def run(self) -> IMDocumentOp | typing.List[IMDocumentOp] | None:
     if len(self.inputs) == 1:
       op = self.inputs[0]
       perform_command_parse_transform(op)
-      return op
-    result = []
-    for op in self.inputs:
-      perform_command_parse_transform(op)
-      result.append(op)
+      result = op
+    else:
+      result = []
+      for op in self.inputs:
+        perform_command_parse_transform(op)
+        result.append(op)
+    if CommandSyntaxAnalysisTransform.verbose:
+      total_hits = _command_scan_memo.num_hits + _command_parse_memo.num_hits
+      total_lookups = total_hits + _command_scan_memo.num_misses + _command_parse_memo.num_misses
+      rate = "{:.1%}".format(total_hits / total_lookups) if total_lookups > 0 else "-"
+      MessageHandler.info(_tr_cache_stats.format(scan_hits=str(_command_scan_memo.num_hits), scan_misses=str(_command_scan_memo.num_misses),
+                                                 parse_hits=str(_command_parse_memo.num_hits), parse_misses=str(_command_parse_memo.num_misses),
+                                                 rate=rate))
     return result
 
 _tr_noncontent_entry_in_command = TR_parser.tr("noncontent_entry_in_command",
@@ -382,7 +413,9 @@ def _strip_whitespaces(text: str) -> typing.Tuple[str, int, int]: # trimmed stri
   trailing_ws = len(cur_text) - len(result)
   return (result, leading_ws, trailing_ws)
 
+@dataclasses.dataclass(frozen=True, slots=True)
 class _InitParsedCommandInfo:
+  # 会被缓存并在多处共用，所以不可修改
   total_range : typing.Tuple[int, int] # position (from the text) of the '[' and ']' (or counterparts) token
   body : str # content of the body (leading and terminating whitespace trimmed)
   body_range : typing.Tuple[int, int] # start and end position of the body text
@@ -395,20 +428,19 @@ class _CommandScanListener(CommandScanListener):
     self.commandinfo = []
 
   def enterCommand(self, ctx : CommandScanParser.CommandContext):
-    result = _InitParsedCommandInfo()
-
     commandstart = ctx.COMMANDSTART().getSymbol()
     commandend = ctx.COMMANDEND().getSymbol()
     # termal token's getSourceInterval() return Tuple[int, int] (start, end)
     # commandstart_start = commandstart.getSourceInterval()[0]
     # commandstart_end = commandstart.getSourceInterval()[1]
-    result.total_range = (commandstart.start, commandend.stop) # inclusive; usually commandstart/end.start == ....stop
+    total_range = (commandstart.start, commandend.stop) # inclusive; usually commandstart/end.start == ....stop
 
     body = ctx.body()
     raw_text = body.getText()
-    result.body, content_start_trim, content_end_trim = _strip_whitespaces(raw_text)
-    result.body_range = (body.start.start + content_start_trim, body.stop.stop - content_end_trim)
+    body_text, content_start_trim, content_end_trim = _strip_whitespaces(raw_text)
+    body_range = (body.start.start + content_start_trim, body.stop.stop - content_end_trim)
 
+    result = _InitParsedCommandInfo(total_range=total_range, body=body_text, body_range=body_range)
     self.commandinfo.append(result)
 
     # if result.is_comment:
@@ -416,7 +448,7 @@ class _CommandScanListener(CommandScanListener):
     # else:
     #   print("Command: \"" + result.body + "\" " + str(result.body_range) + " <- " + str(result.total_range))
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True, slots=True)
 class _CommandParseErrorRecord:
   column : int
   msg : str
@@ -452,7 +484,58 @@ class _CommandCreationErrorListenerBase(ErrorListener):
 class _CommandScanErrorListener(_CommandCreationErrorListenerBase):
   pass
 
-def _split_text_as_commands(text : str) -> typing.List[_InitParsedCommandInfo] | _CommandParseErrorRecord:
+class _CommandParseMemo:
+  # 有界的 LRU 缓存，用来记录命令文本的扫描、解析结果
+  # 剧本中同样的命令（比如【切换场景：教室】）会反复出现，这样我们只需对每种命令文本运行一次 antlr4
+  # 资源（图片、声音等）在命令文本中都以 '\0' 替代，所以资源的位置也包含在键中；实际的资源在每次生成命令时再对应
+  # 缓存的结果会返回给所有调用者，所以结果都是不可修改的（元组以及 frozen 的 dataclass）
+  # GUI 会在工作线程中运行整个流程，所以所有访问都需要加锁；解析本身在锁外进行，同一文本可能被同时解析多次，结果相同
+  capacity : int
+  num_hits : int
+  num_misses : int
+  _entries : collections.OrderedDict[str, typing.Any]
+  _lock : threading.Lock
+
+  def __init__(self, capacity : int) -> None:
+    self.capacity = capacity
+    self.num_hits = 0
+    self.num_misses = 0
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get_or_create(self, key : str, create_cb : typing.Callable[[str], typing.Any]) -> typing.Any:
+    with self._lock:
+      if key in self._entries:
+        self.num_hits += 1
+        self._entries.move_to_end(key)
+        return self._entries[key]
+      self.num_misses += 1
+    result = create_cb(key)
+    with self._lock:
+      if self.capacity > 0:
+        self._entries[key] = result
+        while len(self._entries) > self.capacity:
+          self._entries.popitem(last=False)
+    return result
+
+  def set_capacity(self, capacity : int):
+    with self._lock:
+      self.capacity = capacity
+      while len(self._entries) > max(capacity, 0):
+        self._entries.popitem(last=False)
+
+_COMMAND_PARSE_CACHE_DEFAULT_CAPACITY : typing.Final[int] = 4096
+_command_scan_memo = _CommandParseMemo(_COMMAND_PARSE_CACHE_DEFAULT_CAPACITY) # 整段命令文本 -> _split_text_as_commands_impl() 的结果
+_command_parse_memo = _CommandParseMemo(_COMMAND_PARSE_CACHE_DEFAULT_CAPACITY) # 单个命令体 -> _parse_command_skeleton() 的结果
+
+def set_command_parse_cache_capacity(capacity : int):
+  _command_scan_memo.set_capacity(capacity)
+  _command_parse_memo.set_capacity(capacity)
+
+def _split_text_as_commands(text : str) -> tuple[_InitParsedCommandInfo, ...] | _CommandParseErrorRecord:
+  return _command_scan_memo.get_or_create(text, _split_text_as_commands_impl)
+
+def _split_text_as_commands_impl(text : str) -> tuple[_InitParsedCommandInfo, ...] | _CommandParseErrorRecord:
   istream = antlr4.InputStream(text)
   error_listener = _CommandScanErrorListener()
   lexer = CommandScanLexer(istream)
@@ -474,7 +557,7 @@ def _split_text_as_commands(text : str) -> typing.List[_InitParsedCommandInfo] |
   listener = _CommandScanListener()
   walker = antlr4.ParseTreeWalker()
   walker.walk(listener, tree)
-  return listener.commandinfo
+  return tuple(listener.commandinfo)
 
 # ------------------------------------------------------------------------------
 # 命令解析
@@ -538,6 +621,45 @@ class _CommandParseVisitorImpl(CommandParseVisitor):
     data = self.asset_map[global_start]
     return (data, global_start, self.global_offset + end)
 
+  def instantiate_command(self, skeleton : _CommandSkeletonCall) -> GeneralCommandOp:
+    # 根据（可能是缓存的）命令骨架生成命令，结果与直接用 visitCommand() 访问解析树相同
+    name_value = StringLiteral.get(skeleton.name, self.context)
+    name_loc = self._get_loc(self.global_offset + skeleton.name_offset)
+    self.commandop = GeneralCommandOp.create('', self.startloc, name_value, name_loc)
+    if skeleton.rawarg_range is not None:
+      self._instantiate_arguments(self.commandop, skeleton)
+    return self.commandop
+
+  def _instantiate_arguments(self, current_command : GeneralCommandOp, skeleton : _CommandSkeletonCall) -> None:
+    # 对应 visitArguments()
+    rawarg_start = self.global_offset + skeleton.rawarg_range[0]
+    rawarg_end = self.global_offset + skeleton.rawarg_range[1]
+    rawarg_text = ''
+    if rawarg_end > rawarg_start:
+      rawarg_text = self.fulltext[rawarg_start:rawarg_end]
+    current_command.set_raw_arg(StringLiteral.get(rawarg_text, self.context), self._get_loc(rawarg_start))
+    for v in skeleton.positionals:
+      value, loc = self._instantiate_value(current_command, v)
+      current_command.add_positional_arg(value, loc)
+    for name, name_offset, v in skeleton.kwargs:
+      name_loc = self._get_loc(self.global_offset + name_offset)
+      value, value_loc = self._instantiate_value(current_command, v)
+      current_command.add_keyword_arg(name, value, name_loc, value_loc)
+
+  def _instantiate_value(self, current_command : GeneralCommandOp, v : _CommandSkeletonValue) -> tuple[Value, Location]:
+    start = self.global_offset + v.offset
+    if v.call is not None:
+      name_loc = self._get_loc(start)
+      newop = GeneralCommandOp.create('', name_loc, StringLiteral.get(v.call.name, self.context), name_loc)
+      current_command.add_nested_call(newop)
+      self._instantiate_arguments(newop, v.call)
+      return (newop.valueref, newop.location)
+    if v.text is not None:
+      return (StringLiteral.get(v.text, self.context), self._get_loc(start))
+    data = self.asset_map[start]
+    assert isinstance(data, AssetData)
+    return (data, self._get_loc(start))
+
   def visitName(self, ctx: CommandParseParser.NameContext) -> tuple[StringLiteral, Location]:
     content_tuple = None
 
@@ -643,6 +765,129 @@ class _CommandParseVisitorImpl(CommandParseVisitor):
     loc = self._get_loc(startpos)
     return (value, loc)
 
+# ------------------------------------------------------------------------------
+# 命令骨架
+# 解析一个命令体只依赖于命令体的文本，所以我们把解析结果记录为与位置、资源无关的“骨架”并缓存起来
+# 生成命令时再根据骨架创建 GeneralCommandOp（位置信息、资源都在此时填入）
+# 骨架中所有的位置都是相对于命令体开头的
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class _CommandSkeletonValue:
+  offset : int
+  text : str | None = None # 字符串值
+  call : _CommandSkeletonCall | None = None # 调用表达式
+  # 都为 None 的话该值是一个资源（即命令文本中的 '\0'）
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class _CommandSkeletonCall:
+  name : str
+  name_offset : int
+  rawarg_range : tuple[int, int] | None # 参数列表的范围，没有参数列表的话是 None
+  positionals : tuple[_CommandSkeletonValue, ...]
+  kwargs : tuple[tuple[str, int, _CommandSkeletonValue], ...] # (参数名，参数名位置，值)
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class _CommandSkeletonError:
+  # 命令体有语法错误
+  error_column : int
+  error_msg : str
+  name : str | None # 如果还能读到命令名的话
+  name_column : int
+  rawarg : str | None # 如果还能读到原始参数的话
+  rawarg_column : int
+
+class _CommandSkeletonBuilder(CommandParseVisitor):
+  # 从 antlr4 的解析树中生成命令骨架
+
+  def visitName(self, ctx: CommandParseParser.NameContext) -> tuple[str, int]:
+    if ctx.NATURALTEXT() is not None:
+      token = ctx.NATURALTEXT().getSymbol()
+      return (token.text, token.start)
+    if ctx.QUOTEDSTR() is not None:
+      token = ctx.QUOTEDSTR().getSymbol()
+      return (token.text[1:-1], token.start + 1)
+    raise PPInternalError('Name without valid child?')
+
+  def visitCommand(self, ctx: CommandParseParser.CommandContext) -> _CommandSkeletonCall:
+    assert ctx.name() is not None and isinstance(ctx.name(), CommandParseParser.NameContext)
+    name, name_offset = self.visitName(ctx.name())
+    if ctx.argumentlist() is not None:
+      assert ctx.argumentlist().arguments() is not None and isinstance(ctx.argumentlist().arguments(), CommandParseParser.ArgumentsContext)
+      return self._build_call(name, name_offset, ctx.argumentlist().arguments())
+    return _CommandSkeletonCall(name=name, name_offset=name_offset, rawarg_range=None, positionals=(), kwargs=())
+
+  def _build_call(self, name : str, name_offset : int, ctx: CommandParseParser.ArgumentsContext) -> _CommandSkeletonCall:
+    rawarg_range = (ctx.start.start, ctx.stop.stop + 1)
+    positionals = []
+    if ctx.positionals() is not None:
+      for v in ctx.positionals().value():
+        assert isinstance(v, CommandParseParser.ValueContext)
+        positionals.append(self.visitValue(v))
+    kwargs = []
+    if ctx.kwargs() is not None:
+      for kv in ctx.kwargs().kwvalue():
+        assert isinstance(kv, CommandParseParser.KwvalueContext)
+        kwname, kwname_offset = self.visitName(kv.name())
+        kwargs.append((kwname, kwname_offset, self.visitValue(kv.value())))
+    return _CommandSkeletonCall(name=name, name_offset=name_offset, rawarg_range=rawarg_range, positionals=tuple(positionals), kwargs=tuple(kwargs))
+
+  def visitValue(self, ctx: CommandParseParser.ValueContext) -> _CommandSkeletonValue:
+    if ctx.callexpr() is not None:
+      callexpr = ctx.callexpr()
+      name, name_offset = self.visitName(callexpr.name())
+      return _CommandSkeletonValue(offset=name_offset, call=self._build_call(name, name_offset, callexpr.arguments()))
+    evalue = ctx.evalue()
+    if evalue is None:
+      raise PPInternalError('Invalid value')
+    if evalue.NATURALTEXT() is not None:
+      token = evalue.NATURALTEXT().getSymbol()
+      return _CommandSkeletonValue(offset=token.start, text=token.text)
+    if evalue.QUOTEDSTR() is not None:
+      token = evalue.QUOTEDSTR().getSymbol()
+      return _CommandSkeletonValue(offset=token.start + 1, text=token.text[1:-1])
+    if evalue.ELEMENT() is not None:
+      token = evalue.ELEMENT().getSymbol()
+      assert len(token.text) == 1 and token.text == '\0'
+      return _CommandSkeletonValue(offset=token.start)
+    raise PPInternalError('evalue without valid child?')
+
+def _parse_command_skeleton(body : str) -> _CommandSkeletonCall | _CommandSkeletonError:
+  istream = antlr4.InputStream(body)
+  error_listener = _CommandParseErrorListener()
+  lexer = CommandParseLexer(istream)
+  lexer.removeErrorListeners(); # remove ConsoleErrorListener
+  lexer.addErrorListener(error_listener)
+  tstream = antlr4.CommonTokenStream(lexer)
+  parser = CommandParseParser(tstream)
+  parser.removeErrorListeners(); # remove ConsoleErrorListener
+  parser.addErrorListener(error_listener)
+  tree = parser.command()
+  if error_listener.error_occurred:
+    record = error_listener.get_error_record()
+    # 如果此时 tree 还有子节点，我们还能尝试解析该命令，至少把原始参数给记下来
+    # 实际上，如果是注释的话，这里很可能会报错，但实际上这种错误完全没有问题。
+    # 应该是有 name, <可选> COMMANDSEP, <可选> argumentlist 三个参数
+    cmd_name = None
+    cmd_name_column = 0
+    rawarg_str = None
+    rawarg_column = 0
+    if tree.getChildCount() > 0:
+      name_node = tree.getChild(0)
+      cmd_name = name_node.getText()
+      cmd_name_column = _find_node_startcolumn(name_node)
+      if tree.getChildCount() > 1:
+        rawarg_node = tree.getChild(tree.getChildCount()-1)
+        rawarg_str = rawarg_node.getText()
+        # 去掉末尾的 <EOF> 标记
+        if rawarg_str.endswith("<EOF>"):
+          rawarg_str = rawarg_str[:-5]
+        rawarg_column = _find_node_startcolumn(rawarg_node)
+    return _CommandSkeletonError(error_column=record.column, error_msg=record.msg, name=cmd_name, name_column=cmd_name_column, rawarg=rawarg_str, rawarg_column=rawarg_column)
+  return _CommandSkeletonBuilder().visitCommand(tree)
+
+def _get_command_skeleton(body : str) -> _CommandSkeletonCall | _CommandSkeletonError:
+  return _command_parse_memo.get_or_create(body, _parse_command_skeleton)
+
 # ------------------------------------------------------------------------------
 # 组装起来
 
@@ -658,7 +903,7 @@ _tr_syntax_error = TR_parser.tr("syntax_error",
   zh_hk="命令 \"{cmd}\" 語法錯誤：{err}",
 )
 
-def _visit_command_block_impl(b : Block, ctx : Context, command_str : str, asset_list : typing.List[AssetData], insert_before_op : IMElementOp, infolist : list[_InitParsedCommandInfo]) -> GeneralCommandOp | None:
+def _visit_command_block_impl(b : Block, ctx : Context, command_str : str, asset_list : typing.List[AssetData], insert_before_op : IMElementOp, infolist : tuple[_InitParsedCommandInfo, ...]) -> GeneralCommandOp | None:
   # 如果生成了命令的话，返回最后一个生成的命令
   # 帮助生成位置信息
   headloc = insert_before_op.location
@@ -686,7 +931,7 @@ def _visit_command_block_impl(b : Block, ctx : Context, command_str : str, asset
 
   # 开始处理
   last_command = None
-  assert isinstance(infolist, list)
+  assert isinstance(infolist, tuple)
   for info in infolist:
     # total_range = info.total_range
     body = info.body
@@ -703,37 +948,18 @@ def _visit_command_block_impl(b : Block, ctx : Context, command_str : str, asset
     #   comment.insert_before(insert_before_op)
     #   continue
     # 既然不是注释，那就是真正的命令了
-    istream = antlr4.InputStream(body)
-    error_listener = _CommandParseErrorListener()
-    lexer = CommandParseLexer(istream)
-    lexer.removeErrorListeners(); # remove ConsoleErrorListener
-    lexer.addErrorListener(error_listener)
-    tstream = antlr4.CommonTokenStream(lexer)
-    parser = CommandParseParser(tstream)
-    parser.removeErrorListeners(); # remove ConsoleErrorListener
-    parser.addErrorListener(error_listener)
-    tree = parser.command()
-    if error_listener.error_occurred:
-      record = error_listener.get_error_record()
-      errorloc = get_loc_at_offset(record.column)
-      errormsg = _tr_syntax_error.format(cmd=command_str, err=record.msg)
-      # 如果此时 tree 还有子节点，我们还能尝试解析该命令，至少把原始参数给记下来
-      # 实际上，如果是注释的话，这里很可能会报错，但实际上这种错误完全没有问题。
-      # 应该是有 name, <可选> COMMANDSEP, <可选> argumentlist 三个参数
+    # 同样的命令体只解析一次，之后都使用缓存的骨架
+    skeleton = _get_command_skeleton(body)
+    if isinstance(skeleton, _CommandSkeletonError):
+      errorloc = get_loc_at_offset(skeleton.error_column)
+      errormsg = _tr_syntax_error.format(cmd=command_str, err=skeleton.error_msg)
       result_command_op = None
-      if tree.getChildCount() > 0:
-        name_node = tree.getChild(0)
-        cmd_name = name_node.getText()
-        cmd_name_loc = get_loc_at_offset(_find_node_startcolumn(name_node))
-        result_command_op = GeneralCommandOp.create('', loc=loc, name_value=StringLiteral.get(cmd_name, ctx), name_loc=cmd_name_loc)
-        if tree.getChildCount() > 1:
-          rawarg_node = tree.getChild(tree.getChildCount()-1)
-          rawarg_str = rawarg_node.getText()
-          # 去掉末尾的 <EOF> 标记
-          if rawarg_str.endswith("<EOF>"):
-            rawarg_str = rawarg_str[:-5]
-          rawarg_loc = get_loc_at_offset(_find_node_startcolumn(rawarg_node))
-          result_command_op.set_raw_arg(StringLiteral.get(rawarg_str, ctx), rawarg_loc)
+      if skeleton.name is not None:
+        cmd_name_loc = get_loc_at_offset(skeleton.name_column)
+        result_command_op = GeneralCommandOp.create('', loc=loc, name_value=StringLiteral.get(skeleton.name, ctx), name_loc=cmd_name_loc)
+        if skeleton.rawarg is not None:
+          rawarg_loc = get_loc_at_offset(skeleton.rawarg_column)
+          result_command_op.set_raw_arg(StringLiteral.get(skeleton.rawarg, ctx), rawarg_loc)
           result_command_op.set_parse_error(StringLiteral.get(errormsg, ctx), errorloc)
         result_command_op.insert_before(insert_before_op)
         last_command = result_command_op
@@ -743,8 +969,7 @@ def _visit_command_block_impl(b : Block, ctx : Context, command_str : str, asset
         errop.insert_before(insert_before_op)
       continue
     cmd_visitor = _CommandParseVisitorImpl(command_str, body_range_start, asset_map_dict, loc)
-    cmd_visitor.visit(tree)
-    result_command_op = cmd_visitor.commandop
+    result_command_op = cmd_visitor.instantiate_command(skeleton)
     result_command_op.insert_before(insert_before_op)
     last_command = result_command_op
     continue
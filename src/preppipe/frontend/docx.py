@@ -555,7 +555,7 @@ class _DOCXParseContext:
           if rid in r._r.xml:
             href = self.get_path_from_rid(rid)
             if href in self.ziphandle.namelist():
-              data = self.ziphandle.read(href)
+              # 这里不读取内容，资源在真正使用时才从 docx 中解压
               mime, encoding = mimetypes.guess_type(href)
               loc = self.context.get_DILocation(self.difile, page, row, col)
               if mime is None:
@@ -566,9 +566,9 @@ class _DOCXParseContext:
                 return IMErrorElementOp.create(name = '', loc = loc, content = textstr, error_code='docx-bad-media-ref', error_msg = msgstr)
               fullpath = self.get_full_path_from_epath(href)
               if fmt := ImageAssetData.get_format_from_mime_type(mime):
-                value = self.context.create_image_asset_data_embedded(fullpath, data, fmt)
+                value = self.context.create_image_asset_data_zipped(fullpath, self.filepath, href, fmt)
               elif fmt := AudioAssetData.get_format_from_mime_type(mime):
-                value = self.context.create_audio_asset_data_embedded(fullpath, data, fmt)
+                value = self.context.create_audio_asset_data_zipped(fullpath, self.filepath, href, fmt)
               else:
                 textstr = StringLiteral.get(href, self.context)
                 msgstr = StringLiteral.get(mime, self.context)
@@ -107,6 +107,256 @@ class _ListStyleInfo:
   def set_start_value(self, v : int):
     self.start_value = v
 
+class _ODSpecialBlockMerger:
+  # transform_pass_merge_special_blocks() 的逐块版本，只给 _ODPostParseTransformer 使用，逻辑应与之保持一致
+  # 按顺序把同一区内的块传给 add_block()，最后调用 finish()
+  # 被合并的块会在提交时直接删除，所以传入的块只能是已经访问过的（不会删除之后的块）
+  ctx : Context
+  special_block_textlist : list[StringLiteral]
+  leader_block : Block | None
+  leader_op : IMSpecialBlockOp | None
+  member_blocks : list[Block]
+
+  def __init__(self, ctx : Context) -> None:
+    self.ctx = ctx
+    self.special_block_textlist = []
+    self.leader_block = None
+    self.leader_op = None
+    self.member_blocks = []
+
+  def commit_blocks(self):
+    if len(self.member_blocks) > 0:
+      if len(self.special_block_textlist) > 0:
+        self.leader_op.content.drop_all_uses()
+        for v in self.special_block_textlist:
+          self.leader_op.content.add_operand(v)
+      for b in self.member_blocks:
+        ops_to_move = []
+        for op in b.body:
+          if isinstance(op, MetadataOp):
+            ops_to_move.append(op)
+            continue
+          if isinstance(op, IMSpecialBlockOp):
+            continue
+          raise RuntimeError("Unexpected op kind: " + type(op).__name__)
+        for op in ops_to_move:
+          op.remove_from_parent()
+          self.leader_block.push_back(op)
+        b.erase_from_parent()
+    else:
+      # 这种情况下我们应该不需要 StringListLiteral
+      assert len(self.special_block_textlist) < 2
+    self.special_block_textlist = []
+    self.leader_block = None
+    self.leader_op = None
+    self.member_blocks = []
+
+  def add_block(self, b : Block):
+    # 一般而言这个块内应该只有一个 IMSpecialBlockOp, 其他只可能有 MetadataOp
+    # 不过如果段内有不止一个文本样式的话可能会被拆分成多个 IMSpecialBlockOp
+    # 这里我们先进行段内合并，再做段间合并
+    is_other_elements_found = False
+    cur_leader_op : IMSpecialBlockOp | None = None
+    subsequent_specialblocks = []
+    cur_specialblock_text = []
+    for op in b.body:
+      if isinstance(op, MetadataOp):
+        continue
+      if isinstance(op, IMSpecialBlockOp):
+        for u in op.content.operanduses():
+          cur_specialblock_text.append(u.value)
+        if cur_leader_op is None:
+          cur_leader_op = op
+        else:
+          subsequent_specialblocks.append(op)
+        continue
+      is_other_elements_found = True
+      break
+    # 如有需要，尝试段内合并
+    if len(subsequent_specialblocks) > 0:
+      cur_leader_op.content.drop_all_uses()
+      cumulative_str = ''.join([v.get_string() for v in cur_specialblock_text])
+      cumulative_str_l = StringLiteral.get(cumulative_str, self.ctx)
+      cur_specialblock_text = [cumulative_str_l]
+      cur_leader_op.content.add_operand(cumulative_str_l)
+      for op in subsequent_specialblocks:
+        op.erase_from_parent()
+      subsequent_specialblocks.clear()
+    # 开始判断
+    if self.leader_block is None:
+      # 现在还没有块可以合并
+      if cur_leader_op is not None and not is_other_elements_found:
+        # 遇到一个新块
+        self.leader_block = b
+        self.leader_op = cur_leader_op
+        self.special_block_textlist = cur_specialblock_text
+      else:
+        # 这个块不能合并
+        pass
+    else:
+      # 当前已经有块
+      if cur_leader_op is not None and not is_other_elements_found:
+        # 可以合并
+        self.special_block_textlist.extend(cur_specialblock_text)
+        self.member_blocks.append(b)
+      else:
+        # 结束一个块
+        self.commit_blocks()
+
+  def finish(self):
+    if len(self.member_blocks) > 0:
+      self.commit_blocks()
+
+class _ODListReassociator:
+  # transform_pass_reassociate_lists() 中 walk_frame() 的逐块版本，只给 _ODPostParseTransformer 使用，逻辑应与之保持一致；详细说明见该函数的注释
+  # cur_listop_stack 维护一个当前 IMListOp 嵌套层级的栈
+  # 当我们不能再继续合并列表内容时，该栈清空
+  # 当我们需要合并一个新的列表时，我们根据该列表的嵌套层级来进行合并
+  # 栈底的列表（如果有）是唯一一个之后还可能被修改的顶层列表
+  cur_listop_stack : list[IMListOp]
+
+  def __init__(self) -> None:
+    self.cur_listop_stack = []
+
+  def get_active_root_list(self) -> IMListOp | None:
+    if len(self.cur_listop_stack) > 0:
+      return self.cur_listop_stack[0]
+    return None
+
+  def add_block(self, cur_block : Block) -> bool:
+    # 处理下一个块，如果该块被合并进之前的列表（并被删除）则返回 False，否则返回 True
+    if cur_block.body.empty:
+      # 遇到一个空段落
+      # 如果此时我们正在尝试合并，则立即停止
+      self.cur_listop_stack.clear()
+      return True
+    # 该段落有内容
+    # 如果我们有 IMListOp，则该操作项一般独占一段（除非有错误）
+    # 如果这段是一个列表操作项，则我们首先尝试将其合并入当前的列表栈
+    # 如果可以的话就合并，不行的话就在合适的地方“断开”
+    # 如果这段不是一个列表操作项，则清空当前栈
+    if not (cur_block.body.size == 1 and isinstance(cur_block.body.front, IMListOp)):
+      self.cur_listop_stack.clear()
+      return True
+    # 这段是一个列表操作项
+    if len(self.cur_listop_stack) == 0:
+      self.cur_listop_stack.append(cur_block.body.front)
+      return True
+    cur_list : IMListOp = cur_block.body.front
+    num_nest = 0
+    # 展开所有嵌套
+    # 如果该列表只有一个区，并且其内容也是一个列表，则我们视其为一重嵌套
+    while cur_list.get_num_regions() == 1:
+      first_region = cur_list.get_first_region()
+      if first_region.blocks.size == 1:
+        first_block = first_region.blocks.front
+        if first_block.body.size == 1 and isinstance(first_block.body.front, IMListOp):
+          cur_list = first_block.body.front
+          num_nest += 1
+          continue
+      break
+    if num_nest > len(self.cur_listop_stack):
+      # 正常情况下不应该出现这样的情况（也许用户是故意的？）
+      # 放弃挣扎，跳过这个列表
+      # something weird is happening (maybe the user is intentionally doing the wrong thing?)
+      # just stop and skip this list
+      self.cur_listop_stack.clear()
+      return True
+    if num_nest == len(self.cur_listop_stack):
+      # 开启一个新的层叠层级
+      # 将当前列表添加到栈顶列表最后一项的区中
+      # we are opening a new nest level
+      # move the current list to the stack top
+      cur_parent_block = cur_list.parent_block
+      assert cur_parent_block is not cur_block
+      cur_parent_block.remove_from_parent()
+      last_list = self.cur_listop_stack[-1]
+      last_listitem = last_list.get_last_region()
+      last_listitem.push_back(cur_parent_block)
+      self.cur_listop_stack.append(cur_list)
+      # 把 cur_block 删了然后继续
+      cur_block.erase_from_parent()
+      return False
+    # 当前列表的层级与已有的列表相同，需要进行合并
+    # 首先检查两列表是否兼容：
+    # 如果列表使用点(Bullet point)，则必定兼容
+    # 如果列表使用数字，则所有区的名字不应重复
+    # 若列表不兼容，则重新开始
+    # 不管怎样，我们不会再需要层级更高的项
+    if len(self.cur_listop_stack) > num_nest+1:
+      del self.cur_listop_stack[num_nest+1:]
+    existing_list = self.cur_listop_stack[num_nest]
+    if existing_list.is_numbered == cur_list.is_numbered:
+      is_compatible = True
+      if existing_list.is_numbered:
+        for r in cur_list.regions:
+          if existing_list.get_region(r.name) is not None:
+            is_compatible = False
+            break
+      # 如果使用的是点，那么一定兼容，不需要额外检查
+      if is_compatible:
+        # 进行合并，这里我们只需将所有区搬迁到目标列表即可
+        region_to_move = cur_list.get_first_region()
+        while region_to_move is not None:
+          existing_list.take_list_item(region_to_move)
+          region_to_move = cur_list.get_first_region()
+        # 删除当前列表
+        cur_list.erase_from_parent()
+        # 把 cur_block 删了然后继续
+        cur_block.erase_from_parent()
+        return False
+    # 这是列表不兼容的情况
+    self.cur_listop_stack.clear()
+    if num_nest == 0:
+      self.cur_listop_stack.append(cur_list)
+    return True
+
+class _ODPostParseTransformer:
+  # 把 _ODParseContext 的四个解析后变换合并为一遍：
+  # transform_pass_fix_text_elements, transform_pass_merge_special_blocks,
+  # transform_pass_reassociate_lists, transform_pass_recover_flattened_list
+  # 每当一个顶层块生成完毕（加入文档 body 区）后就调用 add_block()，全部生成完毕后调用 finish()
+  # 结果应与依次执行这四个变换完全相同
+  parsectx : '_ODParseContext'
+  region : Region
+  merger : _ODSpecialBlockMerger
+  reassociator : _ODListReassociator
+  pending_lists : list[IMListOp] # 还没有进行 _try_recover_flattened_list() 的顶层列表
+
+  def __init__(self, parsectx : '_ODParseContext', region : Region) -> None:
+    self.parsectx = parsectx
+    self.region = region
+    self.merger = _ODSpecialBlockMerger(parsectx.ctx)
+    self.reassociator = _ODListReassociator()
+    self.pending_lists = []
+
+  def add_block(self, b : Block):
+    assert b.parent is self.region
+    if self.parsectx._fix_text_elements_in_block(b):
+      b.erase_from_parent()
+      return
+    self.merger.add_block(b)
+    if not self.reassociator.add_block(b):
+      return
+    for op in b.body:
+      if isinstance(op, IMListOp):
+        self.pending_lists.append(op)
+    # 只有列表栈底的列表还可能被修改，其他的顶层列表都可以直接还原层级了
+    active_root = self.reassociator.get_active_root_list()
+    remaining_lists = []
+    for listop in self.pending_lists:
+      if listop is active_root:
+        remaining_lists.append(listop)
+      else:
+        self.parsectx._try_recover_flattened_list(listop)
+    self.pending_lists = remaining_lists
+
+  def finish(self):
+    self.merger.finish()
+    for listop in self.pending_lists:
+      self.parsectx._try_recover_flattened_list(listop)
+    self.pending_lists = []
+
 class _ODParseContext:
   # how many characters in a paragraph makes the paragraph considered long enough (for debugging purpose)
   _NUM_CHARS_LONG_PARAGRAPH : typing.ClassVar[int] = 10
@@ -128,6 +378,9 @@ class _ODParseContext:
   cur_page_count : int
   cur_row_count : int
   cur_column_count : int
+  fused_transform : bool # 是否在生成文档的同时（用 _ODPostParseTransformer）一遍完成所有的解析后变换
+  # 在目前的测试文档上没有明显的速度提升，所以默认不使用，默认仍依次执行各个变换；test-odf-fused-transform (testbench.py) 检查两种方式的结果是否相同
+  post_parse_transformer : _ODPostParseTransformer | None
 
   # ------------------------------------------------------------------
   # ODF states
@@ -141,7 +394,7 @@ class _ODParseContext:
 
   # ------------------------------------------------------------------
 
-  def __init__(self, ctx : Context, filePath : str) -> None:
+  def __init__(self, ctx : Context, filePath : str, fused_transform : bool = False) -> None:
     filePath = os.path.realpath(filePath, strict=True)
     self.ctx = ctx
     self.filePath = filePath
@@ -157,6 +410,8 @@ class _ODParseContext:
     self.cur_page_count = 1
     self.cur_row_count = 1
     self.cur_column_count = 1
+    self.fused_transform = fused_transform
+    self.post_parse_transformer = None
 
     #self.num_total_paragraph = 0
     #self.last_paragraph_text = ""
@@ -351,7 +606,11 @@ class _ODParseContext:
         #entry = self.parent.get_image_asset_entry_from_path(imagePath, mediatype)
       elif FilenameOrImage == odf.opendocument.IS_IMAGE:
         # the image is embedded in the file
-        value = self.ctx.create_image_asset_data_embedded(href_full_path, data, fmt)
+        # 如果图片在压缩包中，我们只记录位置，不在这里写临时文件
+        if href in self.ziphandle.NameToInfo:
+          value = self.ctx.create_image_asset_data_zipped(href_full_path, self.filePath, href, fmt)
+        else:
+          value = self.ctx.create_image_asset_data_embedded(href_full_path, data, fmt)
         # entry = self.parent.get_image_asset_entry_from_inlinedata(data, mediatype, self.filePath, href)
     else:
       # the image is a link to outside file
@@ -382,7 +641,7 @@ class _ODParseContext:
     href_full_path = self.get_full_path_from_href(href)
     if href in self.ziphandle.namelist():
       assert href.startswith('Media/')
-      data = self.ziphandle.read(href)
+      # 这里不读取内容，资源在真正使用时才从压缩包中解压
 
       mime, encoding = mimetypes.guess_type(href)
       if mime is None:
@@ -393,9 +652,9 @@ class _ODParseContext:
         self.asset_reference_dict[href] = (textstr, msgstr)
         return IMErrorElementOp.create(name = '', loc = loc, content = textstr, error_code='odf-bad-media-ref', error_msg = msgstr)
       if fmt := ImageAssetData.get_format_from_mime_type(mime):
-        value = self.ctx.create_image_asset_data_embedded(href_full_path, data, fmt)
+        value = self.ctx.create_image_asset_data_zipped(href_full_path, self.filePath, href, fmt)
       elif fmt := AudioAssetData.get_format_from_mime_type(mime):
-        value = self.ctx.create_audio_asset_data_embedded(href_full_path, data, fmt)
+        value = self.ctx.create_audio_asset_data_zipped(href_full_path, self.filePath, href, fmt)
       else:
         textstr = StringLiteral.get(href, self.ctx)
         msgstr = StringLiteral.get(mime, self.ctx)
@@ -531,6 +790,11 @@ class _ODParseContext:
     self.cur_column_count = 1
     return paragraph
 
+  def odf_push_block(self, result : Region, block : Block):
+    result.push_back(block)
+    if self.post_parse_transformer is not None and result is self.post_parse_transformer.region:
+      self.post_parse_transformer.add_block(block)
+
   def odf_encountering_pagebreak(self):
     self.cur_page_count += 1
     self.cur_row_count = 1
@@ -630,7 +894,7 @@ class _ODParseContext:
         case "p":
           # paragraph
           paragraph = self.odf_parse_paragraph(node, isInFrame, default_style)
-          result.push_back(paragraph)
+          self.odf_push_block(result, paragraph)
         case 'list':
           # list is in parallel with paragraph in odf
           listname = self._get_element_attribute(node, 'id')
@@ -672,14 +936,14 @@ class _ODParseContext:
                 # treat it as a new paragraph
                 # (this part is not tested; I don't even know how to create a list-header..)
                 paragraph = self.odf_parse_paragraph(node, isInFrame, default_style)
-                result.push_back(paragraph)
+                self.odf_push_block(result, paragraph)
               case 'list-item':
                 self.odf_parse_frame(listop.add_list_item(start_base), listnode, False, default_style)
           container_paragraph = Block.create('', self.ctx)
           container_paragraph.body.push_back(listop)
           if list_error_op is not None:
             container_paragraph.body.push_back(list_error_op)
-          result.push_back(container_paragraph)
+          self.odf_push_block(result, container_paragraph)
         case "table":
           rowlist : list[list[list[Value]]] = [] # [row][col] -> [list of value]
           covered_table_cells : dict[tuple[int,int], tuple[int,int]] = {} # covered <row, col> --> src <row, col>
@@ -742,7 +1006,7 @@ class _ODParseContext:
           container_paragraph.body.push_back(tableop)
           for md in errlist:
             container_paragraph.body.push_back(md)
-          result.push_back(container_paragraph)
+          self.odf_push_block(result, container_paragraph)
         case _:
           # node type not recognized
           loc = self.get_DILocation(self.cur_page_count, self.cur_row_count, self.cur_column_count)
@@ -1209,6 +1473,164 @@ class _ODParseContext:
     # end of the helper
     walk_frame(doc)
 
+  # 以下两个函数是 transform_pass_fix_text_elements() 的逐块版本，只给 _ODPostParseTransformer 使用
+  # 两者的逻辑应该保持一致；修改其中一个时请同时修改另一个，并用 test-odf-fused-transform (testbench.py) 检查结果是否相同
+  def _fix_text_elements_in_region(self, region : Region) -> bool:
+    # 如果该区内所有的内容都被去除，则返回 True,否则返回 False
+    blocks_to_delete = []
+    for b in region.blocks:
+      if self._fix_text_elements_in_block(b):
+        blocks_to_delete.append(b)
+    if len(blocks_to_delete) > 0:
+      for b in blocks_to_delete:
+        b.erase_from_parent()
+      if region.blocks.empty:
+        return True
+    return False
+
+  def _fix_text_elements_in_block(self, b : Block) -> bool:
+    # transform_pass_fix_text_elements() 对单个块的处理
+    # 如果该块因内容全被划掉而需要删除，则返回 True （由调用者删除），否则返回 False
+    # 我们首先把所有划掉的 IMElementOp 删掉
+    strikethrough_elements : list[IMElementOp] = []
+    for op in b.body:
+      if isinstance(op, IMElementOp):
+        if op.has_attr('StrikeThrough'):
+          strikethrough_elements.append(op)
+    if len(strikethrough_elements) > 0:
+      for op in strikethrough_elements:
+        op.erase_from_parent()
+      # 如果这个块空了，直接跳过
+      if b.body.empty:
+        return True
+    # 然后开始常规的合并
+    first_text_op : IMElementOp = None
+    last_text_op : IMElementOp = None
+    # 尝试合并从 first_text_op 到 last_text_op 间的所有文本内容
+    # 相同字体的内容合并为同一个 ConstantTextFragment
+    # 不同字体的内容合并为一个 ConstantText，内容为多个 ConstantTextFragment
+    def coalesce():
+      nonlocal first_text_op
+      nonlocal last_text_op
+      # skip degenerate cases
+      if first_text_op is None or last_text_op is None or first_text_op is last_text_op:
+        first_text_op = None
+        last_text_op = None
+        return
+      cur_text = ''
+      cur_style = None
+      fragment_list = []
+      end_op = last_text_op.get_next_node()
+      cur_op = first_text_op
+      merged_attribute_dict = {}
+      while cur_op is not end_op:
+        assert type(cur_op) == IMElementOp
+        # 加上这条检查，这样万一以后在首次生成 IMElementOp 时沾上属性后，我们可以在这里添加对属性的合并
+        if len(cur_op.attributes) > 0:
+          for k, v in cur_op.attributes.items():
+            match k:
+              case "LeftMarginInList":
+                if k not in merged_attribute_dict:
+                  merged_attribute_dict[k] = v
+              case _:
+                raise RuntimeError("Unexpected IMElementOp attribute on merge: " + k)
+        for u in cur_op.content.operanduses():
+          cur_content = u.value
+          if isinstance(cur_content, TextFragmentLiteral):
+            cur_new_text = cur_content.get_string()
+            cur_new_style = cur_content.style
+          else:
+            assert isinstance(cur_content, StringLiteral)
+            cur_new_text = cur_content.get_string()
+            cur_new_style = None
+
+          if cur_style is None and len(cur_text) == 0:
+            # this is the first time we visit an element
+            cur_text = cur_new_text
+            cur_style = cur_new_style
+          elif (cur_style is None and cur_new_style is None) or (cur_style == cur_new_style):
+            # this is the first time we visit an element
+            cur_text += cur_new_text
+          else:
+            # we get an fragment with a different style
+            newfrag = StringLiteral.get(cur_text, self.ctx)
+            if cur_style is not None:
+              newfrag = TextFragmentLiteral.get(self.ctx, newfrag, cur_style)
+            fragment_list.append(newfrag)
+            cur_text = cur_new_text
+            cur_style = cur_new_style
+        # finished handling current op
+        cur_op = cur_op.get_next_node()
+      # finished the first iteration
+      # end the last fragment
+      if len(cur_text) > 0:
+        newfrag = StringLiteral.get(cur_text, self.ctx)
+        if cur_style is not None:
+          newfrag = TextFragmentLiteral.get(self.ctx, newfrag, cur_style)
+        # create the new element
+        new_content = None
+        if len(fragment_list) == 0:
+          new_content = newfrag
+        else:
+          fragment_list.append(newfrag)
+          new_content = fragment_list
+        newop  = IMElementOp.create(content = new_content, name = first_text_op.name, loc = first_text_op.location)
+        # now replace the current ops
+        newop.insert_before(first_text_op)
+        for k, v in merged_attribute_dict.items():
+          newop.set_attr(k, v)
+      cur_op = first_text_op
+      while cur_op is not end_op:
+        cur_op = cur_op.erase_from_parent()
+      # done for this helper
+
+    op_to_delete = []
+    for op in b.body:
+      if op.get_num_regions() > 0:
+        assert not isinstance(op, IMElementOp)
+        coalesce()
+        emptied_regions : typing.List[Region] = []
+        for r in op.regions:
+          ret = self._fix_text_elements_in_region(r)
+          if ret:
+            emptied_regions.append(r)
+        if len(emptied_regions) > 0:
+          # 查看我们是否允许在该操作符内删掉区，甚至删除整个操作符
+          delete_op_if_empty = False
+          if isinstance(op, IMListOp):
+            # 列表下任意区都可以删
+            # 如果所有区都没了，列表也可以删
+            delete_op_if_empty = True
+          else:
+            # 默认什么区都不能删
+            # 如果以后有其他操作符可以删区，则在此处更新
+            emptied_regions.clear()
+          if len(emptied_regions) > 0:
+            for r in emptied_regions:
+              r.erase_from_parent()
+            if op.get_num_regions() == 0 and delete_op_if_empty:
+              op_to_delete.append(op)
+      elif type(op) == IMElementOp:
+        content = op.content.get()
+        if isinstance(content, (StringLiteral, TextFragmentLiteral)) and not op.has_attr('StrikeThrough'):
+          # we do found a fragment
+          if first_text_op is None:
+            first_text_op = op
+            last_text_op = op
+          else:
+            last_text_op = op
+        else:
+          # it is some other content (cannot merge)
+          coalesce()
+      else:
+        # this is not an IMElementOp
+        coalesce()
+    # we walked through all the ops of the body
+    coalesce()
+    for op in op_to_delete:
+      op.erase_from_parent()
+    return False
+
   def _try_recover_flattened_list(self, rootlist : IMListOp):
     # 首先检查是否只有一个层级，如果已经有多层级了就可以结束了
     # 同时收集每项的缩进距离
@@ -1333,6 +1755,13 @@ class _ODParseContext:
     assert self.cur_column_count == 1
 
     result : IMDocumentOp = IMDocumentOp.create(self.documentname, self.difile)
+    if self.fused_transform:
+      # 每个顶层块生成后立即进行变换，不需要再遍历整个文档
+      self.post_parse_transformer = _ODPostParseTransformer(self, result.body)
+      self.odf_parse_frame(result.body, self.odfhandle.text, False)
+      self.post_parse_transformer.finish()
+      self.post_parse_transformer = None
+      return result
     self.odf_parse_frame(result.body, self.odfhandle.text, False)
     self.transform_pass_fix_text_elements(result)
     self.transform_pass_merge_special_blocks(result)
@@ -1340,8 +1769,8 @@ class _ODParseContext:
     self.transform_pass_recover_flattened_list(result)
     return result
 
-def parse_odf(ctx : Context, filePath : str):
-  pc = _ODParseContext(ctx = ctx, filePath = filePath)
+def parse_odf(ctx : Context, filePath : str, fused_transform : bool = False):
+  pc = _ODParseContext(ctx = ctx, filePath = filePath, fused_transform = fused_transform)
   result = pc.parse_odf()
   pc.cleanup()
   return result
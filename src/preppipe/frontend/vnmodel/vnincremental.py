@@ -0,0 +1,476 @@
+# SPDX-FileCopyrightText: 2025 PrepPipe's Contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# 增量解析：给 GUI 的实时预览使用，在同一个进程内反复解析同一组文档
+# 每次更新时：
+# 1. 如果文件（大小、修改时间）没有变化，直接复用上次的 VNASTFileInfo，不再读取文件
+# 2. 否则重新读取文件、运行 cmdsyntax，然后以段落（块）为单位计算指纹并与上次的结果比较
+#     指纹只包含内容，不包含位置，这样在中间插入一行时后面的段落仍然可以复用；
+#     复用的段落在新文档中的位置可能变了，拼接后我们把旧结果中的位置都换成新文档中对应的位置
+#     如果只有函数体内的部分段落有变化，并且这些段落（新旧都算）不含声明、函数切换等影响文件级状态的内容，
+#     我们只对这些段落重新运行 VNParser.handle_block()，并把结果拼接到之前的 VNAST 中
+# 3. 其他情况下重新转录整个文件
+# 解析后处理（推断占位图大小）只对声明有影响，所以只对重新转录的文件执行
+# 不同文件之间的转录是独立的（声明等都保存在各自的 VNASTFileInfo 中），所以一个文件的变化不会影响其他文件
+
+from __future__ import annotations
+import os
+import dataclasses
+import hashlib
+import typing
+import zipfile
+
+from ...irbase import *
+from ...inputmodel import *
+from ...pipeline import TransformBase
+from ..commandsyntaxparser import perform_command_parse_transform
+from ..opendocument import ReadOpenDocument
+from ..docx import ReadDOCX
+from ..markdown import ReadMarkdown
+from ..text import ReadText
+from .vnast import *
+from .vnparser import VNParser, VNASTParsingState
+
+@dataclasses.dataclass
+class _VNIncrementalCallRecord:
+  # 一次顶层 VNParser.handle_block() 调用的记录
+  start : int # 第一个输入块的序号
+  count : int # 读取的输入块数量（图片后紧跟标题时会多读一块）
+  region : VNASTCodegenRegion | None # 调用开始时的输出区域
+  nodes : list[Operation] # 该次调用在输出区域中新加的内容
+  is_pure : bool # 是否只向输出区域（函数体）添加了内容，没有修改文件级的状态（声明、函数切换等）
+  is_lookahead : bool # 该调用是否可能读取下一个块的内容
+
+@dataclasses.dataclass
+class _VNIncrementalFileRecord:
+  path : str
+  stat_key : tuple[int, int] | None
+  doc : IMDocumentOp
+  block_hashes : list[bytes]
+  calls : list[_VNIncrementalCallRecord]
+  file : VNASTFileInfo | None # 空文件的话为 None
+
+class VNIncrementalParser:
+  # 长期存在的增量解析器，每次调用 update_files() 或 update_documents() 都返回更新后的 VNAST
+  # 返回的 VNAST 会在之后的更新中被原地修改，调用者不应在两次更新之间修改它
+  ctx : Context
+  parser : VNParser
+  _records : dict[str, _VNIncrementalFileRecord]
+  _zip_crc_cache : dict[str, tuple[tuple[int, int], dict[str, int]]]
+
+  # 统计信息
+  num_files_reused : int
+  num_files_spliced : int
+  num_files_reparsed : int
+  num_blocks_reparsed : int
+
+  FRONTENDS : typing.ClassVar[dict[str, type[TransformBase]]] = {
+    '.odt' : ReadOpenDocument,
+    '.docx' : ReadDOCX,
+    '.md' : ReadMarkdown,
+    '.txt' : ReadText,
+  }
+
+  def __init__(self, ctx : Context, screen_resolution : tuple[int, int] | None = None, name : str = '') -> None:
+    self.ctx = ctx
+    self.parser = VNParser.create(ctx, screen_resolution=screen_resolution, name=name)
+    self._records = {}
+    self._zip_crc_cache = {}
+    self.reset_stats()
+
+  @property
+  def ast(self) -> VNAST:
+    return self.parser.ast
+
+  def reset_stats(self):
+    self.num_files_reused = 0
+    self.num_files_spliced = 0
+    self.num_files_reparsed = 0
+    self.num_blocks_reparsed = 0
+
+  @staticmethod
+  def _get_stat_key(path : str) -> tuple[int, int]:
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime_ns)
+
+  def update_files(self, paths : typing.Iterable[str]) -> VNAST:
+    # 按后缀选择前端读取文件；只有（大小、修改时间）有变化的文件才会被重新读取
+    docs : list[IMDocumentOp | str] = []
+    stat_keys : dict[str, tuple[int, int]] = {}
+    for path in paths:
+      path = os.path.abspath(path)
+      stat_key = self._get_stat_key(path)
+      stat_keys[path] = stat_key
+      record = self._records.get(path)
+      if record is not None and record.stat_key == stat_key:
+        docs.append(path)
+        continue
+      _basename, ext = os.path.splitext(path)
+      frontend_cls = VNIncrementalParser.FRONTENDS.get(ext.lower())
+      if frontend_cls is None:
+        raise PPInvalidOperationError('Unsupported input file type: ' + path)
+      frontend = frontend_cls(self.ctx)
+      frontend.set_input([path])
+      doc = frontend.run()
+      assert isinstance(doc, IMDocumentOp)
+      docs.append(doc)
+    return self._update_impl(docs, stat_keys)
+
+  def update_documents(self, docs : typing.Iterable[IMDocumentOp]) -> VNAST:
+    # 输入是前端刚生成的（还没经过 cmdsyntax 的）文档
+    return self._update_impl(list(docs), {})
+
+  def _update_impl(self, docs : list[IMDocumentOp | str], stat_keys : dict[str, tuple[int, int]]) -> VNAST:
+    files : list[VNASTFileInfo] = []
+    transcribed_files : list[VNASTFileInfo] = []
+    live_paths : set[str] = set()
+    for doc in docs:
+      if isinstance(doc, str):
+        record = self._records[doc]
+        self.num_files_reused += 1
+      else:
+        path = os.path.abspath(doc.location.get_file_path())
+        record, is_transcribed = self._update_document(path, doc, stat_keys.get(path))
+        if is_transcribed and record.file is not None:
+          transcribed_files.append(record.file)
+      live_paths.add(record.path)
+      if record.file is not None:
+        files.append(record.file)
+    # 删掉不再使用的文件
+    for path in [p for p in self._records if p not in live_paths]:
+      record = self._records.pop(path)
+      if record.file is not None:
+        record.file.erase_from_parent()
+    # 按输入顺序重新排列文件
+    for file in files:
+      file.remove_from_parent()
+      self.parser.ast.files.push_back(file)
+    self.parser.postprocessing(transcribed_files)
+    return self.parser.ast
+
+  def _update_document(self, path : str, doc : IMDocumentOp, stat_key : tuple[int, int] | None) -> tuple[_VNIncrementalFileRecord, bool]:
+    # 返回 (记录, 是否重新转录了整个文件)
+    perform_command_parse_transform(doc)
+    block_hashes = [self._get_block_fingerprint(b) for b in doc.body.blocks]
+    record = self._records.get(path)
+    if record is not None:
+      if record.block_hashes == block_hashes:
+        # 内容没变，但段落的位置可能变了（比如前面加了被删除线划掉的内容）
+        old_blocks = list(record.doc.body.blocks)
+        location_map = self._get_location_map(zip(old_blocks, doc.body.blocks))
+        if location_map is not None:
+          if record.file is not None:
+            self._rebase_locations(record.file, location_map, set())
+          record.stat_key = stat_key
+          self._replace_doc(record, doc)
+          self.num_files_reused += 1
+          return (record, False)
+      elif record.file is not None and self._try_splice(record, doc, block_hashes):
+        record.stat_key = stat_key
+        self.num_files_spliced += 1
+        return (record, False)
+      if record.file is not None:
+        record.file.erase_from_parent()
+      record.doc.drop_all_references()
+    file, calls = self._transcribe_document(doc)
+    self.num_files_reparsed += 1
+    self.num_blocks_reparsed += len(block_hashes)
+    record = _VNIncrementalFileRecord(path=path, stat_key=stat_key, doc=doc, block_hashes=block_hashes, calls=calls, file=file)
+    self._records[path] = record
+    return (record, True)
+
+  # ----------------------------------------------------------------------------
+  # 转录
+  # ----------------------------------------------------------------------------
+
+  @staticmethod
+  def _get_file_signature(file : VNASTFileInfo) -> tuple:
+    # 除了向当前函数体添加内容外，其他所有会被 handle_block() 修改的文件级状态
+    return (len(file.functions.body), len(file.assetdecls), len(file.characters), len(file.variables), len(file.scenes),
+            len(file.pending_content.body), file.namespace.try_get_value(), file.export_script_name.try_get_value())
+
+  @staticmethod
+  def _is_lookahead_block(block : Block) -> bool:
+    # 参考 VNParser.handle_block(): 段落以图片结尾时会读取下一段来找图片的标题
+    lastop = block.body.back
+    return isinstance(lastop, IMElementOp) and isinstance(lastop.content.get(), ImageAssetData)
+
+  def _run_handle_block(self, state : VNASTParsingState, block : Block, start : int, block_index : dict[int, int], num_blocks : int) -> _VNIncrementalCallRecord:
+    file = state.output_current_file
+    region = state.output_current_region
+    container = region.body if region is not None else file.pending_content
+    last = container.body.back
+    signature = self._get_file_signature(file)
+    self.parser.handle_block(state, block)
+    if nextblock := state.peek_next_block():
+      end = block_index[id(nextblock)]
+    else:
+      end = num_blocks
+    nodes : list[Operation] = []
+    is_pure = False
+    if state.output_current_region is region:
+      node = last.get_next_node() if last is not None else container.body.front
+      while node is not None:
+        nodes.append(node)
+        node = node.get_next_node()
+      is_pure = region is not None and self._get_file_signature(file) == signature
+    return _VNIncrementalCallRecord(start=start, count=end-start, region=region, nodes=nodes, is_pure=is_pure, is_lookahead=self._is_lookahead_block(block))
+
+  def _transcribe_document(self, doc : IMDocumentOp) -> tuple[VNASTFileInfo | None, list[_VNIncrementalCallRecord]]:
+    # 与 VNParser.add_document() 相同，只是额外记录每次 handle_block() 的结果
+    state = self.parser.initialize_state_for_doc(doc)
+    if state is None:
+      return (None, [])
+    if len(doc.name) > 0:
+      if len(self.parser.ast.name) == 0:
+        self.parser.ast.name = doc.name
+    block_index = {id(b) : i for i, b in enumerate(doc.body.blocks)}
+    num_blocks = len(block_index)
+    calls : list[_VNIncrementalCallRecord] = []
+    while block := state.get_next_input_block():
+      calls.append(self._run_handle_block(state, block, block_index[id(block)], block_index, num_blocks))
+    self.parser.run_create_default_function(state.output_current_file)
+    return (state.output_current_file, calls)
+
+  @staticmethod
+  def _replace_doc(record : _VNIncrementalFileRecord, doc : IMDocumentOp):
+    # 旧文档不再使用，去掉其对字面值、资源等的引用
+    if record.doc is not doc:
+      record.doc.drop_all_references()
+      record.doc = doc
+
+  @staticmethod
+  def _discard_scratch(scratch_file : VNASTFileInfo, scratch_region : VNASTFunction):
+    scratch_region.drop_all_references()
+    scratch_file.drop_all_references()
+
+  def _try_splice(self, record : _VNIncrementalFileRecord, doc : IMDocumentOp, block_hashes : list[bytes]) -> bool:
+    # 只重新处理有变化的段落，成功的话返回 True
+    # 不满足条件时返回 False 且不修改任何内容，由调用者重新转录整个文件
+    old_hashes = record.block_hashes
+    calls = record.calls
+    if len(calls) == 0:
+      return False
+    limit = min(len(old_hashes), len(block_hashes))
+    prefix = 0
+    while prefix < limit and old_hashes[prefix] == block_hashes[prefix]:
+      prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old_hashes[-1-suffix] == block_hashes[-1-suffix]:
+      suffix += 1
+    delta = len(block_hashes) - len(old_hashes)
+    new_end_min = len(block_hashes) - suffix
+
+    # 找到第一个需要重新运行的调用
+    first = 0
+    while first < len(calls) and calls[first].start + calls[first].count <= prefix:
+      first += 1
+    if first > 0 and calls[first-1].is_lookahead and calls[first-1].start + calls[first-1].count == prefix:
+      first -= 1
+    if first < len(calls):
+      start = calls[first].start
+      region = calls[first].region
+    else:
+      # 只在文件末尾添加了内容
+      start = len(old_hashes)
+      if not calls[-1].is_pure:
+        return False
+      region = calls[-1].region
+    if region is None:
+      return False
+
+    # 在一个临时的文件中运行新的段落，这样任何对文件级状态的修改都能被检测到
+    # （比如在临时文件中添加声明，不管在原文件中是否重名，都会改变临时文件的状态）
+    blocks = list(doc.body.blocks)
+    block_index = {id(b) : i for i, b in enumerate(blocks)}
+    oldfile = record.file
+    assert oldfile is not None
+    scratch_file = VNASTFileInfo.create(name=oldfile.name, loc=oldfile.location, namespace=oldfile.namespace.try_get_value())
+    scratch_region = VNASTFunction.create(context=self.ctx, name=region.name, loc=region.location)
+    state = VNASTParsingState(self.ctx, doc.location.get_file_path())
+    state.input_top_level_region = doc.body
+    state.input_current_block = blocks[start] if start < len(blocks) else None
+    state.output_current_file = scratch_file
+    state.output_current_region = scratch_region
+    old_starts = set(c.start for c in calls)
+    new_calls : list[_VNIncrementalCallRecord] = []
+    cur = start
+    while cur < len(blocks):
+      if cur >= new_end_min and (cur - delta) in old_starts:
+        break
+      block = state.get_next_input_block()
+      assert block is blocks[cur]
+      call = self._run_handle_block(state, block, cur, block_index, len(blocks))
+      if not call.is_pure:
+        self._discard_scratch(scratch_file, scratch_region)
+        return False
+      new_calls.append(call)
+      cur = call.start + call.count
+    end = cur - delta
+
+    # 被替换的旧调用必须都在同一个函数体内且没有修改文件级状态
+    last = first
+    while last < len(calls) and calls[last].start < end:
+      if not calls[last].is_pure or calls[last].region is not region:
+        self._discard_scratch(scratch_file, scratch_region)
+        return False
+      last += 1
+
+    # 保留的段落（前面的 start 个与后面的 len(old_hashes) - end 个）在新文档中的位置
+    old_blocks = list(record.doc.body.blocks)
+    kept_pairs = list(zip(old_blocks[:start], blocks[:start])) + list(zip(old_blocks[end:], blocks[end+delta:]))
+    location_map = self._get_location_map(kept_pairs)
+    if location_map is None:
+      self._discard_scratch(scratch_file, scratch_region)
+      return False
+
+    # 确定插入位置
+    old_nodes = [node for c in calls[first:last] for node in c.nodes]
+    insert_before : Operation | None = None
+    if len(old_nodes) > 0:
+      insert_before = old_nodes[0]
+    else:
+      for c in calls[last:]:
+        if c.region is region and len(c.nodes) > 0 and c.nodes[0].parent is region.body:
+          insert_before = c.nodes[0]
+          break
+      if insert_before is None:
+        for c in reversed(calls[:first]):
+          if c.region is region and len(c.nodes) > 0 and c.nodes[-1].parent is region.body:
+            insert_before = c.nodes[-1].get_next_node()
+            break
+    for c in new_calls:
+      c.region = region
+      for node in c.nodes:
+        if insert_before is not None:
+          node.insert_before(insert_before)
+        else:
+          node.remove_from_parent()
+          region.body.push_back(node)
+    for node in old_nodes:
+      node.erase_from_parent()
+    self._discard_scratch(scratch_file, scratch_region)
+    # 新生成的内容已经是新的位置了，不能再换（旧位置与新位置可能重合）
+    self._rebase_locations(oldfile, location_map, set(id(node) for c in new_calls for node in c.nodes))
+
+    # 更新记录
+    for c in calls[last:]:
+      c.start += delta
+    calls[first:last] = new_calls
+    record.block_hashes = block_hashes
+    self._replace_doc(record, doc)
+    self.num_blocks_reparsed += cur - start
+    return True
+
+  # ----------------------------------------------------------------------------
+  # 位置
+  # ----------------------------------------------------------------------------
+
+  @staticmethod
+  def _add_location_pairs(oldop : Operation, newop : Operation, location_map : dict[Location, Location]) -> bool:
+    # 指纹相同的两个操作项结构也相同，逐个记录 旧位置 -> 新位置；同一个旧位置对应到不同的新位置时返回 False
+    if location_map.setdefault(oldop.location, newop.location) is not newop.location:
+      return False
+    oldregions = list(oldop.regions)
+    newregions = list(newop.regions)
+    if len(oldregions) != len(newregions):
+      return False
+    for oldregion, newregion in zip(oldregions, newregions):
+      oldblocks = list(oldregion.blocks)
+      newblocks = list(newregion.blocks)
+      if len(oldblocks) != len(newblocks):
+        return False
+      for oldblock, newblock in zip(oldblocks, newblocks):
+        if not VNIncrementalParser._add_block_location_pairs(oldblock, newblock, location_map):
+          return False
+    return True
+
+  @staticmethod
+  def _add_block_location_pairs(oldblock : Block, newblock : Block, location_map : dict[Location, Location]) -> bool:
+    oldops = list(oldblock.body)
+    newops = list(newblock.body)
+    if len(oldops) != len(newops):
+      return False
+    for oldop, newop in zip(oldops, newops):
+      if not VNIncrementalParser._add_location_pairs(oldop, newop, location_map):
+        return False
+    return True
+
+  @staticmethod
+  def _get_location_map(block_pairs : typing.Iterable[tuple[Block, Block]]) -> dict[Location, Location] | None:
+    # 输入为内容相同的 (旧段落, 新段落)，返回旧文档中的位置到新文档中位置的映射；无法确定映射时返回 None
+    location_map : dict[Location, Location] = {}
+    for oldblock, newblock in block_pairs:
+      if not VNIncrementalParser._add_block_location_pairs(oldblock, newblock, location_map):
+        return None
+    return location_map
+
+  @staticmethod
+  def _rebase_locations(op : Operation, location_map : dict[Location, Location], skipped : set[int]):
+    # 把 op 及其下所有内容的位置按 location_map 替换，跳过 skipped 中（以 id() 记录）的操作项及其内容
+    if id(op) in skipped:
+      return
+    if (loc := location_map.get(op.location)) is not None and loc is not op.location:
+      op.location = loc
+    for r in op.regions:
+      for b in r.blocks:
+        for child in b.body:
+          VNIncrementalParser._rebase_locations(child, location_map, skipped)
+
+  # ----------------------------------------------------------------------------
+  # 段落指纹
+  # ----------------------------------------------------------------------------
+
+  def _get_zip_member_crc(self, zip_path : str, member : str) -> int:
+    stat_key = self._get_stat_key(zip_path)
+    entry = self._zip_crc_cache.get(zip_path)
+    if entry is None or entry[0] != stat_key:
+      with zipfile.ZipFile(zip_path, 'r') as z:
+        entry = (stat_key, {info.filename : info.CRC for info in z.infolist()})
+      self._zip_crc_cache[zip_path] = entry
+    return entry[1].get(member, 0)
+
+  def _hash_value(self, h : hashlib._Hash, v : Value):
+    h.update(type(v).__name__.encode())
+    if isinstance(v, Literal):
+      h.update(repr(v.value).encode())
+    elif isinstance(v, AssetData):
+      # 内嵌在压缩包中的资源用成员的 CRC 来判断内容是否改变
+      # 外部资源在 Context 中是唯一的，用路径和修改时间
+      # 其他情况（临时文件、内存中的数据）每次解析都不一样，总是视为有变化
+      if zip_source := v.zip_source:
+        zip_path, member = zip_source
+        h.update((member + '#' + str(self._get_zip_member_crc(zip_path, member))).encode())
+      elif v.data is None and os.path.isfile(v.backing_store_path):
+        h.update((v.backing_store_path + '#' + str(self._get_stat_key(v.backing_store_path))).encode())
+      else:
+        h.update(str(id(v)).encode())
+    elif isinstance(v, OpResult):
+      h.update(type(v.parent).__name__.encode())
+    else:
+      h.update(str(v).encode())
+
+  def _hash_operation(self, h : hashlib._Hash, op : Operation):
+    # 不包含位置，见文件开头的说明
+    h.update(b'(' + type(op).__name__.encode() + b':' + op.name.encode())
+    for name, value in op.attributes.items():
+      h.update(('@' + name + '=' + repr(value)).encode())
+    for name, operand in op.operands.items():
+      h.update(('%' + name).encode())
+      for u in operand.operanduses():
+        self._hash_value(h, u.value)
+    for r in op.regions:
+      h.update(('{' + r.name).encode())
+      for b in r.blocks:
+        h.update(b'[')
+        for child in b.body:
+          self._hash_operation(h, child)
+        h.update(b']')
+      h.update(b'}')
+    h.update(b')')
+
+  def _get_block_fingerprint(self, block : Block) -> bytes:
+    h = hashlib.blake2b(digest_size=16)
+    for op in block.body:
+      self._hash_operation(h, op)
+    return h.digest()
@@ -450,8 +450,9 @@ class VNParser(FrontendParserBase[VNASTParsingState]):
     func.body.take_body(file.pending_content)
     # 结束
 
-  def postprocessing(self):
-    parse_postprocessing_update_placeholder_imagesizes(self.ast)
+  def postprocessing(self, files : typing.Iterable[VNASTFileInfo] | None = None):
+    # files 为 None 时处理所有文件
+    parse_postprocessing_update_placeholder_imagesizes(self.ast, files)
 
   def create_command_match_error(self, commandop: GeneralCommandOp, unmatched_results: list[typing.Tuple[callable, typing.Tuple[str, str]]] | None = None, matched_results: list[FrontendParserBase.CommandInvocationInfo] | None = None) -> ErrorOp:
     errmsg = 'Cannot find unique match for command: ' + commandop.get_short_str()
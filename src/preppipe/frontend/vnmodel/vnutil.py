@@ -706,14 +706,14 @@ def infer_placeholder_sizes(t : SymbolTableRegion[VNASTNamespaceSwitchableValueS
       raise PPInternalError()
     u.set_value(newexpr)
 
-def parse_postprocessing_update_placeholder_imagesizes(ast : VNAST):
+def parse_postprocessing_update_placeholder_imagesizes(ast : VNAST, files : typing.Iterable[VNASTFileInfo] | None = None):
   screen_width, screen_height = ast.screen_resolution.get().value
   background_size = (screen_width, screen_height)
   charactersprite_width = int(600 * screen_height / 1080)
   charactersprite_size = (charactersprite_width, screen_height)
   charactersideimage_width = int(600 * min(screen_width, screen_height) / 1080)
   charactersideimage_size = (charactersideimage_width, charactersideimage_width)
-  for f in ast.files.body:
+  for f in (ast.files.body if files is None else files):
     if not isinstance(f, VNASTFileInfo):
       raise PPInternalError("Unexpected file type")
     for c in f.characters:
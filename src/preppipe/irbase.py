@@ -19,6 +19,8 @@ import abc
 import json
 import hashlib
 import mimetypes
+import threading
+import zipfile
 import base64
 
 import PIL.Image
@@ -2446,6 +2448,15 @@ class Context:
     self._asset_data_list.push_back(asset)
     return asset
 
+  def _create_asset_data_zipped(self, asset_cls : typing.Type[_AssetTV], full_embed_path : str, zip_path : str, member : str, asset_format : typing.Any) -> _AssetTV:
+    # 资源内嵌在 docx/odt 这类压缩包中时，我们只记录 (压缩包路径, 成员名)，在读取或导出时才解压
+    # 这样在之后被丢弃的资源（比如被划掉的内容中的图片）就不需要额外复制一遍了
+    assert asset_format is not None
+    loc = self.get_DIFile(full_embed_path)
+    asset = asset_cls(init_mode=IRObjectInitMode.CONSTRUCT, context=self, zip_source=(zip_path, member), format=asset_format, loc=loc)
+    self._asset_data_list.push_back(asset)
+    return asset
+
   def _get_or_create_asset_data_external(self, asset_cls : typing.Type[_AssetTV], ext_path : str, asset_format : typing.Any) -> _AssetTV:
     if ext_path in self._asset_import_cache:
       result = self._asset_import_cache[ext_path]
@@ -2473,6 +2484,9 @@ class Context:
   def create_image_asset_data_embedded(self, full_embed_path : str, data : bytes, img_format : str | None = None) -> ImageAssetData:
     return self._create_asset_data_embedded(ImageAssetData, full_embed_path, data, img_format)
 
+  def create_image_asset_data_zipped(self, full_embed_path : str, zip_path : str, member : str, img_format : str) -> ImageAssetData:
+    return self._create_asset_data_zipped(ImageAssetData, full_embed_path, zip_path, member, img_format)
+
   def get_or_create_image_asset_data_external(self, ext_path : str, img_format : str | None = None) -> ImageAssetData:
     assert self._file_auditor.check_is_path_accessible(ext_path)
     return self._get_or_create_asset_data_external(ImageAssetData, ext_path, img_format)
@@ -2480,6 +2494,9 @@ class Context:
   def create_audio_asset_data_embedded(self, full_embed_path : str, data : bytes, audio_format : str | None = None) -> AudioAssetData:
     return self._create_asset_data_embedded(AudioAssetData, full_embed_path, data, audio_format)
 
+  def create_audio_asset_data_zipped(self, full_embed_path : str, zip_path : str, member : str, audio_format : str) -> AudioAssetData:
+    return self._create_asset_data_zipped(AudioAssetData, full_embed_path, zip_path, member, audio_format)
+
   def get_or_create_audio_asset_data_external(self, ext_path : str, audio_format : str | None = None) -> AudioAssetData:
     assert self._file_auditor.check_is_path_accessible(ext_path)
     return self._get_or_create_asset_data_external(AudioAssetData, ext_path, audio_format)
@@ -2538,18 +2555,26 @@ class AssetData(Value, IListNode, typing.Generic[_DataTV, _FmtTV]):
 
   _loc : DIFile | None # non-null if the asset is from external file (i.e., not created on the fly)
   _backing_store_path : str # if it is in the temporary directory, this asset data owns it; otherwise the source is read-only; empty string if no backing store
+  _zip_source : tuple[str, str] | None # (zip path, member name) if the asset is embedded in an archive (e.g., docx/odt) and is not extracted yet
+
+  # serializes the extraction of archive members (see _extract_zip_source()); extraction happens at most once per asset so a single lock is enough
+  _zip_extract_lock : typing.ClassVar[threading.Lock] = threading.Lock()
   _data : _DataTV | None
   _format : _FmtTV | None
 
-  def construct_init(self, *, context : Context, backing_store_path : str = '', data : _DataTV | None = None, format : _FmtTV | None = None, loc : DIFile | None = None, **kwargs) -> None:
+  def construct_init(self, *, context : Context, backing_store_path : str = '', data : _DataTV | None = None, format : _FmtTV | None = None, loc : DIFile | None = None, zip_source : tuple[str, str] | None = None, **kwargs) -> None:
     ty = AssetDataReferenceType.get(context)
     super().construct_init(context=context, ty=ty, **kwargs)
     # context._add_asset_data(self)
     self._loc = loc
     self._backing_store_path = backing_store_path
+    self._zip_source = zip_source
     self._data = data
-    # invariants check: either backing_store_path is provided, or data is provided
-    assert (self._data is not None) == (len(self._backing_store_path) == 0)
+    # invariants check: exactly one of backing_store_path, zip_source, and data is provided
+    assert [self._data is not None, len(self._backing_store_path) > 0, self._zip_source is not None].count(True) == 1
+    if zip_source is not None:
+      # the format must be provided (e.g., from the MIME type) so that we do not need to extract the asset here
+      assert format is not None
     if format is not None:
       self._format = format
     else:
@@ -2564,6 +2589,59 @@ class AssetData(Value, IListNode, typing.Generic[_DataTV, _FmtTV]):
 
   @property
   def backing_store_path(self) -> str:
+    # if the asset is still in an archive, we extract it to the temporary directory on first access
+    if self._zip_source is not None:
+      self._extract_zip_source()
+    return self._backing_store_path
+
+  @property
+  def zip_source(self) -> tuple[str, str] | None:
+    return self._zip_source
+
+  def _read_zip_source(self) -> bytes:
+    # callers check zip_source first, but another thread may have extracted the member since then
+    # _extract_zip_source() sets the backing store path before clearing _zip_source, so one of them is always usable
+    zip_source = self._zip_source
+    if zip_source is None:
+      with open(self._backing_store_path, 'rb') as f:
+        return f.read()
+    zip_path, member = zip_source
+    with zipfile.ZipFile(zip_path, 'r') as z:
+      return z.read(member)
+
+  def _export_zip_source(self, dest_path : str) -> None:
+    # copy the archive member to dest_path without extracting it to the temporary directory first
+    zip_source = self._zip_source
+    if zip_source is None:
+      # extracted by another thread in the meantime (see _read_zip_source())
+      shutil.copy2(self._backing_store_path, dest_path, follow_symlinks=False)
+      return
+    zip_path, member = zip_source
+    with zipfile.ZipFile(zip_path, 'r') as z:
+      with z.open(member, 'r') as src, open(dest_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+
+  def _extract_zip_source(self) -> None:
+    # several threads (e.g., asset export workers) may ask for the backing store path of the same asset at once
+    # only the first one extracts the member; the others wait for it and then see _zip_source cleared
+    with AssetData._zip_extract_lock:
+      zip_source = self._zip_source
+      if zip_source is None:
+        return
+      _zip_path, member = zip_source
+      data = self._read_zip_source()
+      tmppath = self.context.get_backing_dir()
+      filename = self.context.create_name_for_asset(tmppath.name, member, data)
+      backing_store_path = os.path.join(tmppath.name, filename)
+      with open(backing_store_path, "wb") as f:
+        f.write(data)
+      self._backing_store_path = backing_store_path
+      self._zip_source = None
+
+  def _get_source_name(self) -> str:
+    # the path (or archive member name) we read from; we only use this for the file extension
+    if self._zip_source is not None:
+      return self._zip_source[1]
     return self._backing_store_path
 
   @property
@@ -2609,6 +2687,29 @@ class AssetData(Value, IListNode, typing.Generic[_DataTV, _FmtTV]):
     # if the caller want one, they can always create one using the dest_path
     raise PPNotImplementedError()
 
+  def get_export_passthrough_path(self, dest_path : str) -> str | None:
+    # if export(dest_path) would be a plain copy of a file on disk, return the path of that file
+    # the exporter can then compare it against the destination, or place a hard link / reflink instead of copying
+    return None
+
+  def get_export_source_key(self) -> str | None:
+    # a string identifying the content of this asset; same key and same destination path means export() produces the same file
+    # return None if we cannot decide it cheaply; such assets are always exported
+    # derived classes with in-memory data should override this
+    if (zip_source := self._zip_source) is not None:
+      # do not extract the member; the CRC in the archive directory is enough
+      zip_path, member = zip_source
+      with zipfile.ZipFile(zip_path, 'r') as z:
+        info = z.getinfo(member)
+      return 'zip:' + str(info.CRC) + ':' + str(info.file_size)
+    if len(self._backing_store_path) > 0:
+      h = hashlib.sha256()
+      with open(self._backing_store_path, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+          h.update(chunk)
+      return 'file:' + h.hexdigest()
+    return None
+
   @staticmethod
   def secure_overwrite(exportpath: str, write_callback: typing.Callable):
     tmpfilepath = exportpath + ".tmp"
@@ -2635,6 +2736,8 @@ class AssetData(Value, IListNode, typing.Generic[_DataTV, _FmtTV]):
 @IRObjectJsonTypeName('bytes_ad')
 class BytesAssetData(AssetData[bytes, None]):
   def load_from_storage(self) -> bytes:
+    if self.zip_source is not None:
+      return self._read_zip_source()
     with open(self.backing_store_path, 'rb') as f:
       return f.read()
 
@@ -2642,9 +2745,21 @@ class BytesAssetData(AssetData[bytes, None]):
     if data := self.data:
       with open(dest_path, 'wb') as f:
         f.write(data)
+    elif self.zip_source is not None:
+      self._export_zip_source(dest_path)
     else:
       shutil.copy2(self.backing_store_path, dest_path, follow_symlinks=False)
 
+  def get_export_passthrough_path(self, dest_path : str) -> str | None:
+    if self._data is None and self._zip_source is None:
+      return self._backing_store_path
+    return None
+
+  def get_export_source_key(self) -> str | None:
+    if self._data is not None:
+      return 'bytes:' + hashlib.sha256(self._data).hexdigest()
+    return super().get_export_source_key()
+
   _tr_bytesassetdata_name = TR_preppipe.tr("bytesassetdata_name",
     en="Binary Asset",
     zh_cn="二进制资源",
@@ -2704,6 +2819,8 @@ class ImageAssetData(AssetData[PIL.Image.Image, str]):
         return format.lower()
 
   def load_from_storage(self) -> PIL.Image.Image:
+    if self.zip_source is not None:
+      return PIL.Image.open(io.BytesIO(self._read_zip_source()))
     return PIL.Image.open(self.backing_store_path)
 
   def export(self, dest_path : str) -> None:
@@ -2712,14 +2829,39 @@ class ImageAssetData(AssetData[PIL.Image.Image, str]):
       return
     # we do file copy iff the source and dest format matches
     # otherwise, we open the source file and save it in the destination
-    _srcname, srcext = os.path.splitext(self.backing_store_path)
+    _srcname, srcext = os.path.splitext(self._get_source_name())
     _destname, destext = os.path.splitext(dest_path)
     if srcext.lower() == destext.lower():
-      shutil.copy2(self.backing_store_path, dest_path, follow_symlinks=False)
+      if self.zip_source is not None:
+        self._export_zip_source(dest_path)
+      else:
+        shutil.copy2(self.backing_store_path, dest_path, follow_symlinks=False)
     else:
-      image = PIL.Image.open(self.backing_store_path)
+      image = self.load_from_storage()
       image.save(dest_path)
 
+  def get_export_passthrough_path(self, dest_path : str) -> str | None:
+    if self._data is not None or self._zip_source is not None:
+      return None
+    _srcname, srcext = os.path.splitext(self._backing_store_path)
+    _destname, destext = os.path.splitext(dest_path)
+    if srcext.lower() == destext.lower():
+      return self._backing_store_path
+    return None
+
+  def get_export_source_key(self) -> str | None:
+    if self._data is not None:
+      # hashing the pixels is much cheaper than encoding the image again
+      h = hashlib.sha256()
+      h.update((self._data.mode + ':' + str(self._data.size) + ':').encode('utf-8'))
+      if self._data.mode in ('P', 'PA'):
+        h.update(str(self._data.getpalette()).encode('utf-8'))
+      # save() also writes some of the info (e.g., transparency, ICC profile)
+      h.update(repr(sorted(self._data.info.items())).encode('utf-8'))
+      h.update(self._data.tobytes())
+      return 'image:' + h.hexdigest()
+    return super().get_export_source_key()
+
   _tr_imagesassetdata_name = TR_preppipe.tr("imagesassetdata_name",
     en="Image Asset",
     zh_cn="图片资源",
@@ -2779,6 +2921,8 @@ class AudioAssetData(AssetData[pydub.AudioSegment, str]):
     return self._format
 
   def load_from_storage(self) -> pydub.AudioSegment:
+    if self.zip_source is not None:
+      return pydub.AudioSegment.from_file(io.BytesIO(self._read_zip_source()), format = self._format)
     return pydub.AudioSegment.from_file(self._backing_store_path, format = self._format)
 
   def export(self, dest_path: str) -> None:
@@ -2790,11 +2934,30 @@ class AudioAssetData(AssetData[pydub.AudioSegment, str]):
       self._data.export(dest_path, format=fmt)
       return
     if fmt == self._format:
-      shutil.copy2(self._backing_store_path, dest_path, follow_symlinks=False)
+      if self.zip_source is not None:
+        self._export_zip_source(dest_path)
+      else:
+        shutil.copy2(self._backing_store_path, dest_path, follow_symlinks=False)
     else:
-      data : pydub.AudioSegment = pydub.AudioSegment.from_file(self._backing_store_path, format = self._format)
+      data : pydub.AudioSegment = self.load_from_storage()
       data.export(dest_path, format=fmt)
 
+  def get_export_passthrough_path(self, dest_path : str) -> str | None:
+    if self._data is not None or self._zip_source is not None:
+      return None
+    _basepath, ext = os.path.splitext(dest_path)
+    if ext[1:].lower() == self._format:
+      return self._backing_store_path
+    return None
+
+  def get_export_source_key(self) -> str | None:
+    if self._data is not None:
+      h = hashlib.sha256()
+      h.update((str(self._data.frame_rate) + ':' + str(self._data.sample_width) + ':' + str(self._data.channels) + ':').encode('utf-8'))
+      h.update(self._data.raw_data)
+      return 'audio:' + h.hexdigest()
+    return super().get_export_source_key()
+
   _tr_audiosassetdata_name = TR_preppipe.tr("audiosassetdata_name",
     en="Audio Asset",
     zh_cn="音频资源",
@@ -30,6 +30,9 @@ import traceback
 class TranslationDomain:
   ALL_DOMAINS : typing.ClassVar[dict[str, TranslationDomain]] = {}
   SUPPORTED_LANGNAMES : typing.ClassVar[tuple[str,...]] = ("en", "zh_cn", "zh_hk")
+  # 有些译段只在需要时才会被读取（比如素材的描述对象，见 NamedAssetClassBase），导出、导入翻译前需要先把它们都读进来
+  # 这里的函数会在 json_dict_export() 和 json_dict_import() 开始时执行
+  PENDING_LOADERS : typing.ClassVar[list[typing.Callable[[], None]]] = []
   name : str
   elements : dict[str, Translatable]
 
@@ -92,6 +95,15 @@ class TranslationDomain:
     domaininst.add_unpickled_translatable(result)
     return result
 
+  @staticmethod
+  def add_pending_loader(loader : typing.Callable[[], None]):
+    TranslationDomain.PENDING_LOADERS.append(loader)
+
+  @staticmethod
+  def run_pending_loaders():
+    for loader in TranslationDomain.PENDING_LOADERS:
+      loader()
+
   def add_unpickled_translatable(self, t : Translatable):
     assert t.parent is self
     assert t.code not in self.elements
@@ -99,6 +111,7 @@ class TranslationDomain:
 
   @staticmethod
   def json_dict_export(domain_filter : str | None = None, name_filter : str | None = None) -> collections.OrderedDict[str, collections.OrderedDict[str, dict[str, list[str]]]]:
+    TranslationDomain.run_pending_loaders()
     if domain_filter is None:
       domains = sorted(TranslationDomain.ALL_DOMAINS.keys())
     else:
@@ -121,6 +134,7 @@ class TranslationDomain:
 
   @staticmethod
   def json_dict_import(d : dict[str, dict[str, dict[str, list[str]]]]):
+    TranslationDomain.run_pending_loaders()
     for dname, ddict in d.items():
       if dname not in TranslationDomain.ALL_DOMAINS:
         continue
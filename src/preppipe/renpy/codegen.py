@@ -1161,6 +1161,7 @@ class _RenPyCodeGenHelper(BackendCodeGenHelperBase[RenPyNode]):
       n = self.model.namespace.get(k)
       assert isinstance(n, VNNamespace)
       self.move_to_ns(n)
+      self.prefetch_imagepacks(n)
       self.handle_all_devices()
       self.label_all_functions()
       self.handle_all_values()
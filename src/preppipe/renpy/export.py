@@ -1,8 +1,6 @@
 # SPDX-FileCopyrightText: 2023 PrepPipe's Contributors
 # SPDX-License-Identifier: Apache-2.0
 
-import io
-
 from preppipe.renpy.ast import RenPyASMNode, RenPyScriptFileOp
 from preppipe.renpy.transform import *
 from .ast import *
@@ -12,18 +10,21 @@ from ..enginecommon.export import *
 class RenPyExportVisitor(RenPyASTVisitor):
   indent_level : int
   indent_width : int # 每一层缩进的空格数量
-  dest : io.TextIOBase
-  def __init__(self, dest : io.TextIOBase, indent_width : int = 4) -> None:
+  dest : list[str] # 输出的各个片段，最后一次性拼接，比逐个写入文件快
+  def __init__(self, indent_width : int = 4) -> None:
     super().__init__()
     self.indent_level = 0
     self.indent_width = indent_width
-    self.dest = dest
+    self.dest = []
     assert indent_width > 0
 
+  def get_result(self) -> str:
+    return ''.join(self.dest)
+
   def start_visit(self, v: RenPyScriptFileOp) -> None:
     self.indent_level = 0
     self.walk_body(v.body, no_leading_newline=True)
-    self.dest.write('\n')
+    self.dest.append('\n')
 
   @staticmethod
   def drop_leading_ws(s : str, numws : int) -> str:
@@ -186,7 +187,7 @@ class RenPyExportVisitor(RenPyASTVisitor):
     for op in b.body:
       if isinstance(op, RenPyNode):
         if not no_leading_newline:
-          self.dest.write(self.get_eol_with_ws())
+          self.dest.append(self.get_eol_with_ws())
         else:
           no_leading_newline = False
         op.accept(self)
@@ -195,10 +196,10 @@ class RenPyExportVisitor(RenPyASTVisitor):
         msg : str = op.error_message.get_string()
         fullmsg = msg + ' (' + code + ')'
         if not no_leading_newline:
-          self.dest.write(self.get_eol_with_ws())
+          self.dest.append(self.get_eol_with_ws())
         else:
           no_leading_newline = False
-        self.dest.write(self.RENPY_ERROR_SAYER_CUR.get() + " \"" + self.escapestr(fullmsg) + '"')
+        self.dest.append(self.RENPY_ERROR_SAYER_CUR.get() + " \"" + self.escapestr(fullmsg) + '"')
       elif isinstance(op, MetadataOp):
         if isinstance(op, CommentOp):
           content = op.comment.get_string()
@@ -206,10 +207,10 @@ class RenPyExportVisitor(RenPyASTVisitor):
           content = str(op)
         for s in content.split('\n'):
           if not no_leading_newline:
-            self.dest.write(self.get_eol_with_ws())
+            self.dest.append(self.get_eol_with_ws())
           else:
             no_leading_newline = False
-          self.dest.write('# ' + s)
+          self.dest.append('# ' + s)
       else:
         raise NotImplementedError("TODO")
 
@@ -219,8 +220,8 @@ class RenPyExportVisitor(RenPyASTVisitor):
     if len(b.body) > 0:
       self.walk_body(b)
     else:
-      self.dest.write(self.get_eol_with_ws())
-      self.dest.write("pass")
+      self.dest.append(self.get_eol_with_ws())
+      self.dest.append("pass")
     self.indent_level = cur_level
 
   def collect_strings(self, o : OpOperand[StringLiteral]) -> list[str]:
@@ -229,10 +230,10 @@ class RenPyExportVisitor(RenPyASTVisitor):
   def visitRenPyASMNode(self, v: RenPyASMNode):
     # 以这种方式碰到的 ASM 都视为 RenPy 脚本
     # 需要 Python 内容的地方都会由父节点直接处理
-    self.dest.write(self.stringtize_multiline_asm(v.asm.get(), False))
+    self.dest.append(self.stringtize_multiline_asm(v.asm.get(), False))
 
   def visitRenPyASMExpr(self, v : RenPyASMExpr):
-    self.dest.write(v.get_string())
+    self.dest.append(v.get_string())
 
   def visitRenPyCharacterExpr(self, v : RenPyCharacterExpr):
     if v.displayname.try_get_value():
@@ -273,11 +274,11 @@ class RenPyExportVisitor(RenPyASTVisitor):
         p = v.show_params.get_operand(i)
         params.append(p.get_string())
       pieces.append(', ' + ', '.join(params))
-    self.dest.write(''.join(pieces))
-    self.dest.write(')')
+    self.dest.append(''.join(pieces))
+    self.dest.append(')')
 
   def visitRenPyImageNode(self, v : RenPyImageNode):
-    self.dest.write('image ' + ' '.join(self.collect_strings(v.codename)) + ' = ')
+    self.dest.append('image ' + ' '.join(self.collect_strings(v.codename)) + ' = ')
     self.visitRenPyASMExpr(v.displayable.get())
 
   def visitRenPySayNode(self, v : RenPySayNode):
@@ -308,22 +309,22 @@ class RenPyExportVisitor(RenPyASTVisitor):
       if len(s) > 0:
         pieces.append('with')
         pieces.append(s)
-    self.dest.write(' '.join(pieces))
+    self.dest.append(' '.join(pieces))
     return None
 
   def visitRenPyLabelNode(self, v : RenPyLabelNode):
-    self.dest.write(self.get_eol_with_ws())
-    self.dest.write('label ' + v.codename.get().get_string())
+    self.dest.append(self.get_eol_with_ws())
+    self.dest.append('label ' + v.codename.get().get_string())
     if v.parameters.has_value():
-      self.dest.write('(')
-      self.dest.write(','.join(self.collect_strings(v.parameters)))
-      self.dest.write(')')
-    self.dest.write(':')
+      self.dest.append('(')
+      self.dest.append(','.join(self.collect_strings(v.parameters)))
+      self.dest.append(')')
+    self.dest.append(':')
     self.walk_body_with_incr_level(v.body)
 
   def visitRenPyDefineNode(self, v : RenPyDefineNode):
     assignstr = '=' if v.assign_operator.try_get_value() is None else v.assign_operator.get().get_string()
-    self.dest.write('define ' + v.get_varname_str() + ' ' + assignstr + ' ')
+    self.dest.append('define ' + v.get_varname_str() + ' ' + assignstr + ' ')
     value = v.expr.get()
     if isinstance(value, RenPyCharacterExpr):
       self.visitRenPyCharacterExpr(value)
@@ -335,7 +336,7 @@ class RenPyExportVisitor(RenPyASTVisitor):
     return None
 
   def visitRenPyDefaultNode(self, v : RenPyDefaultNode):
-    self.dest.write('default ' + v.get_varname_str() + ' = ' + v.expr.get().get_string())
+    self.dest.append('default ' + v.get_varname_str() + ' = ' + v.expr.get().get_string())
 
   def visitRenPyShowNode(self, v : RenPyShowNode):
     pieces = ["show"]
@@ -355,30 +356,30 @@ class RenPyExportVisitor(RenPyASTVisitor):
     if onlayer := v.onlayer.try_get_value():
       pieces.append('onlayer')
       pieces.append(onlayer.get_string())
-    self.dest.write(' '.join(pieces))
+    self.dest.append(' '.join(pieces))
     if with_ := v.with_.try_get_value():
-      self.dest.write(' ')
+      self.dest.append(' ')
       self.visitRenPyWithNode(with_)
 
   def visitRenPySceneNode(self, v : RenPySceneNode):
-    self.dest.write('scene ' + ' '.join(self.collect_strings(v.imspec)))
+    self.dest.append('scene ' + ' '.join(self.collect_strings(v.imspec)))
     if with_ := v.with_.try_get_value():
-      self.dest.write(' ')
+      self.dest.append(' ')
       self.visitRenPyWithNode(with_)
     if atl := v.atl.try_get_value():
-      self.dest.write(':')
+      self.dest.append(':')
       curlevel = self.indent_level
       self.indent_level += 1
-      self.dest.write(self.get_eol_with_ws())
+      self.dest.append(self.get_eol_with_ws())
       self.visitRenPyASMNode(atl)
       self.indent_level = curlevel
 
   def visitRenPyHideNode(self, v : RenPyHideNode):
-    self.dest.write('hide ' + ' '.join(self.collect_strings(v.imspec)))
+    self.dest.append('hide ' + ' '.join(self.collect_strings(v.imspec)))
     if onlayer := v.onlayer.try_get_value():
-      self.dest.write('onlayer ' + onlayer.get_string())
+      self.dest.append('onlayer ' + onlayer.get_string())
     if with_ := v.with_.try_get_value():
-      self.dest.write(' ')
+      self.dest.append(' ')
       self.visitRenPyWithNode(with_)
 
   def visitRenPyPlayNode(self, v : RenPyPlayNode):
@@ -391,70 +392,70 @@ class RenPyExportVisitor(RenPyASTVisitor):
     if fadeout := v.fadeout.try_get_value():
       result.append('fadeout')
       result.append(str(fadeout.value))
-    self.dest.write(' '.join(result))
+    self.dest.append(' '.join(result))
 
   def visitRenPyStopNode(self, v : RenPyStopNode):
-    self.dest.write('stop ' + v.channel.get().get_string())
+    self.dest.append('stop ' + v.channel.get().get_string())
 
   def visitRenPyVoiceNode(self, v : RenPyVoiceNode):
-    self.dest.write('voice ' + v.audiospec.get().get_string())
+    self.dest.append('voice ' + v.audiospec.get().get_string())
 
   def visitRenPyWithNode(self, v : RenPyWithNode):
-    self.dest.write('with ' + ' '.join(self.collect_strings(v.expr)))
+    self.dest.append('with ' + ' '.join(self.collect_strings(v.expr)))
 
   def visitRenPyCallNode(self, v : RenPyCallNode):
-    self.dest.write('call ')
+    self.dest.append('call ')
     if is_expr_l := v.is_expr.try_get_value():
       if is_expr_l.value:
-        self.dest.write("expression ")
-    self.dest.write(v.label.get().get_string())
+        self.dest.append("expression ")
+    self.dest.append(v.label.get().get_string())
     if v.arguments.has_value():
-      self.dest.write('(')
-      self.dest.write(','.join(self.collect_strings(v.arguments)))
-      self.dest.write(')')
+      self.dest.append('(')
+      self.dest.append(','.join(self.collect_strings(v.arguments)))
+      self.dest.append(')')
 
   def visitRenPyReturnNode(self, v : RenPyReturnNode):
-    self.dest.write("return")
+    self.dest.append("return")
     if retval := v.expr.try_get_value():
-      self.dest.write(' ' + retval.get_string())
+      self.dest.append(' ' + retval.get_string())
 
   def visitRenPyJumpNode(self, v : RenPyJumpNode):
-    self.dest.write("jump ")
+    self.dest.append("jump ")
     if is_expr_l := v.is_expr.try_get_value():
       if is_expr_l.value:
-        self.dest.write("expression ")
-    self.dest.write(v.target.get().get_string())
+        self.dest.append("expression ")
+    self.dest.append(v.target.get().get_string())
 
   def visitRenPyPassNode(self, v : RenPyPassNode):
-    self.dest.write("pass")
+    self.dest.append("pass")
 
   def visitRenPyMenuItemNode(self, v : RenPyMenuItemNode):
-    self.dest.write('"' + self.stringmarshal(v.label) + '"')
+    self.dest.append('"' + self.stringmarshal(v.label) + '"')
     if arguments := v.arguments.try_get_value():
-      self.dest.write('(' + arguments.get_string() + ')')
+      self.dest.append('(' + arguments.get_string() + ')')
     if condition := v.condition.try_get_value():
-      self.dest.write(" if ")
-      self.dest.write(condition.get_string())
-    self.dest.write(':')
+      self.dest.append(" if ")
+      self.dest.append(condition.get_string())
+    self.dest.append(':')
     self.walk_body_with_incr_level(v.body)
 
   def visitRenPyMenuNode(self, v : RenPyMenuNode):
-    self.dest.write("menu")
+    self.dest.append("menu")
     if varname := v.varname.try_get_value():
       if len(varname.get_string()) > 0:
-        self.dest.write(' ' + varname.get_string())
+        self.dest.append(' ' + varname.get_string())
     if arguments := v.arguments.try_get_value():
-      self.dest.write('(' + arguments.get_string() + ')')
-    self.dest.write(':')
+      self.dest.append('(' + arguments.get_string() + ')')
+    self.dest.append(':')
     if menuset := v.menuset.try_get_value():
-      self.dest.write(self.get_eol_with_ws(1) + 'set ' + menuset.get_string())
+      self.dest.append(self.get_eol_with_ws(1) + 'set ' + menuset.get_string())
     self.walk_body_with_incr_level(v.items)
 
   def visitRenPyCondBodyPair(self, v : RenPyCondBodyPair):
     raise RuntimeError("Should not be visited")
 
   def visitRenPyWhileNode(self, v : RenPyWhileNode):
-    self.dest.write('while ' + v.condition.get().get_string() + ':')
+    self.dest.append('while ' + v.condition.get().get_string() + ':')
     self.walk_body_with_incr_level(v.body)
 
   def visitRenPyIfNode(self, v : RenPyIfNode):
@@ -463,37 +464,37 @@ class RenPyExportVisitor(RenPyASTVisitor):
       assert isinstance(branch, RenPyCondBodyPair)
       if condition := branch.condition.try_get_value():
         if is_first_branch:
-          self.dest.write('if ')
+          self.dest.append('if ')
           is_first_branch = False
         else:
-          self.dest.write(self.get_eol_with_ws())
-          self.dest.write('elif ')
-        self.dest.write(condition.get_string() + ':')
+          self.dest.append(self.get_eol_with_ws())
+          self.dest.append('elif ')
+        self.dest.append(condition.get_string() + ':')
       else:
         if is_first_branch:
           raise RuntimeError("if statement without condition")
-        self.dest.write(self.get_eol_with_ws())
-        self.dest.write('else:')
+        self.dest.append(self.get_eol_with_ws())
+        self.dest.append('else:')
       self.walk_body_with_incr_level(branch.body)
 
   def visitRenPyInitNode(self, v : RenPyInitNode):
-    self.dest.write('init')
+    self.dest.append('init')
     if priority := v.priority.try_get_value():
-      self.dest.write(' ' + str(priority.value))
+      self.dest.append(' ' + str(priority.value))
     if code := v.pythoncode.try_get_value():
       # init python
-      self.dest.write(' python:')
+      self.dest.append(' python:')
       curlevel = self.indent_level
       self.indent_level += 1
       asmstr = self.stringtize_multiline_asm(code.asm.get(), False)
       if len(asmstr) == 0:
         asmstr = "pass"
-      self.dest.write(self.get_eol_with_ws())
-      self.dest.write(asmstr)
+      self.dest.append(self.get_eol_with_ws())
+      self.dest.append(asmstr)
       self.indent_level = curlevel
     else:
       # init
-      self.dest.write(':')
+      self.dest.append(':')
       self.walk_body_with_incr_level(v.body)
 
 #  def visitRenPyTransformNode(self, v : RenPyTransformNode):
@@ -504,23 +505,23 @@ class RenPyExportVisitor(RenPyASTVisitor):
     # 否则使用 python 块
     asm = v.code.get().asm.get()
     if len(asm.value) == 0:
-      self.dest.write('$ # No code')
+      self.dest.append('$ # No code')
       return
     if asm.has_single_value():
       if not v.store.has_value() and not v.hide.has_value():
-        self.dest.write(self.stringtize_multiline_asm(asm, True))
+        self.dest.append(self.stringtize_multiline_asm(asm, True))
         return
-    self.dest.write("python")
+    self.dest.append("python")
     if hide := v.hide.try_get_value():
       if hide.value:
-        self.dest.write(" hide")
+        self.dest.append(" hide")
     if store := v.store.try_get_value():
-      self.dest.write(" in " + store.get_string())
-    self.dest.write(':')
+      self.dest.append(" in " + store.get_string())
+    self.dest.append(':')
     curlevel = self.indent_level
     self.indent_level += 1
-    self.dest.write(self.get_eol_with_ws())
-    self.dest.write(self.stringtize_multiline_asm(asm, False))
+    self.dest.append(self.get_eol_with_ws())
+    self.dest.append(self.stringtize_multiline_asm(asm, False))
     self.indent_level = curlevel
 
   def visitRenPyEarlyPythonNode(self, v : RenPyEarlyPythonNode):
@@ -528,42 +529,40 @@ class RenPyExportVisitor(RenPyASTVisitor):
     asm = v.code.get().asm.get()
     if len(asm.value) == 0:
       return
-    self.dest.write('python early:')
+    self.dest.append('python early:')
     curlevel = self.indent_level
     self.indent_level += 1
-    self.dest.write(self.get_eol_with_ws())
-    self.dest.write(self.stringtize_multiline_asm(asm, False))
+    self.dest.append(self.get_eol_with_ws())
+    self.dest.append(self.stringtize_multiline_asm(asm, False))
     self.indent_level = curlevel
 
-def export_renpy(m : RenPyModel, out_path : str, template_dir : str = '') -> None:
+def render_renpy_script(script : RenPyScriptFileOp) -> str:
+  exporter = RenPyExportVisitor(indent_width=4)
+  exporter.start_visit(script)
+  return exporter.get_result()
+
+def export_renpy(m : RenPyModel, out_path : str, template_dir : str = '', asset_jobs : int = 0, asset_placement : str = "copy", script_jobs : int = 0, script_processes : bool = False) -> None:
   assert isinstance(m, RenPyModel)
   os.makedirs(out_path, exist_ok=True)
   # step 1: copy the template directory and the runtime
+  # 所有文件都只在内容有变化时才写入，否则 Ren'Py 会因为修改时间变了而重新编译所有脚本
   if len(template_dir) > 0:
-    shutil.copytree(template_dir, out_path, dirs_exist_ok=True)
+    copy_template_dir(template_dir, out_path)
   # now copy the runtime
   rtname = 'preppipert.rpy'
   rtsrc = os.path.join(os.path.dirname(os.path.abspath(__file__)), rtname)
   rtdest = os.path.join(out_path, rtname)
   rttitle = '# PrepPipe ' + versioning.get_version_string() + '\n'
-  with open(rtdest, 'w', encoding="utf-8") as dst:
-    dst.write(rttitle)
-    with open(rtsrc, 'r', encoding="utf-8") as src:
-      all = src.read()
-      dst.write(all)
+  with open(rtsrc, 'r', encoding="utf-8") as src:
+    write_text_if_changed(rtdest, rttitle + src.read())
 
   # step 2: start walking all script files
   # apply the default transform to make output nicer
   apply_default_renpy_transform(m)
-  for script in m.scripts():
-    scriptpath = os.path.join(out_path, script.name + '.rpy')
-    parentdir = os.path.dirname(scriptpath)
-    os.makedirs(parentdir, exist_ok=True)
-    with open(scriptpath, 'w', encoding="utf-8") as f:
-      exporter = RenPyExportVisitor(f, indent_width=4)
-      exporter.start_visit(script)
-
-  export_assets_and_cacheable(m, out_path=out_path)
+  scripts = [(os.path.join(out_path, script.name + '.rpy'), script) for script in m.scripts()]
+  export_scripts(scripts, render_renpy_script, num_workers=script_jobs, use_processes=script_processes)
+
+  export_assets_and_cacheable(m, out_path=out_path, num_workers=asset_jobs, placement=asset_placement)
   # done for now
 
 def apply_default_renpy_transform(m : RenPyModel):
@@ -13,6 +13,7 @@ from ..irbase import *
 from ..exceptions import PPInternalError
 from ..util.message import MessageHandler
 from .export import export_renpy
+from ..enginecommon.export import ASSET_PLACEMENT_MODES
 from .codegen import codegen_renpy
 from ..vnmodel import VNModel
 
@@ -178,10 +179,18 @@ class _TestVNModelBuild(TransformBase):
 @BackendDecl('renpy-export', input_decl=RenPyModel, output_decl=IODecl(description='<output directory>', nargs=1))
 class _RenPyExport(TransformBase):
   _template_dir : typing.ClassVar[str] = ""
+  _asset_jobs : typing.ClassVar[int] = 0
+  _asset_placement : typing.ClassVar[str] = "copy"
+  _script_jobs : typing.ClassVar[int] = 0
+  _script_processes : typing.ClassVar[bool] = False
 
   @staticmethod
   def install_arguments(argument_group : argparse._ArgumentGroup):
     argument_group.add_argument("--renpy-export-templatedir", nargs=1, type=str, default='')
+    argument_group.add_argument("--renpy-export-asset-jobs", type=int, default=0, help="Number of threads for exporting assets (0: default, 1: no threading)")
+    argument_group.add_argument("--renpy-export-asset-placement", choices=ASSET_PLACEMENT_MODES, default="copy", help="How to place unconverted asset files in the output directory (hardlink/reflink fall back to copy if unsupported)")
+    argument_group.add_argument("--renpy-export-script-jobs", type=int, default=0, help="Number of workers for generating script files (0: default, 1: one by one)")
+    argument_group.add_argument("--renpy-export-script-processes", action="store_true", help="Generate script files in forked processes instead of threads (only on platforms supporting fork and when no other thread is running)")
 
   @staticmethod
   def handle_arguments(args : argparse.Namespace):
@@ -192,6 +201,10 @@ class _RenPyExport(TransformBase):
     assert isinstance(_RenPyExport._template_dir, str)
     if len(_RenPyExport._template_dir) > 0 and not os.path.isdir(_RenPyExport._template_dir):
       raise PPInternalError('--renpy-export-templatedir: input "' + _RenPyExport._template_dir + '" is not a valid path')
+    _RenPyExport._asset_jobs = args.renpy_export_asset_jobs
+    _RenPyExport._asset_placement = args.renpy_export_asset_placement
+    _RenPyExport._script_jobs = args.renpy_export_script_jobs
+    _RenPyExport._script_processes = args.renpy_export_script_processes
 
   def run(self) -> None:
     if len(self._inputs) == 0:
@@ -204,7 +217,7 @@ class _RenPyExport(TransformBase):
         raise PPInternalError("renpy-export: exporting to non-directory path: " + out_path)
     # 若输出目录尚无完整 Ren'Py 工程（无 gui.rpy），则用内嵌 SDK 先生成空工程与 GUI 图片
     _ensure_renpy_project_generated(out_path, _renpy_launcher_language_from_env())
-    return export_renpy(self.inputs[0], out_path, _RenPyExport._template_dir)
+    return export_renpy(self.inputs[0], out_path, _RenPyExport._template_dir, asset_jobs=_RenPyExport._asset_jobs, asset_placement=_RenPyExport._asset_placement, script_jobs=_RenPyExport._script_jobs, script_processes=_RenPyExport._script_processes)
 
 @MiddleEndDecl('renpy-codegen', input_decl=VNModel, output_decl=RenPyModel)
 class _RenPyCodeGen(TransformBase):
@@ -1,6 +1,25 @@
 # SPDX-FileCopyrightText: 2022-2023 PrepPipe's Contributors
 # SPDX-License-Identifier: Apache-2.0
 
+import os
+import time
+import typing
+import decimal
+import shutil
+import tempfile
+
+import odf.opendocument
+import odf.style
+import odf.text
+import odf.element
+import numpy as np
+import PIL.Image
+import PIL.ImageDraw
+import PIL.ImageFilter
+import psd_tools
+import psd_tools.api.layers
+import psd_tools.constants
+
 from .pipeline import *
 from .irbase import *
 from .vnmodel import *
@@ -8,6 +27,14 @@ from .imageexpr import *
 from .analysis.icfg import *
 from .analysis.vnmodel.timemodel import *
 from .analysis.vnmodel.assetusage import AssetUsage
+from .inputmodel import IMDocumentOp
+from .frontend.opendocument import parse_odf
+from .frontend.commandsyntaxparser import perform_command_parse_transform
+from .frontend.vnmodel.vnast import VNAST
+from .frontend.vnmodel.vnparser import VNParser
+from .frontend.vnmodel.vnincremental import VNIncrementalParser
+from .util.imagepack import ImagePack, ImageWrapper, LayerBlendMode, DecodedImageCache, _PSDLayerCache
+from .util.imageblend import alpha_composite_inplace, multiply_composite_inplace
 
 # 这是开发早期用来创建测试用 VNModel 的代码，现在已经不需要这些了。
 @FrontendDecl('test-vnmodel-build', input_decl=IODecl(description='<No Input>', nargs=0), output_decl=VNModel)
@@ -56,3 +83,439 @@ class _TestVNModelBuild(TransformBase):
     usage = AssetUsage.build(model, graph, tm)
     print(str(usage))
     return model
+
+# 比较 OpenDocument 前端合并为一遍的解析后变换（fused_transform=True）与依次执行各个变换（默认）的结果
+# 每个输入文件用两种方式各解析一次，输出的 IR 不同时报错，并打印两者的耗时；返回依次变换的结果
+# test-odf-fused-transform-generated 不需要输入，使用 _write_odf_transform_test_document() 生成的文档，覆盖四个变换的各种情况
+def _write_odf_transform_test_document(path : str, repeat : int = 1):
+  # 生成一个包含以下内容的 OpenDocument 文档（重复 repeat 次）：
+  # 相邻的同样式文本、整段或部分划掉的文本、相邻的高亮段落（特殊块）、需要合并或嵌套的列表、只靠缩进表示层级的（“压扁”的）列表
+  doc = odf.opendocument.OpenDocumentText()
+  def add_paragraph_style(name : str, paragraph_properties : dict | None = None, list_style : str | None = None, **text_properties):
+    style = odf.style.Style(name=name, family="paragraph", **({"liststylename": list_style} if list_style is not None else {}))
+    if paragraph_properties is not None:
+      style.addElement(odf.style.ParagraphProperties(**paragraph_properties))
+    if len(text_properties) > 0:
+      style.addElement(odf.style.TextProperties(**text_properties))
+    doc.automaticstyles.addElement(style)
+  def add_text_style(name : str, **text_properties):
+    style = odf.style.Style(name=name, family="text")
+    style.addElement(odf.style.TextProperties(**text_properties))
+    doc.automaticstyles.addElement(style)
+  def add_list_style(name : str, level_style : odf.element.Element):
+    style = odf.text.ListStyle(name=name)
+    style.addElement(level_style)
+    doc.automaticstyles.addElement(style)
+  add_paragraph_style("Pn")
+  add_paragraph_style("Strike", textlinethroughstyle="solid")
+  add_paragraph_style("HL", paragraph_properties={"backgroundcolor": "#ffff00"})
+  add_paragraph_style("Ctr", paragraph_properties={"textalign": "center"})
+  add_text_style("B", fontweight="bold")
+  add_text_style("I", fontstyle="italic")
+  add_text_style("S", textlinethroughstyle="solid")
+  add_list_style("LB", odf.text.ListLevelStyleBullet(level=1, bulletchar="*"))
+  add_list_style("LN", odf.text.ListLevelStyleNumber(level=1, numformat="1"))
+  for i, margin in enumerate(["0.5in", "1in", "1.5in"]):
+    add_paragraph_style("M" + str(i), paragraph_properties={"marginleft": margin}, list_style="LB")
+  def add_paragraph(style : str, *parts : str | tuple[str, str]):
+    p = odf.text.P(stylename=style)
+    for part in parts:
+      if isinstance(part, tuple):
+        p.addElement(odf.text.Span(stylename=part[0], text=part[1]))
+      else:
+        p.addText(part)
+    doc.text.addElement(p)
+  def create_list(style : str | None, items : list) -> odf.element.Element:
+    # items 中每一项为文本（使用 Pn 样式）、(段落样式, 文本) 或者子列表
+    l = odf.text.List(stylename=style) if style is not None else odf.text.List()
+    for item in items:
+      li = odf.text.ListItem()
+      if isinstance(item, list):
+        li.addElement(create_list(None, item))
+      elif isinstance(item, tuple):
+        li.addElement(odf.text.P(stylename=item[0], text=item[1]))
+      else:
+        li.addElement(odf.text.P(stylename="Pn", text=item))
+      l.addElement(li)
+    return l
+  def add_list(style : str | None, items : list):
+    doc.text.addElement(create_list(style, items))
+  for _ in range(repeat):
+    add_paragraph("Pn", "hello ", ("B", "bold"), ("B", " more bold"), " plain", ("I", "it"), " tail")
+    add_paragraph("Strike", "all gone")
+    add_paragraph("Pn", "keep ", ("S", "struck"), " this")
+    add_paragraph("Pn")
+    add_paragraph("HL", "hl1 ", ("B", "x"), "y")
+    add_paragraph("HL", "hl2")
+    add_paragraph("Ctr", "centered")
+    add_paragraph("Pn", "normal")
+    add_paragraph("HL", "lonely")
+    add_list("LB", ["a", "b"])
+    add_list("LN", [["x", "y"]])
+    add_list("LB", ["c"])
+    add_paragraph("Pn", "between")
+    add_list("LN", ["n1", "n2"])
+    add_list("LN", ["n1", "n3"])
+    add_paragraph("Pn")
+    add_list("LB", [("Strike", "gone item"), "kept item"])
+    add_paragraph("Pn")
+    add_list("LB", [("M0", "L0a"), ("M1", "L1a"), ("M2", "L2a"), ("M1", "L1b"), ("M0", "L0b")])
+    add_list("LB", [("M0", "F0"), ("M1", "F1")])
+    add_list("LB", [("M0", "G0")])
+    add_paragraph("Strike", "struck between lists")
+    add_list("LB", [("M1", "G1")])
+  doc.save(path)
+
+def _compare_odf_transforms(context : Context, paths : list[str]) -> list[IMDocumentOp]:
+  results = []
+  for f in paths:
+    start = time.time()
+    staged = parse_odf(context, f, fused_transform=False)
+    staged_time = time.time() - start
+    start = time.time()
+    fused = parse_odf(context, f, fused_transform=True)
+    fused_time = time.time() - start
+    if str(staged) != str(fused):
+      raise PPInternalError("Fused OpenDocument transform result differs from the staged one: " + f)
+    fused.drop_all_references()
+    print(os.path.basename(f) + ": identical; staged " + f"{staged_time:.3f}" + "s, fused " + f"{fused_time:.3f}" + "s")
+    results.append(staged)
+  return results
+
+@FrontendDecl('test-odf-fused-transform', input_decl=IODecl('OpenDocument files', match_suffix=('odt',), nargs='+'), output_decl=IMDocumentOp)
+class _TestODFFusedTransform(TransformBase):
+  def run(self) -> IMDocumentOp | list[IMDocumentOp]:
+    results = _compare_odf_transforms(self.context, self.inputs)
+    if len(results) == 1:
+      return results[0]
+    return results
+
+@FrontendDecl('test-odf-fused-transform-generated', input_decl=IODecl(description='<No Input>', nargs=0), output_decl=IMDocumentOp)
+class _TestODFFusedTransformGenerated(TransformBase):
+  def run(self) -> list[IMDocumentOp]:
+    tmpdir = tempfile.mkdtemp(prefix="preppipe_odf_transform_")
+    try:
+      paths = [os.path.join(tmpdir, "small.odt"), os.path.join(tmpdir, "large.odt")]
+      _write_odf_transform_test_document(paths[0])
+      _write_odf_transform_test_document(paths[1], repeat=200)
+      return _compare_odf_transforms(self.context, paths)
+    finally:
+      shutil.rmtree(tmpdir, ignore_errors=True)
+
+# 检查增量解析（VNIncrementalParser）的结果是否与完整解析相同
+# 输入为 UTF-8 编码的文本或 Markdown 文档，复制到临时目录后依次在文档中间插入一行、修改插入点后的一行、删掉插入的行，
+# 每次修改后分别用增量解析与完整解析处理，输出的 VNAST 不同时报错，并打印每次增量更新的统计信息；返回增量解析的结果
+@FrontendDecl('test-vn-incremental', input_decl=IODecl('Text or Markdown files', match_suffix=('txt', 'md'), nargs='+'), output_decl=VNAST)
+class _TestVNIncrementalParse(TransformBase):
+  def parse_full(self, paths : list[str]) -> VNAST:
+    parser = VNParser.create(self.context)
+    for path in paths:
+      frontend = VNIncrementalParser.FRONTENDS[os.path.splitext(path)[1].lower()](self.context)
+      frontend.set_input([path])
+      doc = frontend.run()
+      assert isinstance(doc, IMDocumentOp)
+      perform_command_parse_transform(doc)
+      parser.add_document(doc)
+    parser.postprocessing()
+    return parser.ast
+
+  def run(self) -> VNAST:
+    tmpdir = tempfile.mkdtemp(prefix="preppipe_vn_incremental_")
+    try:
+      paths = []
+      contents : list[list[str]] = []
+      for f in self.inputs:
+        path = os.path.join(tmpdir, str(len(paths)) + "_" + os.path.basename(f))
+        shutil.copyfile(f, path)
+        paths.append(path)
+        with open(f, "r", encoding="utf-8") as file:
+          contents.append(file.read().splitlines())
+      incparser = VNIncrementalParser(self.context)
+      def write_lines(path : str, lines : list[str]):
+        # 修改时间总是增加，这样即使大小不变（比如删掉插入的行之后）也会被当作修改过
+        mtime = os.stat(path).st_mtime_ns
+        with open(path, "w", encoding="utf-8") as file:
+          file.write("\n".join(lines) + "\n")
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, max(st.st_mtime_ns, mtime + 1000000)))
+      def check(step : str):
+        incparser.reset_stats()
+        start = time.time()
+        ast = incparser.update_files(paths)
+        inc_time = time.time() - start
+        start = time.time()
+        full = self.parse_full(paths)
+        full_time = time.time() - start
+        is_identical = str(ast) == str(full)
+        full.drop_all_references()
+        if not is_identical:
+          raise PPInternalError("Incremental parse result differs from the full parse after step: " + step)
+        print(step + ": identical; incremental " + f"{inc_time:.3f}" + "s (" + str(incparser.num_files_reused) + " reused, " + str(incparser.num_files_spliced) + " spliced, " + str(incparser.num_files_reparsed) + " reparsed, " + str(incparser.num_blocks_reparsed) + " blocks), full " + f"{full_time:.3f}" + "s")
+      check("initial")
+      for path, lines in zip(paths, contents):
+        name = os.path.basename(path)
+        mid = len(lines) // 2
+        edited = lines[:mid] + ["这是插入的一行"] + lines[mid:]
+        write_lines(path, edited)
+        check(name + ": insert line " + str(mid + 1))
+        if mid + 1 < len(edited):
+          edited[mid + 1] += "（已修改）"
+          write_lines(path, edited)
+          check(name + ": modify line " + str(mid + 2))
+        del edited[mid]
+        write_lines(path, edited)
+        check(name + ": delete line " + str(mid + 1))
+      return incparser.ast
+    finally:
+      shutil.rmtree(tmpdir, ignore_errors=True)
+
+# 检查从 PSD 中导出图层组合时，先单独渲染各图层再叠加（ImagePack._use_psd_layer_cache, _PSDLayerCache）的结果是否与每次都调用 psd.composite() 的结果逐位相同
+# 生成的 PSD 包含：穿透组中互相重叠的半透明图层、普通混合模式的组、剪贴蒙版图层、带不透明度的图层、隐藏的图层、正片叠底图层、超出画布的图层
+# 后两种以及普通混合模式的组需要回退到 psd.composite()，检查时也会覆盖到
+def _create_test_layer_image(width : int, height : int, seed : int) -> PIL.Image.Image:
+  # 随机颜色，alpha 为边缘模糊的椭圆，中间部分半透明或不透明，四周全透明
+  rng = np.random.default_rng(seed)
+  mask = PIL.Image.new('L', (width, height))
+  PIL.ImageDraw.Draw(mask).ellipse((5, 5, width - 5, height - 5), fill=int(rng.integers(120, 256)))
+  mask = mask.filter(PIL.ImageFilter.GaussianBlur(3))
+  data = rng.integers(0, 256, (height, width, 4), dtype=np.uint8)
+  data[..., 3] = np.asarray(mask)
+  return PIL.Image.fromarray(data, 'RGBA')
+
+def _create_test_image_pack(seed : int) -> ImagePack:
+  # 随机生成的图片包，有普通图层和正片叠底图层，部分图层超出画布；组合按 基底/服装/表情 的结构共享前缀
+  rng = np.random.default_rng(seed)
+  width = 300
+  height = 400
+  pack = ImagePack(width, height)
+  for i in range(16):
+    if i == 0:
+      x, y, w, h = 0, 0, width, height
+    else:
+      w = int(rng.integers(30, width))
+      h = int(rng.integers(30, height))
+      x = int(rng.integers(-20, width - w + 20))
+      y = int(rng.integers(-20, height - h + 20))
+    image = _create_test_layer_image(w, h, seed * 100 + i)
+    mode = LayerBlendMode.MULTIPLY if i % 5 == 3 else None
+    pack.layers.append(ImagePack.LayerInfo(ImageWrapper(image=image), x, y, w, h, base=(i < 2), mode=mode))
+  for c in range(24):
+    pack.composites.append(ImagePack.CompositeInfo([0, 1 + c % 2, 3 + (c // 2) % 4, 7 + (c // 8) % 3, 10 + c % 6]))
+  pack.composites.append(ImagePack.CompositeInfo([0]))
+  return pack
+
+@MetaPassDecl('test-image-compositing')
+class _TestImageCompositing(TransformBase):
+  # 检查图层合成的 NumPy 实现（ImagePack._use_numpy_compositing）与 PIL 实现的结果逐位相同
+  def run(self) -> None:
+    rng = np.random.default_rng(0)
+    # 先直接检查 imageblend 中的函数，包括 alpha 的所有组合
+    src_alpha, dst_alpha = np.meshgrid(np.arange(256, dtype=np.uint8), np.arange(256, dtype=np.uint8))
+    for trial in range(4):
+      dst = rng.integers(0, 256, (256, 256, 4), dtype=np.uint8)
+      src = rng.integers(0, 256, (256, 256, 4), dtype=np.uint8)
+      dst[..., 3] = dst_alpha
+      src[..., 3] = src_alpha
+      expected = np.asarray(PIL.Image.alpha_composite(PIL.Image.fromarray(dst, 'RGBA'), PIL.Image.fromarray(src, 'RGBA')))
+      actual = dst.copy()
+      alpha_composite_inplace(actual, src)
+      if not np.array_equal(expected, actual):
+        raise PPInternalError("alpha_composite_inplace() differs from PIL.Image.alpha_composite()")
+      expected = np.asarray(ImagePack.apply_multiply_blend_mode(PIL.Image.fromarray(dst, 'RGBA'), PIL.Image.fromarray(src, 'RGBA')))
+      actual = dst.copy()
+      multiply_composite_inplace(actual, src)
+      if not np.array_equal(expected, actual):
+        raise PPInternalError("multiply_composite_inplace() differs from ImagePack.apply_multiply_blend_mode()")
+    # 然后检查整个图片包的组合，包括批量生成
+    saved_setting = ImagePack._use_numpy_compositing
+    try:
+      for seed in range(3):
+        pack = _create_test_image_pack(seed)
+        ImagePack._use_numpy_compositing = False
+        expected_images = [np.asarray(pack.get_composed_image(i).get().convert('RGBA')) for i in range(len(pack.composites))]
+        ImagePack._use_numpy_compositing = True
+        for i in range(len(pack.composites)):
+          if not np.array_equal(expected_images[i], np.asarray(pack.get_composed_image(i).get().convert('RGBA'))):
+            raise PPInternalError("NumPy compositing differs from PIL for composite " + str(i) + " of test pack " + str(seed))
+        for i, image in pack.compose_many():
+          if not np.array_equal(expected_images[i], np.asarray(image.get().convert('RGBA'))):
+            raise PPInternalError("compose_many() differs from PIL for composite " + str(i) + " of test pack " + str(seed))
+    finally:
+      ImagePack._use_numpy_compositing = saved_setting
+    print("NumPy compositing matches PIL")
+
+@MetaPassDecl('test-mask-optimization')
+class _TestMaskOptimization(TransformBase):
+  # 检查 optimize_masks() 的检查、inverse_pasting() 与 inverse_alpha_composite() 只在有效区域计算时（ImagePack._use_cropped_mask_optimization）与在整张画布上计算的结果逐位相同
+  @staticmethod
+  def add_test_masks(pack : ImagePack, seed : int):
+    # 在整张画布上计算的实现要求基底图层都在画布内
+    rng = np.random.default_rng(seed)
+    inside = [l.offset_x >= 0 and l.offset_y >= 0 and l.offset_x + l.width <= pack.width and l.offset_y + l.height <= pack.height for l in pack.layers]
+    for index, l in enumerate(pack.layers):
+      l.base = index < 4 and inside[index]
+    base_alpha = np.zeros((pack.height, pack.width), dtype=bool)
+    for l in pack.layers:
+      if l.base:
+        base_alpha[l.offset_y:l.offset_y+l.height, l.offset_x:l.offset_x+l.width] |= np.asarray(l.patch.get())[..., 3] > 0
+    covering = PIL.Image.fromarray(base_alpha.astype(np.uint8) * 255, 'L')
+    def add_mask(image : PIL.Image.Image | None, offset_x : int = 0, offset_y : int = 0, applyon : list[int] | None = None):
+      width, height = image.size if image is not None else (pack.width, pack.height)
+      pack.masks.append(ImagePack.MaskInfo(ImageWrapper(image=image) if image is not None else None, Color.get((255, 0, 0)), offset_x, offset_y, width, height, applyon=applyon))
+    # 覆盖整张画布的；刚好覆盖所有基底图层的；比基底图层略小的；随机的；没有图片的
+    add_mask(PIL.Image.new('L', (pack.width + 20, pack.height + 20), 255), -10, -10)
+    add_mask(covering.filter(PIL.ImageFilter.MaxFilter(5)))
+    add_mask(covering.filter(PIL.ImageFilter.MinFilter(5)))
+    add_mask(PIL.Image.fromarray((rng.integers(0, 4, (pack.height // 2, pack.width // 2)) > 0).astype(np.uint8) * 255, 'L'), pack.width // 4, pack.height // 4)
+    add_mask(None)
+    # 只用于某个图层、部分在画布外的
+    for index, l in enumerate(pack.layers):
+      if inside[index] and index > 0:
+        add_mask(PIL.Image.new('L', (l.width + 40, l.height + 40), 255), l.offset_x - 20, l.offset_y - 20, applyon=[index])
+        add_mask(PIL.Image.new('L', (l.width // 2 + 1, l.height), 255), l.offset_x, l.offset_y, applyon=[index])
+        break
+
+  def run(self) -> None:
+    saved_setting = ImagePack._use_cropped_mask_optimization
+    num_covering = 0
+    num_patches = 0
+    try:
+      for seed in range(3):
+        pack = _create_test_image_pack(seed)
+        _TestMaskOptimization.add_test_masks(pack, seed)
+        results = {}
+        for use_cropped in (False, True):
+          ImagePack._use_cropped_mask_optimization = use_cropped
+          results[use_cropped] = pack.get_fully_covering_masks(enable_parallelization=use_cropped)
+        if results[False] != results[True]:
+          raise PPInternalError("Cropped mask check differs for test pack " + str(seed) + ": " + str(results[False]) + " vs " + str(results[True]))
+        num_covering += sum(results[False])
+        for info in pack.composites:
+          if len(info.layers) < 2:
+            continue
+          base = pack.get_composed_image_lower(list(info.layers[:-1])).get().convert('RGBA')
+          result = pack.get_composed_image_lower(list(info.layers)).get().convert('RGBA')
+          for func in (ImagePack.inverse_pasting, ImagePack.inverse_alpha_composite):
+            patches = {}
+            for use_cropped in (False, True):
+              ImagePack._use_cropped_mask_optimization = use_cropped
+              patches[use_cropped] = func(base, result)
+            if (patches[False] is None) != (patches[True] is None) or (patches[False] is not None and not np.array_equal(patches[False], patches[True])):
+              raise PPInternalError("Cropped " + func.__name__ + "() differs for composite " + str(info.layers) + " of test pack " + str(seed))
+            if patches[False] is not None:
+              num_patches += 1
+    finally:
+      ImagePack._use_cropped_mask_optimization = saved_setting
+    if num_covering == 0 or num_patches == 0:
+      raise PPInternalError("Mask optimization test did not cover any fully covering mask or patch")
+    print("Cropped mask optimization matches the full canvas version (" + str(num_covering) + " covering masks, " + str(num_patches) + " patches)")
+
+@MetaPassDecl('test-shrink-pyramid')
+class _TestShrinkPyramid(TransformBase):
+  # 检查 fork_and_shrink() 使用缩小金字塔（ImagePack._use_shrink_pyramid）时的结果：
+  # 比例大于 0.5 时与直接缩小的结果逐位相同；不超过 0.5 时图层的位置和大小相同，像素只在边缘有少量差别
+  # 金字塔的层被 DecodedImageCache 淘汰后重新生成的结果不变
+  MAX_ALPHA_ERROR : typing.ClassVar[int] = 32
+
+  @staticmethod
+  def shrink(pack : ImagePack, ratio : str, use_pyramid : bool) -> list[tuple[tuple[int, int, int, int], np.ndarray]]:
+    saved_setting = ImagePack._use_shrink_pyramid
+    try:
+      ImagePack._use_shrink_pyramid = use_pyramid
+      result = pack.fork_and_shrink(decimal.Decimal(ratio))
+    finally:
+      ImagePack._use_shrink_pyramid = saved_setting
+    return [((l.offset_x, l.offset_y, l.width, l.height), np.asarray(l.patch.get().convert('RGBA'))) for l in result.layers]
+
+  def run(self) -> None:
+    cache = DecodedImageCache.get_instance()
+    saved_budget = cache.budget
+    try:
+      for seed in range(2):
+        pack = _create_test_image_pack(seed)
+        for ratio in ('0.75', '0.6', '0.5', '0.35', '0.25', '0.125'):
+          expected = _TestShrinkPyramid.shrink(pack, ratio, False)
+          actual = _TestShrinkPyramid.shrink(pack, ratio, True)
+          for index, ((expected_geometry, expected_array), (actual_geometry, actual_array)) in enumerate(zip(expected, actual)):
+            if expected_geometry != actual_geometry:
+              raise PPInternalError("Shrink pyramid changed the geometry of layer " + str(index) + " at ratio " + ratio)
+            if decimal.Decimal(ratio) > decimal.Decimal('0.5'):
+              if not np.array_equal(expected_array, actual_array):
+                raise PPInternalError("Shrink pyramid changed layer " + str(index) + " at ratio " + ratio)
+            elif np.abs(expected_array[..., 3].astype(np.int16) - actual_array[..., 3]).max() > _TestShrinkPyramid.MAX_ALPHA_ERROR:
+              raise PPInternalError("Shrink pyramid result too different for layer " + str(index) + " at ratio " + ratio)
+        # 让金字塔的层全部被淘汰，重新生成的结果应该不变
+        expected = _TestShrinkPyramid.shrink(pack, '0.125', True)
+        num_evictions = cache.stats.num_evictions
+        cache.set_budget(1)
+        actual = _TestShrinkPyramid.shrink(pack, '0.125', True)
+        cache.set_budget(saved_budget)
+        if cache.stats.num_evictions == num_evictions:
+          raise PPInternalError("Shrink pyramid levels were not evicted from the image cache")
+        for (expected_geometry, expected_array), (actual_geometry, actual_array) in zip(expected, actual):
+          if expected_geometry != actual_geometry or not np.array_equal(expected_array, actual_array):
+            raise PPInternalError("Shrink pyramid changed after its levels were evicted")
+    finally:
+      cache.set_budget(saved_budget)
+    print("Shrink pyramid results are consistent")
+
+@MetaPassDecl('test-psd-layer-cache')
+class _TestPSDLayerCache(TransformBase):
+  def create_test_psd(self, path : str):
+    psd = psd_tools.PSDImage.new('RGB', (400, 600))
+    seed = 0
+    def add_layer(parent, name : str, width : int, height : int, left : int, top : int) -> psd_tools.api.layers.PixelLayer:
+      nonlocal seed
+      seed += 1
+      layer = psd_tools.api.layers.PixelLayer.frompil(_create_test_layer_image(width, height, seed), psd, name, top, left)
+      parent.append(layer)
+      return layer
+    add_layer(psd, 'body', 380, 580, 10, 10)
+    add_layer(psd, 'shade', 200, 200, 100, 100).clipping_layer = True
+    def add_group(parent, name : str, blend_mode : psd_tools.constants.BlendMode) -> psd_tools.api.layers.Group:
+      # 组的混合模式保存在分组标记中，没有签名的话保存时不会写入混合模式
+      group = psd_tools.api.layers.Group.new(name, parent=parent)
+      group.tagged_blocks.set_data(psd_tools.constants.Tag.SECTION_DIVIDER_SETTING, psd_tools.constants.SectionDivider.OPEN_FOLDER, signature=b'8BIM', blend_mode=blend_mode)
+      group.blend_mode = blend_mode
+      return group
+    face = add_group(psd, 'face', psd_tools.constants.BlendMode.PASS_THROUGH)
+    for groupname, blend_mode in (('eye', psd_tools.constants.BlendMode.PASS_THROUGH), ('mouth', psd_tools.constants.BlendMode.NORMAL), ('brow', psd_tools.constants.BlendMode.PASS_THROUGH)):
+      group = add_group(face, groupname, blend_mode)
+      for k in range(4):
+        layer = add_layer(group, groupname + str(k), 120, 80, 150 + k * 10, 100 + k * 20 + len(groupname) * 30)
+        if k == 2:
+          layer.opacity = 128
+        elif k == 3:
+          layer.visible = False
+    add_layer(psd, 'mul', 300, 300, 50, 50).blend_mode = psd_tools.constants.BlendMode.MULTIPLY
+    add_layer(psd, 'over', 300, 100, -50, 550)
+    psd.save(path)
+
+  def run(self) -> None:
+    tmpdir = tempfile.mkdtemp(prefix="preppipe_psd_layer_cache_")
+    try:
+      path = os.path.join(tmpdir, "test.psd")
+      self.create_test_psd(path)
+      psd = psd_tools.PSDImage.open(path)
+      specs = [['body'], ['body', 'face/eye/eye0', 'face/mouth/mouth1'], ['body', 'shade', 'face/eye/eye2'],
+               ['body', 'face/eye', 'face/brow/brow1'], ['body', 'face/eye/eye3', 'face/mouth'], ['face'],
+               ['body', 'mul'], ['body', 'over', 'face/eye/eye1'], ['shade', 'face/eye/eye0'],
+               ['body', 'face/eye/eye1', 'face/brow/brow2'], ['body', 'face/eye/eye1', 'face/brow/brow0']]
+      layer_cache = _PSDLayerCache(psd)
+      time_full = 0.0
+      time_cached = 0.0
+      for spec in specs:
+        converted_layers = ImagePack._convert_psd_layername_expr(spec)
+        start = time.time()
+        expected = np.asarray(ImagePack._get_psd_composite_image_from_layers(psd, converted_layers))
+        time_full += time.time() - start
+        start = time.time()
+        actual = np.asarray(ImagePack._get_psd_composite_image_from_layers(psd, converted_layers, layer_cache))
+        time_cached += time.time() - start
+        if not np.array_equal(expected, actual):
+          raise PPInternalError("PSD layer cache result differs from psd.composite() for " + str(spec))
+      if layer_cache.num_cached_composites == 0 or layer_cache.num_fallback_composites == 0:
+        raise PPInternalError("PSD layer cache test did not cover both the cached and the fallback path")
+      print(str(len(specs)) + " composites identical (" + str(layer_cache.num_cached_composites) + " from the layer cache, " + str(layer_cache.num_fallback_composites) + " fallback); psd.composite() " + f"{time_full:.3f}" + "s, layer cache " + f"{time_cached:.3f}" + "s")
+    finally:
+      shutil.rmtree(tmpdir, ignore_errors=True)
@@ -6,6 +6,48 @@ import typing
 from ..language import TranslationDomain, Translatable
 from .message import MessageHandler
 
+class FileSearchIndex:
+  # 记录各目录下的文件列表，用于在 FileAccessAuditor.search() 中猜测没有后缀名的文件，避免每次查找都要 os.listdir()
+  # 每个目录的记录在该目录的修改时间 (mtime) 变化后失效，所以同一个实例可以在多次运行间重复使用（比如在 GUI 中）
+  # 目录的记录是在第一次查找时生成的
+  _dir_entries : dict[str, tuple[int, dict[str, list[str]]]] # 目录路径 -> (mtime_ns, 无后缀的文件名 -> [有后缀的文件名])
+  num_hits : int
+  num_misses : int
+
+  def __init__(self) -> None:
+    self._dir_entries = {}
+    self.num_hits = 0
+    self.num_misses = 0
+
+  def get_files_by_stem(self, dirpath : str, stem : str) -> list[str] | None:
+    # 返回 dirpath 目录下所有去掉后缀后与 stem 相同（且有后缀）的文件名，顺序与 os.listdir() 相同
+    # 如果目录不存在则返回 None
+    try:
+      mtime = os.stat(dirpath).st_mtime_ns
+    except OSError:
+      self._dir_entries.pop(dirpath, None)
+      return None
+    if entry := self._dir_entries.get(dirpath):
+      if entry[0] == mtime:
+        self.num_hits += 1
+        return entry[1].get(stem, [])
+    if not os.path.isdir(dirpath):
+      return None
+    self.num_misses += 1
+    stem_dict : dict[str, list[str]] = {}
+    for file in os.listdir(dirpath):
+      root, ext = os.path.splitext(file)
+      if len(ext) > 0:
+        stem_dict.setdefault(root, []).append(file)
+    self._dir_entries[dirpath] = (mtime, stem_dict)
+    return stem_dict.get(stem, [])
+
+  def invalidate(self, dirpath : str | None = None):
+    if dirpath is None:
+      self._dir_entries.clear()
+    else:
+      self._dir_entries.pop(dirpath, None)
+
 class FileAccessAuditor:
   # 该类用于存储所有在读取阶段有关的设置，读取完毕后可扔
 
@@ -13,7 +55,9 @@ class FileAccessAuditor:
   # 如果运行该程序的系统不属于输入文件的作者，我们用这类审计手段来限制可访问的文件的范围
   # 所有的字符串都是绝对路径
   _accessible_directories : set[str] # 绝对路径
+  _accessible_directory_lengths : set[int] # _accessible_directories 中所有路径的长度，用于按前缀查找
   _global_searchroots : list[str]
+  _search_index : FileSearchIndex
   _warn_empty_accessible_paths : Translatable | None # 如果命令行上没有给出搜索路径的话，我们需要在实际有搜索需求时给出“未提供搜索路径”的警告
 
   _tr : typing.ClassVar[TranslationDomain] = TranslationDomain("FileAccessAuditor")
@@ -22,6 +66,7 @@ class FileAccessAuditor:
     realpath = os.path.realpath(v)
     if os.path.isdir(realpath):
       self._accessible_directories.add(realpath)
+      self._accessible_directory_lengths.add(len(realpath))
 
   def add_global_searchpath(self, v : str):
     realpath = os.path.realpath(v)
@@ -34,9 +79,10 @@ class FileAccessAuditor:
 
   def check_is_path_accessible(self, realpath : str) -> bool:
     # 检查 abspath 是否为目录白名单中之一
+    # （即白名单中是否有目录是 abspath 所在目录的前缀，我们只需对白名单中出现过的每种长度查一次前缀）
     parent = os.path.dirname(realpath)
-    for candidate in self._accessible_directories:
-      if os.path.commonprefix([candidate, parent]) == candidate:
+    for length in self._accessible_directory_lengths:
+      if parent[:length] in self._accessible_directories:
         return True
     # 到这就检查失败了
     if self._warn_empty_accessible_paths is not None and len(self._accessible_directories) == 0:
@@ -69,17 +115,16 @@ class FileAccessAuditor:
       # 再解决没有后缀、需要猜的情况
       parent = os.path.dirname(candidate)
       basename = os.path.basename(candidate)
-      if os.path.isdir(parent):
-        for file in os.listdir(parent):
-          if not file.startswith(basename):
-            continue
-          root, ext = os.path.splitext(file)
-          if root == basename and len(ext) > 0:
-            candidatepath = os.path.join(parent, file)
-            if result := filecheckCB(candidatepath):
-              return result
+      if files := self._search_index.get_files_by_stem(parent, basename):
+        for file in files:
+          candidatepath = os.path.join(parent, file)
+          if result := filecheckCB(candidatepath):
+            return result
     return None
 
+  def get_search_index(self) -> FileSearchIndex:
+    return self._search_index
+
   _tr_name = _tr.tr("name",
     en="File access auditor: ",
     zh_cn="文件访问控制信息：",
@@ -113,7 +158,10 @@ class FileAccessAuditor:
   def get_asset_not_found_errmsg(self):
     return self._tr_asset_not_found_general.format(searchpath=str(self._global_searchroots))
 
-  def __init__(self) -> None:
+  def __init__(self, search_index : FileSearchIndex | None = None) -> None:
+    # 如果需要在多个 Context 间共享目录索引（比如 GUI 中多次运行），可以传入同一个 search_index
     self._accessible_directories = set()
+    self._accessible_directory_lengths = set()
     self._global_searchroots = []
+    self._search_index = search_index if search_index is not None else FileSearchIndex()
     self._warn_empty_accessible_paths = None
@@ -9,11 +9,14 @@ import time
 import colorsys
 import datetime
 import base64
+import urllib.parse
 import math
 import itertools
 import collections
 import copy
 import decimal
+import fractions
+import hashlib
 import PIL.Image
 import PIL.ImageDraw
 import PIL.ImageFont
@@ -36,7 +39,12 @@ import re
 import shutil
 import tempfile
 import concurrent.futures
+import threading
 import psd_tools
+import psd_tools.composite
+import psd_tools.api.pil_io
+import psd_tools.api.layers
+import psd_tools.constants
 
 from preppipe.irbase import IRValueMapper, Location, Operation
 
@@ -48,25 +56,191 @@ from ..assets.assetclassdecl import *
 from ..assets.assetmanager import AssetManager
 from ..assets.fileasset import FileAssetPack
 from .message import MessageHandler
+from .imageblend import alpha_composite_inplace, multiply_blend, multiply_composite_inplace, get_clipped_regions
+from .imagepackstore import LayerStore, LAYER_STORE_FILENAME, LAYER_STORE_CODECS
+
+@dataclasses.dataclass
+class DecodedImageCacheStats:
+  num_hits : int = 0
+  num_misses : int = 0
+  num_evictions : int = 0
+  current_bytes : int = 0
+  peak_bytes : int = 0
+
+class DecodedImageCache:
+  # 进程内共用的已解码图片缓存，有文件（或图层存储）作为后备的 ImageWrapper 都通过这里读取
+  # 按字节数限制总大小，超出时按最近最少使用的顺序淘汰；被淘汰的图片下次使用时会重新读取
+  # 默认上限比较保守，处理大量高分辨率图片包时可以用环境变量 PREPPIPE_IMAGE_CACHE_BUDGET_MB 指定（单位 MiB）
+  # 同一张图片也可能以不同的形式（PIL 图片、RGBA 数组）存在，它们各自占用一项
+  # fork_applying_mask() 改色后的图层与 fork_and_shrink() 使用的缩小金字塔的各层也放在这里，没有后备存储，被淘汰后需要重新计算
+  DEFAULT_BUDGET : typing.ClassVar[int] = 512 * 1024 * 1024
+
+  _instance : typing.ClassVar["DecodedImageCache | None"] = None
+  _instance_lock : typing.ClassVar[threading.Lock] = threading.Lock()
+
+  budget : int
+  stats : DecodedImageCacheStats
+  _entries : collections.OrderedDict[tuple, tuple[typing.Any, int]] # 键 -> (值, 字节数)，最近使用的在最后
+  _pending : dict[tuple, concurrent.futures.Future] # 正在读取的项，其他线程等待同一个读取完成而不是重复读取
+  _lock : threading.Lock
+
+  def __init__(self, budget : int) -> None:
+    self.budget = budget
+    self.stats = DecodedImageCacheStats()
+    self._entries = collections.OrderedDict()
+    self._pending = {}
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def get_instance() -> "DecodedImageCache":
+    with DecodedImageCache._instance_lock:
+      if DecodedImageCache._instance is None:
+        budget = DecodedImageCache.DEFAULT_BUDGET
+        if budget_str := os.environ.get("PREPPIPE_IMAGE_CACHE_BUDGET_MB"):
+          budget = int(budget_str) * 1024 * 1024
+        DecodedImageCache._instance = DecodedImageCache(budget)
+      return DecodedImageCache._instance
+
+  @staticmethod
+  def get_size(value : typing.Any) -> int:
+    if isinstance(value, np.ndarray):
+      # 图层存储中映射的数组不占用进程的内存
+      if isinstance(value.base, np.memmap) or isinstance(value, np.memmap):
+        return 0
+      return value.nbytes
+    if isinstance(value, PIL.Image.Image):
+      return value.width * value.height * len(value.getbands())
+    if isinstance(value, ImagePack.LayerInfo):
+      # fork_applying_mask() 生成的图层，图片只保存在 patch.image 中
+      assert value.patch.image is not None
+      return DecodedImageCache.get_size(value.patch.image)
+    if isinstance(value, list):
+      # 缩小金字塔的一层（见 ImagePack.get_pyramid_level()），从文件映射的图层不计入
+      return sum(DecodedImageCache.get_size(l.patch.image) for l in value if l is not None and l.patch.image is not None)
+    raise PPInternalError("Unexpected value type in image cache: " + str(type(value)))
+
+  def set_budget(self, budget : int) -> None:
+    with self._lock:
+      self.budget = budget
+      self._evict()
+
+  def get(self, key : tuple, loader : typing.Callable[[], typing.Any]) -> typing.Any:
+    with self._lock:
+      if (entry := self._entries.get(key)) is not None:
+        self._entries.move_to_end(key)
+        self.stats.num_hits += 1
+        return entry[0]
+      future = self._pending.get(key)
+      is_owner = future is None
+      if future is None:
+        future = concurrent.futures.Future()
+        self._pending[key] = future
+        self.stats.num_misses += 1
+      else:
+        self.stats.num_hits += 1
+    if not is_owner:
+      return future.result()
+    try:
+      value = loader()
+    except BaseException as e:
+      with self._lock:
+        del self._pending[key]
+      future.set_exception(e)
+      raise
+    size = DecodedImageCache.get_size(value)
+    with self._lock:
+      del self._pending[key]
+      self._entries[key] = (value, size)
+      self.stats.current_bytes += size
+      self.stats.peak_bytes = max(self.stats.peak_bytes, self.stats.current_bytes)
+      self._evict()
+    future.set_result(value)
+    return value
+
+  def _evict(self) -> None:
+    # 调用时应该已经持有锁；最近使用的一项总是保留
+    while self.stats.current_bytes > self.budget and len(self._entries) > 1:
+      _, (_, size) = self._entries.popitem(last=False)
+      self.stats.current_bytes -= size
+      self.stats.num_evictions += 1
+
+  def clear(self) -> None:
+    with self._lock:
+      self._entries.clear()
+      self.stats.current_bytes = 0
 
 @dataclasses.dataclass
 class ImageWrapper:
   # 在资源构建和对背景图片包的操作中，我们经常是不需要实际读取图片的，复制就行了
   # 该类用于替代所有需要 PIL.Image.Image 的地方以支持按需读取
   # path 应该指向一个 PNG 文件
-  # 如果 image 和 path 同时不为 None 的话，它们一定是同一张图片
+  # 如果图片存放在单文件图层存储中（见 imagepackstore.py），store 和 store_name 指向该图片，此时 path 为 None
+  # 如果 image 和 path (或 store) 同时不为 None 的话，它们一定是同一张图片
+  # 有后备存储的图片读取后不保存在 image 中，而是放在 DecodedImageCache 里，以便控制内存占用；
+  # 只有没有后备存储（比如运行时生成）的图片才一直保存在 image 中
   image : PIL.Image.Image | None = None
   path : str | None = None
+  store : LayerStore | None = None
+  store_name : str | None = None
+  # path 指向的文件在创建时的 (修改时间, 大小)，用于 DecodedImageCache 的键；文件不存在时为 None
+  file_version : tuple[int, int] | None = dataclasses.field(default=None, compare=False, repr=False)
+
+  def __post_init__(self) -> None:
+    # 只在创建（一般是读取图片包）时检查一次文件，之后每次读取都使用同一个键
+    if self.path is not None and self.file_version is None:
+      try:
+        st = os.stat(self.path)
+        self.file_version = (st.st_mtime_ns, st.st_size)
+      except OSError:
+        # 读取时会报错，这里不需要处理
+        pass
+
+  def get_cache_key(self) -> tuple | None:
+    # 键中包含文件的修改时间和大小，图片包在同一路径上重新构建或写入后，新读取的图片包不会读到缓存中的旧图片
+    if self.store is not None and self.store_name is not None:
+      return (self.store.path, self.store.file_version, self.store_name)
+    if self.path is not None:
+      return (self.path, self.file_version)
+    return None
+
+  def _load(self) -> PIL.Image.Image:
+    if self.store is not None and self.store_name is not None:
+      return self.store.get_image(self.store_name)
+    image = PIL.Image.open(self.path)
+    image.load()
+    return image
 
   def get(self) -> PIL.Image.Image:
     if self.image is not None:
       return self.image
-    image = PIL.Image.open(self.path)
-    self.image = image
-    return image
+    key = self.get_cache_key()
+    if key is None:
+      raise PPInternalError("ImageWrapper without image or backing store")
+    return DecodedImageCache.get_instance().get(key + ("image",), self._load)
+
+  def prefetch(self) -> None:
+    # 预先读取到缓存中（一般在线程池中执行）；不返回图片以免调用者持有引用
+    self.get()
+
+  def get_rgba_array(self) -> np.ndarray:
+    # 返回 RGBA uint8 数组（只读）；图片在图层存储中且未压缩时直接返回文件映射，不需要读取和解码
+    def load_array() -> np.ndarray:
+      if self.store is not None and self.store_name is not None and self.store.get_mode(self.store_name) == "RGBA":
+        return self.store.get_array(self.store_name)
+      # 不经过 get()，以免同一张图片在缓存中同时占两份
+      image = self.image if self.image is not None else self._load()
+      if image.mode != "RGBA":
+        image = image.convert("RGBA")
+      return np.asarray(image)
+    if self.image is not None:
+      return load_array()
+    key = self.get_cache_key()
+    if key is None:
+      raise PPInternalError("ImageWrapper without image or backing store")
+    return DecodedImageCache.get_instance().get(key + ("rgba",), load_array)
 
   def has_backing_store(self) -> bool:
-    return self.path is not None
+    return self.path is not None or (self.store is not None and self.store_name is not None)
 
   def save_png(self, pngpath : str):
     if self.path is not None:
@@ -108,6 +282,304 @@ class ImageCompositionCache:
     self.layers.clear()
     self.min_cached_layer = 0
 
+@dataclasses.dataclass
+class ImageCompositionBatchStats:
+  # ImagePack.compose_many() 的统计信息
+  num_composites : int = 0 # 输出的组合数
+  num_ops : int = 0 # 实际进行的图层合成次数
+  num_ops_saved : int = 0 # 与逐个调用 get_composed_image() 相比省下的图层合成次数
+
+class _CompositionTrieNode:
+  # compose_many() 中用于调度的前缀树结点
+  # 每个结点代表一个图层序列前缀，children 以下一个图层的下标为键
+  __slots__ = ("children", "composites")
+  children : dict[int, "_CompositionTrieNode"]
+  composites : list[int] # 图层序列正好是该前缀的组合
+
+  def __init__(self) -> None:
+    self.children = {}
+    self.composites = []
+
+
+class _PSDLayerCache:
+  # 从同一个 PSD 中导出多个图层组合时使用（见 ImagePack._get_psd_composite_image_from_layers()）
+  # psd.composite() 每次都会把整个图层树重新渲染一遍，而这里每个叶子图层（连同其剪贴蒙版图层）只在自己的区域内渲染一次，
+  # 之后每个组合只需要把选中的图层按顺序叠加即可
+  # 叠加时使用与 psd_tools 中普通混合模式完全相同的公式（运算顺序也相同），穿透组也和 psd_tools 一样先以下方内容为背景在组内合成再叠加，结果与 psd.composite() 逐位相同
+  # 对于不能这样拆开计算的图层（非普通混合模式、带图层样式、在非穿透组中、组本身有蒙版或不透明度等），composite() 返回 None，由调用者改用 psd.composite()
+
+  @dataclasses.dataclass
+  class LeafInfo:
+    layer : typing.Any
+    path : tuple[str, ...]
+    viewport : tuple[int, int, int, int] # 图层能影响到的区域（psd_tools 在合成组时会裁剪到组的边界框，所以这里是图层与所有上级组的边界框的交集）
+    is_simple : bool # 是否可以单独渲染后再叠加
+    groups : tuple[int, ...] # 所在的组（从外到内）在 groups 中的下标
+    clip_base : int | None = None # 如果是剪贴蒙版图层，这是其基底图层的下标（基底是组的话为 -1）
+    clip_layers : list[int] = dataclasses.field(default_factory=list) # 该图层的剪贴蒙版图层的下标
+
+  @dataclasses.dataclass
+  class GroupInfo:
+    layer : typing.Any
+    viewport : tuple[int, int, int, int] # 组内合成时使用的区域（与 psd_tools 相同，是组与所有上级组的边界框的交集）
+
+  # 保留中间结果最多使用的内存（字节）
+  SNAPSHOT_BUDGET : typing.ClassVar[int] = 512 * 1024 * 1024
+
+  psd : psd_tools.PSDImage
+  leaves : list[LeafInfo] # 按合成顺序（从下到上）排列
+  groups : list[GroupInfo]
+  leaves_by_prefix : dict[tuple[str, ...], list[int]] # 叶子图层路径的所有前缀 -> 叶子图层下标
+  patches : dict[tuple[int, tuple[int, ...]], tuple[tuple[int, int, int, int], np.ndarray, np.ndarray, np.ndarray] | None] # (图层下标, 剪贴蒙版图层下标) -> (区域, color, shape, alpha)
+  snapshots : list[tuple[tuple, np.ndarray, np.ndarray]] # 上一个组合每一步叠加后的 (步骤, color, alpha)
+  is_supported : bool
+  num_cached_composites : int
+  num_fallback_composites : int
+
+  def __init__(self, psd : psd_tools.PSDImage) -> None:
+    self.psd = psd
+    self.leaves = []
+    self.groups = []
+    self.leaves_by_prefix = {}
+    self.patches = {}
+    self.snapshots = []
+    self.is_supported = psd.color_mode == psd_tools.constants.ColorMode.RGB and len(psd) > 0
+    self.num_cached_composites = 0
+    self.num_fallback_composites = 0
+    clip_base_map : dict[int, int] = {} # id(剪贴蒙版图层) -> 基底图层下标
+    def visit(group, path : tuple[str, ...], viewport : tuple[int, int, int, int], groups : tuple[int, ...], is_group_simple : bool):
+      for layer in group:
+        curpath = path + (layer.name,)
+        curviewport = _PSDLayerCache.intersect(viewport, layer.bbox)
+        if layer.is_group():
+          if layer.has_clip_layers():
+            for clip_layer in layer.clip_layers:
+              clip_base_map[id(clip_layer)] = -1
+          if curviewport == (0, 0, 0, 0):
+            # psd.composite() 不会进入这样的组，其中的图层也不会被视为匹配
+            continue
+          self.groups.append(_PSDLayerCache.GroupInfo(layer=layer, viewport=curviewport))
+          visit(layer, curpath, curviewport, groups + (len(self.groups) - 1,), is_group_simple and id(layer) not in clip_base_map and _PSDLayerCache.is_group_simple(layer))
+          continue
+        index = len(self.leaves)
+        info = _PSDLayerCache.LeafInfo(layer=layer, path=curpath, viewport=curviewport, is_simple=is_group_simple and _PSDLayerCache.is_leaf_simple(layer), groups=groups)
+        if (clip_base := clip_base_map.get(id(layer))) is not None:
+          info.clip_base = clip_base
+          if clip_base >= 0:
+            self.leaves[clip_base].clip_layers.append(index)
+          else:
+            info.is_simple = False
+        if layer.has_clip_layers():
+          for clip_layer in layer.clip_layers:
+            if clip_layer.is_group():
+              info.is_simple = False
+            else:
+              clip_base_map[id(clip_layer)] = index
+        self.leaves.append(info)
+        for i in range(1, len(curpath) + 1):
+          self.leaves_by_prefix.setdefault(curpath[:i], []).append(index)
+    visit(psd, (), psd.viewbox, (), True)
+
+  @staticmethod
+  def intersect(a : tuple[int, int, int, int], b : tuple[int, int, int, int]) -> tuple[int, int, int, int]:
+    result = (max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3]))
+    if result[0] >= result[2] or result[1] >= result[3]:
+      return (0, 0, 0, 0)
+    return result
+
+  @staticmethod
+  def is_group_simple(group) -> bool:
+    # 组的效果等价于把组内图层直接依次叠加的条件
+    # 只有穿透组满足；普通混合模式的组是先把组内图层单独合成再与下方合成的，组内有重叠的半透明图层时浮点结果会不同
+    if group.blend_mode != psd_tools.constants.BlendMode.PASS_THROUGH:
+      return False
+    if group.opacity != 255 or group.tagged_blocks.get_data(psd_tools.constants.Tag.BLEND_FILL_OPACITY, 255) != 255:
+      return False
+    if group.tagged_blocks.get_data(psd_tools.constants.Tag.KNOCKOUT_SETTING, 0):
+      return False
+    if group.mask is not None and not group.mask.disabled:
+      return False
+    if group.vector_mask is not None and not group.vector_mask.disabled:
+      return False
+    return not group.has_clip_layers() and not group.has_effects()
+
+  @staticmethod
+  def is_leaf_simple(layer) -> bool:
+    # 图层本身的蒙版、不透明度、剪贴蒙版都在单独渲染时处理，这里只需要保证它与下方内容的混合方式是普通的 alpha 合成
+    if layer.blend_mode != psd_tools.constants.BlendMode.NORMAL:
+      return False
+    if layer.tagged_blocks.get_data(psd_tools.constants.Tag.KNOCKOUT_SETTING, 0):
+      return False
+    return not layer.has_effects()
+
+  def match(self, converted_layers : list[list[str]]) -> tuple[list[int], list[bool]]:
+    # 与 _get_psd_composite_image_from_layers() 中 layer_filter 的判断相同：叶子图层的路径以某一项为前缀时选中
+    matched : set[int] = set()
+    converted_layers_used = []
+    for candidate_target in converted_layers:
+      indices = self.leaves_by_prefix.get(tuple(candidate_target))
+      converted_layers_used.append(indices is not None)
+      if indices is not None:
+        matched.update(indices)
+    return (sorted(matched), converted_layers_used)
+
+  def get_patch(self, index : int, clip_layers : tuple[int, ...]) -> tuple[tuple[int, int, int, int], np.ndarray, np.ndarray, np.ndarray] | None:
+    key = (index, clip_layers)
+    if key in self.patches:
+      return self.patches[key]
+    layer = self.leaves[index].layer
+    viewport = self.leaves[index].viewport
+    result = None
+    if viewport != (0, 0, 0, 0):
+      included = set(id(self.leaves[i].layer) for i in clip_layers)
+      included.add(id(layer))
+      color, shape, alpha = psd_tools.composite.composite(layer, color=1.0, alpha=0.0, viewport=viewport, layer_filter=lambda l: id(l) in included, force=True, as_layer=True)
+      result = (viewport, color, shape, alpha)
+    self.patches[key] = result
+    return result
+
+  @staticmethod
+  def apply_patch(color : np.ndarray, alpha : np.ndarray, patch : tuple[tuple[int, int, int, int], np.ndarray, np.ndarray, np.ndarray]) -> None:
+    # 与 psd_tools.composite.Compositor._apply_source() 在普通混合模式、非挖空时的计算相同（运算顺序也相同，以保证浮点结果一致），只是改为原地计算
+    viewport, patch_color, patch_shape, patch_alpha = patch
+    region = (slice(viewport[1], viewport[3]), slice(viewport[0], viewport[2]))
+    color_b = color[region]
+    alpha_b = alpha[region]
+    alpha_new = alpha_b + patch_alpha
+    alpha_new -= alpha_b * patch_alpha
+    # color_t = (shape - alpha) * alpha_b * color_b + alpha * ((1 - alpha_b) * color + alpha_b * color)
+    factor = patch_shape - patch_alpha
+    factor *= alpha_b
+    color_t = factor * color_b
+    mixed = (1.0 - alpha_b) * patch_color
+    mixed += alpha_b * patch_color
+    mixed *= patch_alpha
+    color_t += mixed
+    # color = clip(divide((1 - shape) * alpha_b * color_b + color_t, alpha_new))
+    factor = 1.0 - patch_shape
+    factor *= alpha_b
+    result = factor * color_b
+    result += color_t
+    with np.errstate(divide="ignore", invalid="ignore"):
+      result /= alpha_new
+    result[~np.isfinite(result)] = 1.0
+    np.clip(result, 0.0, 1.0, out=color_b)
+    alpha_b[...] = alpha_new
+
+  @staticmethod
+  def apply_group_source(origin : tuple[int, int], color_0 : np.ndarray, alpha_0 : np.ndarray, color : np.ndarray, alpha : np.ndarray, shape_g : np.ndarray, alpha_g : np.ndarray, patch : tuple[tuple[int, int, int, int], np.ndarray, np.ndarray, np.ndarray]) -> None:
+    # 在穿透组内叠加，与 psd_tools.composite.Compositor._apply_source() 在组内（背景 alpha 不为 0）时的计算相同
+    # 所有数组都以 origin 为左上角，patch 的区域在数组的范围内
+    viewport, patch_color, patch_shape, patch_alpha = patch
+    region = (slice(viewport[1] - origin[1], viewport[3] - origin[1]), slice(viewport[0] - origin[0], viewport[2] - origin[0]))
+    shape_g[region] = shape_g[region] + patch_shape - (shape_g[region] * patch_shape)
+    alpha_g[region] = alpha_g[region] + patch_alpha - (alpha_g[region] * patch_alpha)
+    alpha_b = alpha[region]
+    color_b = color[region]
+    alpha_new = alpha_0[region] + alpha_g[region] - (alpha_0[region] * alpha_g[region])
+    color_t = (patch_shape - patch_alpha) * alpha_b * color_b + patch_alpha * ((1.0 - alpha_b) * patch_color + alpha_b * patch_color)
+    with np.errstate(divide="ignore", invalid="ignore"):
+      result = ((1.0 - patch_shape) * alpha_b * color_b + color_t) / alpha_new
+    result[~np.isfinite(result)] = 1.0
+    np.clip(result, 0.0, 1.0, out=color_b)
+    alpha_b[...] = alpha_new
+
+  def composite_group(self, origin : tuple[int, int], color_b : np.ndarray, alpha_b : np.ndarray, group_index : int, children : tuple) -> tuple[tuple[int, int, int, int], np.ndarray, np.ndarray, np.ndarray]:
+    # 与 psd_tools 合成穿透组的过程相同：以组所在区域的当前内容为背景依次叠加组内图层，然后从结果中去掉背景的部分，作为一个图层叠加到外面
+    viewport = self.groups[group_index].viewport
+    region = (slice(viewport[1] - origin[1], viewport[3] - origin[1]), slice(viewport[0] - origin[0], viewport[2] - origin[0]))
+    color_0 = color_b[region].copy()
+    alpha_0 = alpha_b[region].copy()
+    color = color_0.copy()
+    alpha = alpha_0.copy()
+    shape_g = np.zeros_like(alpha_0)
+    alpha_g = np.zeros_like(alpha_0)
+    for child in children:
+      patch = self.get_step_patch((viewport[0], viewport[1]), color, alpha, child)
+      if patch is not None:
+        _PSDLayerCache.apply_group_source((viewport[0], viewport[1]), color_0, alpha_0, color, alpha, shape_g, alpha_g, patch)
+    # Compositor.color
+    with np.errstate(divide="ignore", invalid="ignore"):
+      ratio = np.true_divide(alpha_0, alpha_g)
+    ratio[~np.isfinite(ratio)] = 1.0
+    result = np.clip(color + (color - color_0) * (ratio - alpha_0), 0.0, 1.0)
+    return (viewport, result, shape_g, alpha_g)
+
+  def get_step_patch(self, origin : tuple[int, int], color : np.ndarray, alpha : np.ndarray, step : tuple) -> tuple[tuple[int, int, int, int], np.ndarray, np.ndarray, np.ndarray] | None:
+    # 步骤为 ("layer", 图层下标, 剪贴蒙版图层下标) 或 ("group", 组下标, 组内的步骤)
+    if step[0] == "group":
+      return self.composite_group(origin, color, alpha, step[1], step[2])
+    return self.get_patch(step[1], step[2])
+
+  @staticmethod
+  def build_steps(items : list[tuple[tuple[int, ...], tuple]], depth : int) -> list[tuple]:
+    # items 是按合成顺序排列的 (所在的组, 图层步骤)，这里把同一个组内的连续图层合并为一个组的步骤
+    steps = []
+    i = 0
+    while i < len(items):
+      groups, step = items[i]
+      if len(groups) == depth:
+        steps.append(step)
+        i += 1
+        continue
+      group_index = groups[depth]
+      j = i
+      while j < len(items) and len(items[j][0]) > depth and items[j][0][depth] == group_index:
+        j += 1
+      steps.append(("group", group_index, tuple(_PSDLayerCache.build_steps(items[i:j], depth + 1))))
+      i = j
+    return steps
+
+  def composite(self, converted_layers : list[list[str]]) -> PIL.Image.Image | None:
+    # 返回 None 表示需要使用 psd.composite()（包括没有匹配的图层等需要输出调试信息的情况）
+    if not self.is_supported:
+      return None
+    matched, converted_layers_used = self.match(converted_layers)
+    if len(matched) == 0 or not all(converted_layers_used):
+      return None
+    matched_set = set(matched)
+    for index in matched:
+      if not self.leaves[index].is_simple:
+        return None
+    items : list[tuple[tuple[int, ...], tuple]] = []
+    for index in matched:
+      info = self.leaves[index]
+      if info.clip_base is not None:
+        # 剪贴蒙版图层在基底图层中一起渲染；基底图层没有选中时不显示
+        continue
+      if isinstance(info.layer, psd_tools.api.layers.AdjustmentLayer):
+        continue
+      items.append((info.groups, ("layer", index, tuple(i for i in info.clip_layers if i in matched_set))))
+    steps = _PSDLayerCache.build_steps(items, 0)
+    # 相邻的导出项一般有相同的前缀（比如同一个基底的不同表情），从上一次保留的中间结果继续
+    num_reused = 0
+    while num_reused < len(self.snapshots) and num_reused < len(steps) and self.snapshots[num_reused][0] == steps[num_reused]:
+      num_reused += 1
+    del self.snapshots[num_reused:]
+    if num_reused > 0:
+      color = self.snapshots[-1][1].copy()
+      alpha = self.snapshots[-1][2].copy()
+    else:
+      # 与 psd_tools.composite.Compositor 的初始状态相同（背景 alpha 为 0）
+      color = np.ones((self.psd.height, self.psd.width, 3), dtype=np.float32)
+      alpha = np.zeros((self.psd.height, self.psd.width, 1), dtype=np.float32)
+    snapshot_size = color.nbytes + alpha.nbytes
+    for step in steps[num_reused:]:
+      patch = self.get_step_patch((0, 0), color, alpha, step)
+      if patch is not None:
+        _PSDLayerCache.apply_patch(color, alpha, patch)
+      if (len(self.snapshots) + 1) * snapshot_size <= _PSDLayerCache.SNAPSHOT_BUDGET:
+        self.snapshots.append((step, color.copy(), alpha.copy()))
+    color = np.where(alpha > 0, color, np.float32(1.0))
+    image = PIL.Image.fromarray((255 * np.concatenate((color, alpha), 2)).astype(np.uint8), "RGBA")
+    icc = None
+    if psd_tools.constants.Resource.ICC_PROFILE in self.psd.image_resources:
+      icc = self.psd.image_resources.get_data(psd_tools.constants.Resource.ICC_PROFILE)
+    image = psd_tools.api.pil_io.post_process(image, None, icc)
+    if image.getbbox() is None:
+      return None
+    return image
+
 
 class LayerBlendMode(enum.Enum):
   """图层混合模式。NORMAL 为默认 alpha 合成，MULTIPLY 为正片叠底。
@@ -167,16 +639,16 @@ class ImagePack(NamedAssetClassBase):
       if width == 0 or height == 0:
         raise RuntimeError("Zero-sized mask?")
 
-    def get_shrinked(self, ratio : decimal.Decimal):
-      newwidth = int(self.width * ratio)
-      newheight = int(self.height * ratio)
+    def get_shrinked(self, ratio : decimal.Decimal | fractions.Fraction):
+      newwidth = ImagePack.scale_int(self.width, ratio)
+      newheight = ImagePack.scale_int(self.height, ratio)
       newmask = ImageWrapper(self.mask.get().resize((newwidth, newheight), resample=PIL.Image.Resampling.NEAREST)) if self.mask is not None else None
       newprojective = None
       if self.projective_vertices is not None:
-        newprojective = tuple((int(x * ratio), int(y * ratio)) for x, y in self.projective_vertices)
+        newprojective = tuple((ImagePack.scale_int(x, ratio), ImagePack.scale_int(y, ratio)) for x, y in self.projective_vertices)
       return ImagePack.MaskInfo(mask=newmask,
-                                offset_x=int(self.offset_x * ratio),
-                                offset_y=int(self.offset_y * ratio),
+                                offset_x=ImagePack.scale_int(self.offset_x, ratio),
+                                offset_y=ImagePack.scale_int(self.offset_y, ratio),
                                 width=newwidth, height=newheight,
                                 projective_vertices=newprojective, # type: ignore
                                 basename=self.basename, applyon=self.applyon, mask_color=self.mask_color)
@@ -198,6 +670,9 @@ class ImagePack(NamedAssetClassBase):
     # 图层混合模式
     mode : LayerBlendMode
 
+    # 图层合成时使用的 RGBA uint8 数组，第一次使用时从 patch 转换（只用于没有后备存储的图层）
+    _patch_array : np.ndarray | None
+
     def __init__(self, patch : ImageWrapper,
                  offset_x : int = 0, offset_y : int = 0,
                  width : int = 0, height : int = 0,
@@ -211,16 +686,36 @@ class ImagePack(NamedAssetClassBase):
       self.base = base
       self.toggle = toggle
       self.mode = mode if mode is not None else LayerBlendMode.NORMAL
+      self._patch_array = None
       if width == 0 or height == 0:
         raise RuntimeError("Zero-sized layer?")
 
-    def get_shrinked(self, ratio : decimal.Decimal):
-      newwidth = int(self.width * ratio)
-      newheight = int(self.height * ratio)
-      newpatch = self.patch.get().resize((newwidth, newheight), resample=PIL.Image.Resampling.LANCZOS)
+    def get_patch_array(self) -> np.ndarray:
+      # 有后备存储的图层由 DecodedImageCache 管理，这里只保存运行时生成的图层的转换结果
+      if self.patch.image is None:
+        return self.patch.get_rgba_array()
+      if self._patch_array is None:
+        self._patch_array = self.patch.get_rgba_array()
+      return self._patch_array
+
+    def get_shrinked(self, ratio : decimal.Decimal | fractions.Fraction, level : int = 0, level_layer : "ImagePack.LayerInfo | None" = None):
+      # 如果提供了 level_layer，它应该是该图层在缩小金字塔第 level 层（缩小 2^level 倍）的版本，我们从它而不是原图缩小
+      # 结果的位置和大小只取决于原图层，与是否使用金字塔无关
+      newwidth = ImagePack.scale_int(self.width, ratio)
+      newheight = ImagePack.scale_int(self.height, ratio)
+      if level_layer is None:
+        newpatch = self.patch.get().resize((newwidth, newheight), resample=PIL.Image.Resampling.LANCZOS)
+      else:
+        # 原图层在金字塔层中对应的区域（金字塔层的图层可能在左上方多出来不到一个像素）
+        scale = 1 << level
+        box = (self.offset_x / scale - level_layer.offset_x,
+               self.offset_y / scale - level_layer.offset_y,
+               (self.offset_x + self.width) / scale - level_layer.offset_x,
+               (self.offset_y + self.height) / scale - level_layer.offset_y)
+        newpatch = level_layer.patch.get().resize((newwidth, newheight), resample=PIL.Image.Resampling.LANCZOS, box=box)
       return ImagePack.LayerInfo(patch=ImageWrapper(image=newpatch),
-                                offset_x=int(self.offset_x * ratio),
-                                offset_y=int(self.offset_y * ratio),
+                                offset_x=ImagePack.scale_int(self.offset_x, ratio),
+                                offset_y=ImagePack.scale_int(self.offset_y, ratio),
                                 width=newwidth, height=newheight,
                                 base=self.base, toggle=self.toggle, basename=self.basename, mode=self.mode)
 
@@ -265,6 +760,37 @@ class ImagePack(NamedAssetClassBase):
     "overview_scale",
   ]
 
+  # 图层合成时是否使用 NumPy 实现（见 imageblend.py），否则使用 PIL
+  # 两者的结果完全一致，可以用 --benchmark-compose 比较，也可以用 test-image-compositing (testbench.py) 检查
+  _use_numpy_compositing : typing.ClassVar[bool] = True
+
+  # 从 PSD 中导出图层组合时是否先单独渲染各图层再叠加（见 _PSDLayerCache），否则每个组合都调用一次 psd.composite()
+  # 两者的结果逐位相同，可以用 test-psd-layer-cache (testbench.py) 检查
+  _use_psd_layer_cache : typing.ClassVar[bool] = True
+
+  # fork_applying_mask() 生成的基底图层会放在 DecodedImageCache 中，键包含图片包的序号、图层序号以及所用的选区和参数
+  # 这样同一个图片包用同样的参数改色多次（比如多处导出同一套换色立绘）时每个图层只计算一次
+  # 序号只用于区分不同的图片包实例，不使用 id() 是因为对象释放后 id 可能被重复使用
+  _use_forked_layer_cache : typing.ClassVar[bool] = True
+  _instance_serial_counter : typing.ClassVar[typing.Iterator[int]] = itertools.count()
+  _instance_serial : int
+
+  # fork_and_shrink() 使用的缩小金字塔：第 k 层是每个图层缩小 2^k 倍的版本，按需从上一层生成
+  # 缩小时从不小于目标大小的最小一层开始缩放，而不是每次都从原图开始
+  # 各层是用 2x2 平均（PIL 的 reduce()）生成的，所以缩小比例不超过 0.5 时结果与直接从原图 LANCZOS 缩放的不完全相同（主要是边缘的像素，位置和大小不变）；比例大于 0.5 时不使用金字塔，结果不变
+  # 生成的层放在 DecodedImageCache 中，与其他图片一起受内存上限控制，被淘汰后再次需要时重新生成
+  # 打开 _use_shrink_pyramid_disk_cache 时，如果图片包是从目录中读取的，生成的层会以单文件图层存储的格式（未压缩）保存在该目录下，下次可以直接映射使用
+  # 文件名中包含图片包内容的指纹，图片包改变后旧的文件不会再被使用
+  # 默认不打开：内嵌素材的目录在安装的包里面，可能是只读的，并且 --export-built-embedded 会把这些文件一起复制出去
+  _use_shrink_pyramid : typing.ClassVar[bool] = True
+  _use_shrink_pyramid_disk_cache : typing.ClassVar[bool] = False
+
+  # optimize_masks()、inverse_pasting() 与 inverse_alpha_composite() 是否只在有效区域（图层、选区与有差异的范围）上计算，否则在整张画布上计算
+  # 两者结果完全一致，可以用 --benchmark-mask-optimization 比较，也可以用 test-mask-optimization (testbench.py) 检查
+  _use_cropped_mask_optimization : typing.ClassVar[bool] = True
+  PYRAMID_FILENAME_PREFIX : typing.ClassVar[str] = "pyramid_"
+  _source_path : str | None # 图片包是从哪个目录读取的
+
   def __init__(self, width : int, height : int) -> None:
     self.width = width
     self.height = height
@@ -272,6 +798,8 @@ class ImagePack(NamedAssetClassBase):
     self.layers = []
     self.composites = []
     self.opaque_metadata = {}
+    self._instance_serial = next(ImagePack._instance_serial_counter)
+    self._source_path = None
 
   @staticmethod
   def _write_image_to_path(image : ImageWrapper, filename : str, basepath : str):
@@ -284,14 +812,25 @@ class ImagePack(NamedAssetClassBase):
   def is_imagedata_loaded(self) -> bool:
     return len(self.layers) > 0
 
-  def write_to_path(self, path : str):
+  def write_to_path(self, path : str, store_codec : str | None = None):
+    # store_codec 为 None 时每张图片单独存为 PNG，否则所有图片都存入单文件图层存储（见 imagepackstore.py），取值为 LAYER_STORE_CODECS 中的一项
     if not self.is_imagedata_loaded():
       raise PPInternalError("writing ImagePack without data")
+    if store_codec is not None and store_codec not in LAYER_STORE_CODECS:
+      raise PPInternalError("Unsupported layer store codec: " + store_codec)
     os.makedirs(path, exist_ok=True)
     self.clear_directory_recursive(path)
     jsonout = {}
     used_filenames = set()
     used_filenames.add("manifest.json")
+    stored_images : list[tuple[str, typing.Callable[[], PIL.Image.Image]]] = [] # 写入图层存储时才读取图片
+    if store_codec is not None:
+      used_filenames.add(LAYER_STORE_FILENAME)
+    def write_image(image : ImageWrapper, basename : str):
+      if store_codec is not None:
+        stored_images.append((basename, image.get))
+      else:
+        self._write_image_to_path(image, basename + ".png", path)
     def check_filename(filename : str):
       nonlocal used_filenames
       if filename in used_filenames:
@@ -311,7 +850,7 @@ class ImagePack(NamedAssetClassBase):
           check_filename(filename)
           if m.mask is None:
             raise PPInternalError("Mask is None but basename is not None")
-          self._write_image_to_path(m.mask, filename, path)
+          write_image(m.mask, basename)
         else:
           basename = None
         jsonobj : dict[str, typing.Any] = {
@@ -354,7 +893,7 @@ class ImagePack(NamedAssetClassBase):
         if l.mode != LayerBlendMode.NORMAL:
           jsonobj["mode"] = l.mode.to_serialized()
         result.append(jsonobj)
-        self._write_image_to_path(l.patch, filename, path)
+        write_image(l.patch, basename)
       return result
     jsonout["layers"] = collect_layer_group("l", self.layers)
 
@@ -375,6 +914,10 @@ class ImagePack(NamedAssetClassBase):
     if len(self.opaque_metadata) > 0:
       jsonout["metadata"] = ImagePack.get_metadata_dict_for_serialization(self.opaque_metadata)
 
+    if store_codec is not None:
+      jsonout["store"] = LAYER_STORE_FILENAME
+      LayerStore.write(os.path.join(path, LAYER_STORE_FILENAME), stored_images, store_codec)
+
     with open(os.path.join(path, "manifest.json"), "w", encoding="utf-8") as f:
       json.dump(jsonout, f, ensure_ascii=False, indent=None, separators=(',', ':'))
 
@@ -419,6 +962,17 @@ class ImagePack(NamedAssetClassBase):
       if width != self.width or height != self.height:
         raise PPInternalError("ImagePack size mismatch: " + str((width, height)) + " != " + str((self.width, self.height)))
 
+    self._source_path = path
+
+    # 如果图片存放在单文件图层存储中，优先从中读取；存储中没有的图片仍然从 PNG 文件读取
+    store = None
+    if store_filename := manifest.get("store", None):
+      store = LayerStore(os.path.join(path, store_filename))
+    def get_image_wrapper(basename : str) -> ImageWrapper:
+      if store is not None and basename in store:
+        return ImageWrapper(store=store, store_name=basename)
+      return ImageWrapper(path=os.path.join(path, basename + ".png"))
+
     # Read masks
     if "masks" in manifest:
       masks = []
@@ -426,8 +980,7 @@ class ImagePack(NamedAssetClassBase):
         mask_basename = mask_info["mask"]
         mask_img = None
         if mask_basename is not None:
-          mask_filename = mask_info["mask"] + ".png"
-          mask_img = ImageWrapper(path=os.path.join(path, mask_filename))
+          mask_img = get_image_wrapper(mask_basename)
         mask_color = Color.get(mask_info["maskcolor"])
         offset_x = mask_info["x"]
         offset_y = mask_info["y"]
@@ -448,7 +1001,6 @@ class ImagePack(NamedAssetClassBase):
       layers = []
       if group_name in manifest:
         for layer_info in manifest[group_name]:
-          layer_filename = layer_info["p"] + ".png"
           offset_x = layer_info["x"]
           offset_y = layer_info["y"]
           width = layer_info["w"]
@@ -460,7 +1012,7 @@ class ImagePack(NamedAssetClassBase):
             mode = LayerBlendMode.from_serialized(mode_str)
           except ValueError as e:
             raise PPInternalError(str(e))
-          layer_img = ImageWrapper(path=os.path.join(path, layer_filename))
+          layer_img = get_image_wrapper(layer_info["p"])
           layers.append(ImagePack.LayerInfo(patch=layer_img,
                                             offset_x=offset_x, offset_y=offset_y,
                                             width=width, height=height,
@@ -530,36 +1082,126 @@ class ImagePack(NamedAssetClassBase):
     if result is None:
       result = PIL.Image.new("RGBA", (self.width, self.height))
 
+    if ImagePack._use_numpy_compositing:
+      canvas = np.array(result)
+      for li in layer_indices:
+        self._compose_layer_inplace_array(canvas, self.layers[li])
+        if composition_cache is not None:
+          composition_cache.layers.append((li, PIL.Image.fromarray(canvas.copy()) if li >= composition_cache.min_cached_layer else None))
+      return ImageWrapper(image=PIL.Image.fromarray(canvas))
+
     for li in layer_indices:
       layer = self.layers[li]
-      cur = result.crop((layer.offset_x, layer.offset_y, layer.offset_x + layer.width, layer.offset_y + layer.height))
-      layer_patch = layer.patch.get()
-      if layer.mode == LayerBlendMode.MULTIPLY:
-        cur = ImagePack.apply_multiply_blend_mode(cur, layer_patch)
-      else:
-        cur = PIL.Image.alpha_composite(cur, layer_patch)
       if composition_cache is not None and li >= composition_cache.min_cached_layer:
         result = result.copy()
-      result.paste(cur, (layer.offset_x, layer.offset_y))
+      ImagePack._compose_layer_inplace(result, layer)
       if composition_cache is not None:
         composition_cache.layers.append((li, result if li >= composition_cache.min_cached_layer else None))
     # end = time.time()
     # print(f"get_composed_image_lower: {end-start} s")
     return ImageWrapper(image=result)
 
+  @staticmethod
+  def _compose_layer_inplace(canvas : PIL.Image.Image, layer : "ImagePack.LayerInfo") -> None:
+    # 将单个图层合成到画布上（直接修改画布）
+    cur = canvas.crop((layer.offset_x, layer.offset_y, layer.offset_x + layer.width, layer.offset_y + layer.height))
+    layer_patch = layer.patch.get()
+    if layer.mode == LayerBlendMode.MULTIPLY:
+      cur = ImagePack.apply_multiply_blend_mode(cur, layer_patch)
+    else:
+      cur = PIL.Image.alpha_composite(cur, layer_patch)
+    canvas.paste(cur, (layer.offset_x, layer.offset_y))
+
+  @staticmethod
+  def _compose_layer_inplace_array(canvas : np.ndarray, layer : "ImagePack.LayerInfo") -> None:
+    # 与 _compose_layer_inplace() 相同，但画布是 (height, width, 4) 的 uint8 数组
+    regions = get_clipped_regions(canvas.shape[1], canvas.shape[0], layer.offset_x, layer.offset_y, layer.width, layer.height)
+    if regions is None:
+      return
+    dst_region, src_region = regions
+    dst = canvas[dst_region]
+    src = layer.get_patch_array()[src_region]
+    if layer.mode == LayerBlendMode.MULTIPLY:
+      multiply_composite_inplace(dst, src)
+    else:
+      alpha_composite_inplace(dst, src)
+
+  def compose_many(self, indices : typing.Iterable[int] | None = None, stats : ImageCompositionBatchStats | None = None) -> typing.Generator[tuple[int, ImageWrapper], None, None]:
+    # 批量生成组合图，结果与逐个调用 get_composed_image() 相同
+    # 我们将所有组合的图层序列建成前缀树，然后深度优先遍历，每层深度只保留一张画布，
+    # 这样所有组合共有的前缀（比如立绘的身体、服装部分）都只会合成一次
+    # 结果按遍历顺序（而不是 indices 的顺序）逐个产出 (组合下标, 图片)，调用者可以边生成边保存，不需要把所有结果都留在内存里
+    # indices 为 None 时生成所有组合；同一组合出现多次时会产出多次
+    if not self.is_imagedata_loaded():
+      raise PPInternalError("Cannot compose images without loading the data")
+    if indices is None:
+      indices = range(len(self.composites))
+    if stats is None:
+      stats = ImageCompositionBatchStats()
+    root = _CompositionTrieNode()
+    num_requested_ops = 0
+    direct_results : list[int] = []
+    for index in indices:
+      layer_indices = self.composites[index].layers
+      if len(layer_indices) == 0:
+        raise PPInternalError("Empty composition? some thing is probably wrong")
+      if len(layer_indices) == 1:
+        # 与 get_composed_image_lower() 相同，该图层正好覆盖整个图像时直接返回
+        curlayer = self.layers[layer_indices[0]]
+        if curlayer.offset_x == 0 and curlayer.offset_y == 0 and curlayer.width == self.width and curlayer.height == self.height:
+          direct_results.append(index)
+          continue
+      node = root
+      for li in layer_indices:
+        child = node.children.get(li)
+        if child is None:
+          child = _CompositionTrieNode()
+          node.children[li] = child
+        node = child
+      node.composites.append(index)
+      num_requested_ops += len(layer_indices)
+
+    for index in direct_results:
+      stats.num_composites += 1
+      yield (index, self.layers[self.composites[index].layers[0]].patch)
+
+    num_ops_start = stats.num_ops
+    # 画布可以是 PIL.Image.Image 或 NumPy 数组，两者都有 copy()
+    use_numpy = ImagePack._use_numpy_compositing
+    def compose_layer(canvas : typing.Any, layer : ImagePack.LayerInfo):
+      if use_numpy:
+        ImagePack._compose_layer_inplace_array(canvas, layer)
+      else:
+        ImagePack._compose_layer_inplace(canvas, layer)
+    def to_image(canvas : typing.Any) -> ImageWrapper:
+      return ImageWrapper(image=PIL.Image.fromarray(canvas) if use_numpy else canvas)
+    def visit(node : _CompositionTrieNode, canvas : typing.Any) -> typing.Generator[tuple[int, ImageWrapper], None, None]:
+      # canvas 是该结点的合成结果，只属于这次调用
+      # 最后一个子结点可以直接在该画布上继续合成，其他子结点需要复制一份
+      num_children = len(node.children)
+      for i, index in enumerate(node.composites):
+        stats.num_composites += 1
+        if num_children == 0 and i == len(node.composites) - 1:
+          yield (index, to_image(canvas))
+        else:
+          yield (index, to_image(canvas.copy()))
+      for i, (li, child) in enumerate(node.children.items()):
+        childcanvas = canvas if i == num_children - 1 else canvas.copy()
+        compose_layer(childcanvas, self.layers[li])
+        stats.num_ops += 1
+        yield from visit(child, childcanvas)
+
+    if len(root.children) > 0:
+      if use_numpy:
+        initial_canvas = np.zeros((self.height, self.width, 4), dtype=np.uint8)
+      else:
+        initial_canvas = PIL.Image.new("RGBA", (self.width, self.height))
+      yield from visit(root, initial_canvas)
+    stats.num_ops_saved += num_requested_ops - (stats.num_ops - num_ops_start)
+
   @staticmethod
   def apply_multiply_blend_mode(base : PIL.Image.Image, overlay : PIL.Image.Image) -> PIL.Image.Image:
-    base_array = np.array(base, dtype=np.float32)
-    overlay_array = np.array(overlay, dtype=np.float32)
-    overlay_alpha = overlay_array[:, :, 3:4] / 255.0
-    base_alpha = base_array[:, :, 3:4] / 255.0
-    result_rgb = base_array[:, :, :3] * overlay_array[:, :, :3] / 255.0
-    result_alpha = overlay_alpha + base_alpha * (1.0 - overlay_alpha)
-    base_contribution = 1.0 - overlay_alpha
-    final_rgb = result_rgb * overlay_alpha + base_array[:, :, :3] * base_contribution
-    final_rgb = np.clip(final_rgb, 0, 255).astype(np.uint8)
-    final_alpha = np.clip(result_alpha * 255, 0, 255).astype(np.uint8)
-    result_array = np.dstack((final_rgb, final_alpha))
+    result_array = multiply_blend(np.asarray(base), np.asarray(overlay))
     return PIL.Image.fromarray(result_array, mode='RGBA')
 
   @staticmethod
@@ -575,6 +1217,7 @@ class ImagePack(NamedAssetClassBase):
   @staticmethod
   def change_color_hsv_pillow(base_data : np.ndarray, mask_data : np.ndarray | None, base_color : Color, new_color : Color | np.ndarray) -> np.ndarray:
     # base_data 应该是 RGB[A] 模式, mask_data 应该是 L （灰度）或者 1 (黑白)模式
+    # base_data 会被直接修改（可以是更大的数组中的一块视图），返回值也是 base_data
     # 检查输入
     base_shape = base_data.shape
     assert len(base_shape) == 3  and base_shape[2] in (3, 4)
@@ -596,11 +1239,28 @@ class ImagePack(NamedAssetClassBase):
       else:
         non_zero_indices = np.where(mask_data > 0)
 
+    if len(non_zero_indices[0]) == 0:
+      return base_data
+
     base_alpha = None
     if base_shape[2] == 4:
       base_alpha = base_data[non_zero_indices][:,3:4]
     base_forchange = base_data[non_zero_indices][:,:3]
 
+    # 如果新颜色是单一颜色，每个像素的结果只取决于它原来的 RGB 值
+    # 基底图一般只有有限的几种颜色（加上边缘的过渡色），这时只对出现过的颜色做转换，再查表写回每个像素
+    # 每个颜色的计算与逐像素计算完全相同，所以结果不变
+    lut_inverse = None
+    if isinstance(new_color, Color):
+      packed = base_forchange[:,0].astype(np.uint32) << 16
+      packed |= base_forchange[:,1].astype(np.uint32) << 8
+      packed |= base_forchange[:,2]
+      unique_colors, inverse = np.unique(packed, return_inverse=True)
+      # 颜色太多时查表省下的时间不够排序的开销
+      if len(unique_colors) * 4 <= len(packed):
+        lut_inverse = inverse.reshape(-1)
+        base_forchange = np.stack((unique_colors >> 16, (unique_colors >> 8) & 0xFF, unique_colors & 0xFF), axis=1).astype(np.uint8)
+
     # Convert the RGB values in the region to HSV
     original_hsv = ImagePack.ndarray_rgb_to_hsv(base_forchange)
 
@@ -637,6 +1297,8 @@ class ImagePack(NamedAssetClassBase):
     # Convert the modified HSV values back to RGB
     new_rgb = ImagePack.ndarray_hsv_to_rgb(hsv_values)
     new_rgb = np.clip(new_rgb.astype(np.int16) + delta_rgb, 0, 255).astype(np.uint8)
+    if lut_inverse is not None:
+      new_rgb = new_rgb[lut_inverse]
 
     # Combine RGB values with the original alpha channel
     if base_shape[2] == 4:
@@ -731,6 +1393,27 @@ class ImagePack(NamedAssetClassBase):
     cur_base[l.offset_y:l.offset_y+l.height, l.offset_x:l.offset_x+l.width] = patch_array
 
     for m, arg in applicable_forks:
+      # 只处理基底图与选区重叠的部分，其他像素不会被修改
+      # 有 alpha 的基底图在图层以外的部分都是透明的，不会被选中；没有 alpha 时图层以外的部分（黑色）也会被改色，所以只按选区裁剪
+      if patch_array.shape[2] == 4:
+        xmin, ymin, xmax, ymax = l.offset_x, l.offset_y, l.offset_x + l.width, l.offset_y + l.height
+      else:
+        xmin, ymin, xmax, ymax = 0, 0, imgwidth, imgheight
+      mask_image = None
+      if m.mask is not None:
+        mask_image = m.mask.get()
+        xmin = max(xmin, m.offset_x)
+        ymin = max(ymin, m.offset_y)
+        xmax = min(xmax, m.offset_x + mask_image.width)
+        ymax = min(ymax, m.offset_y + mask_image.height)
+      xmin = max(xmin, 0)
+      ymin = max(ymin, 0)
+      xmax = min(xmax, imgwidth)
+      ymax = min(ymax, imgheight)
+      if xmin >= xmax or ymin >= ymax:
+        continue
+      region = (slice(ymin, ymax), slice(xmin, xmax))
+
       # 在开始前，如果输入是图像且需要进行转换，则执行操作
       if isinstance(arg, Color):
         converted_arg = arg
@@ -753,15 +1436,15 @@ class ImagePack(NamedAssetClassBase):
         projective_matrix = cv2.getPerspectiveTransform(srcpoints, dstpoints)
         converted_arg = cv2.warpPerspective(src=np.array(arg.convert("RGB")).astype(np.float32)/255.0, M=projective_matrix, dsize=(imgwidth, imgheight), dst=converted_arg, flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_TRANSPARENT)
         converted_arg = (converted_arg * 255.0).astype(np.uint8) # type: ignore
+        converted_arg = converted_arg[region]
 
-      # 转换当前的 mask
+      # 转换当前的 mask （只取重叠的部分）
       mask_data = None
-      if m.mask is not None:
-        mask_data = PIL.Image.new("L", (imgwidth, imgheight), color=0)
-        mask_data.paste(m.mask.get().convert("L"), (m.offset_x, m.offset_y))
-        mask_data = np.array(mask_data)
+      if mask_image is not None:
+        mask_data = np.asarray(mask_image.convert("L"))[ymin-m.offset_y:ymax-m.offset_y, xmin-m.offset_x:xmax-m.offset_x]
 
-      cur_base = ImagePack.change_color_hsv_pillow(cur_base, mask_data, m.mask_color, converted_arg)
+      # cur_base[region] 是一个视图，改色的结果直接写回 cur_base
+      ImagePack.change_color_hsv_pillow(cur_base[region], mask_data, m.mask_color, converted_arg)
 
     if cur_base.shape[2] == 3:
       mode = "RGB"
@@ -791,7 +1474,7 @@ class ImagePack(NamedAssetClassBase):
     resultpack.opaque_metadata["modified"] = True
 
     # 开始搬运 layers
-    forkinglayers : dict[int, list[tuple[ImagePack.MaskInfo, Color | PIL.Image.Image | str | tuple[str, Color] | None]]] = {}
+    forkinglayers : dict[int, tuple[list[tuple[ImagePack.MaskInfo, Color | PIL.Image.Image | str | tuple[str, Color] | None]], tuple | None]] = {}
     newlayers : dict[int, ImagePack.LayerInfo | None] = {}
     for layerindex, l in enumerate(self.layers):
       if not l.base:
@@ -800,7 +1483,9 @@ class ImagePack(NamedAssetClassBase):
 
       # 检查当前基底是否必须修改，不修改的话还是可以直接搬
       applicable_forks : list[tuple[ImagePack.MaskInfo, Color | PIL.Image.Image | str | tuple[str, Color] | None]] = []
-      for m, arg in zip(self.masks, args):
+      # 用于在 DecodedImageCache 中查找已经生成的图层；参数中有图片时不缓存
+      fork_key : list[tuple[int, Color | str | tuple[str, Color]]] | None = []
+      for maskindex, (m, arg) in enumerate(zip(self.masks, args)):
         # 如果当前 mask 不需要改动则跳过
         if arg is None:
           continue
@@ -812,22 +1497,33 @@ class ImagePack(NamedAssetClassBase):
           raise PPInternalError("Mask does not support image input")
         # 到这的话就应该需要了
         applicable_forks.append((m, arg))
+        if fork_key is not None:
+          if isinstance(arg, PIL.Image.Image):
+            fork_key = None
+          else:
+            fork_key.append((maskindex, arg))
 
       if len(applicable_forks) == 0:
         newlayers[layerindex] = l
         continue
 
-      forkinglayers[layerindex] = applicable_forks
+      forkinglayers[layerindex] = (applicable_forks, tuple(fork_key) if fork_key is not None else None)
+
+    def get_forked_layer(layerindex : int, applicable_forks : list[tuple[ImagePack.MaskInfo, Color | PIL.Image.Image | str | tuple[str, Color] | None]], fork_key : tuple | None) -> ImagePack.LayerInfo:
+      loader = lambda: ImagePack.create_forked_layer(self.width, self.height, self.layers[layerindex], layerindex, applicable_forks)
+      if fork_key is None or not ImagePack._use_forked_layer_cache:
+        return loader()
+      return DecodedImageCache.get_instance().get(("forked_layer", self._instance_serial, layerindex, fork_key), loader)
 
     if len(forkinglayers) > 0:
       if len(forkinglayers) == 1 or not enable_parallelization:
-        for layerindex, applicable_forks in forkinglayers.items():
-          newlayers[layerindex] = ImagePack.create_forked_layer(self.width, self.height, self.layers[layerindex], layerindex, applicable_forks)
+        for layerindex, (applicable_forks, fork_key) in forkinglayers.items():
+          newlayers[layerindex] = get_forked_layer(layerindex, applicable_forks, fork_key)
       else:
         futures = {}
         with concurrent.futures.ThreadPoolExecutor() as executor:
-          for layerindex, applicable_forks in forkinglayers.items():
-            futureobj = executor.submit(ImagePack.create_forked_layer, self.width, self.height, self.layers[layerindex], layerindex, applicable_forks)
+          for layerindex, (applicable_forks, fork_key) in forkinglayers.items():
+            futureobj = executor.submit(get_forked_layer, layerindex, applicable_forks, fork_key)
             futures[layerindex] = futureobj
         for layerindex, future in futures.items():
           newlayers[layerindex] = future.result()
@@ -840,6 +1536,153 @@ class ImagePack(NamedAssetClassBase):
       resultpack.layers.append(newlayer)
     return resultpack
 
+  @staticmethod
+  def scale_int(value : int, ratio : decimal.Decimal | fractions.Fraction) -> int:
+    # 计算 int(value * ratio)，全部使用整数运算
+    if not isinstance(ratio, fractions.Fraction):
+      ratio = fractions.Fraction(ratio)
+    result = abs(value) * ratio.numerator // ratio.denominator
+    return result if value >= 0 else -result
+
+  @staticmethod
+  def get_pyramid_layer_geometry(l : LayerInfo, level : int) -> tuple[int, int, int, int]:
+    # 返回图层在缩小金字塔第 level 层中的 (x, y, 宽, 高)
+    # 每一层都是把上一层的图层向左上扩展到偶数坐标、向右下扩展到偶数大小，再缩小一半，所以结果只取决于原图层的位置和大小
+    x, y, w, h = l.offset_x, l.offset_y, l.width, l.height
+    for _ in range(level):
+      w = (x % 2 + w + 1) // 2
+      h = (y % 2 + h + 1) // 2
+      x //= 2
+      y //= 2
+    return (x, y, w, h)
+
+  @staticmethod
+  def _halve_pyramid_layer(l : LayerInfo) -> LayerInfo | None:
+    # 从金字塔的上一层生成下一层的图层，不支持的图片模式返回 None （缩小时会直接使用原图）
+    image = l.patch.get()
+    if image.mode not in ("RGBA", "RGB"):
+      return None
+    x, y, w, h = ImagePack.get_pyramid_layer_geometry(l, 1)
+    pad_left = l.offset_x % 2
+    pad_top = l.offset_y % 2
+    if pad_left > 0 or pad_top > 0 or w * 2 != l.width or h * 2 != l.height:
+      if image.mode == "RGBA":
+        padded = PIL.Image.new("RGBA", (w * 2, h * 2), (0, 0, 0, 0))
+        padded.paste(image, (pad_left, pad_top))
+        image = padded
+      else:
+        # 没有 alpha 时用边缘的像素填充，否则边缘会被黑色染暗
+        padding = ((pad_top, h * 2 - l.height - pad_top), (pad_left, w * 2 - l.width - pad_left), (0, 0))
+        image = PIL.Image.fromarray(np.pad(np.asarray(image), padding, mode="edge"), "RGB")
+    # reduce() 对 RGBA 会先预乘 alpha，透明的填充部分不会影响颜色
+    return ImagePack.LayerInfo(ImageWrapper(image=image.reduce(2)),
+                               offset_x=x, offset_y=y, width=w, height=h,
+                               base=l.base, toggle=l.toggle, basename=l.basename, mode=l.mode)
+
+  def _get_pyramid_fingerprint(self) -> str | None:
+    # 用于判断保存在图片包目录下的金字塔是否还有效；只有从目录读取的图片包才有
+    if self._source_path is None or not ImagePack._use_shrink_pyramid_disk_cache:
+      return None
+    h = hashlib.sha256()
+    try:
+      with open(os.path.join(self._source_path, "manifest.json"), "rb") as f:
+        h.update(f.read())
+      files : set[str] = set()
+      for l in self.layers:
+        if l.patch.store is not None:
+          files.add(l.patch.store.path)
+        elif l.patch.path is not None:
+          files.add(l.patch.path)
+      for file in sorted(files):
+        st = os.stat(file)
+        h.update((os.path.basename(file) + ":" + str(st.st_size) + ":" + str(st.st_mtime_ns) + "\n").encode("utf-8"))
+    except OSError:
+      return None
+    return h.hexdigest()[:16]
+
+  def _get_pyramid_level_path(self, level : int, fingerprint : str) -> str:
+    assert self._source_path is not None
+    return os.path.join(self._source_path, ImagePack.PYRAMID_FILENAME_PREFIX + str(level) + "_" + fingerprint + ".bin")
+
+  def _read_pyramid_level(self, level : int, fingerprint : str) -> list[LayerInfo | None] | None:
+    path = self._get_pyramid_level_path(level, fingerprint)
+    if not os.path.isfile(path):
+      return None
+    try:
+      store = LayerStore(path)
+    except (OSError, ValueError, PPInternalError):
+      return None
+    result : list[ImagePack.LayerInfo | None] = []
+    for index, l in enumerate(self.layers):
+      name = "l" + str(index)
+      if name not in store:
+        result.append(None)
+        continue
+      x, y, w, h = ImagePack.get_pyramid_layer_geometry(l, level)
+      _, _, stored_width, stored_height, _, _ = store.index[name]
+      if stored_width != w or stored_height != h:
+        return None
+      result.append(ImagePack.LayerInfo(ImageWrapper(store=store, store_name=name),
+                                        offset_x=x, offset_y=y, width=w, height=h,
+                                        base=l.base, toggle=l.toggle, basename=l.basename, mode=l.mode))
+    return result
+
+  def _write_pyramid_level(self, level : int, fingerprint : str, layers : list[LayerInfo | None]) -> None:
+    # 写入失败（比如目录只读）时不保存，不影响结果
+    assert self._source_path is not None
+    path = self._get_pyramid_level_path(level, fingerprint)
+    # 临时文件名不能固定，多个进程（比如 -j）可能同时在写同一层
+    try:
+      fd, tmppath = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=self._source_path)
+      os.close(fd)
+    except OSError:
+      return
+    try:
+      LayerStore.write(tmppath, (("l" + str(index), l.patch.get()) for index, l in enumerate(layers) if l is not None), codec="raw")
+      os.replace(tmppath, path)
+      # 删除同一层的旧文件
+      prefix = ImagePack.PYRAMID_FILENAME_PREFIX + str(level) + "_"
+      for filename in os.listdir(self._source_path):
+        if filename.startswith(prefix) and filename.endswith(".bin") and os.path.join(self._source_path, filename) != path:
+          # 其他进程可能已经删掉了
+          try:
+            os.remove(os.path.join(self._source_path, filename))
+          except FileNotFoundError:
+            pass
+    except OSError:
+      if os.path.exists(tmppath):
+        os.remove(tmppath)
+
+  def get_pyramid_level(self, level : int, enable_parallelization : bool = False) -> list[LayerInfo | None]:
+    # 返回各图层在缩小金字塔第 level 层中的版本（第 0 层就是原图层），不支持的图层为 None
+    if level == 0:
+      return list(self.layers)
+    # 多个线程同时需要同一层时，DecodedImageCache 保证只生成一次
+    return DecodedImageCache.get_instance().get(("pyramid_level", self._instance_serial, level), lambda: self._create_pyramid_level(level, enable_parallelization))
+
+  def _create_pyramid_level(self, level : int, enable_parallelization : bool) -> list[LayerInfo | None]:
+    fingerprint = self._get_pyramid_fingerprint()
+    if fingerprint is not None:
+      if (result := self._read_pyramid_level(level, fingerprint)) is not None:
+        return result
+    if level == 1:
+      prevlayers : list[ImagePack.LayerInfo | None] = list(self.layers)
+    else:
+      prevlayers = self.get_pyramid_level(level - 1, enable_parallelization)
+    def halve_layer(l : ImagePack.LayerInfo | None) -> ImagePack.LayerInfo | None:
+      return ImagePack._halve_pyramid_layer(l) if l is not None else None
+    if len(prevlayers) > 1 and enable_parallelization:
+      with concurrent.futures.ThreadPoolExecutor() as executor:
+        result = list(executor.map(halve_layer, prevlayers))
+    else:
+      result = [halve_layer(l) for l in prevlayers]
+    if fingerprint is not None:
+      self._write_pyramid_level(level, fingerprint, result)
+      # 写入成功的话改为使用映射的文件，这样生成的图片不需要一直留在内存中
+      if (stored := self._read_pyramid_level(level, fingerprint)) is not None:
+        result = stored
+    return result
+
   def fork_and_shrink(self, ratio : decimal.Decimal, enable_parallelization : bool = False):
     # 创建一个新的 imagepack, 把该图包按 ratio 缩小
     # ratio 必须在 (0, 1) 之间
@@ -847,8 +1690,9 @@ class ImagePack(NamedAssetClassBase):
       raise PPInternalError("Cannot fork without loading the data")
     if ratio <= 0 or ratio >= 1:
       raise PPInternalError("Invalid ratio: " + str(ratio) + ", must be in (0, 1)")
-    target_width = int(self.width * ratio)
-    target_height = int(self.height * ratio)
+    exact_ratio = fractions.Fraction(ratio)
+    target_width = ImagePack.scale_int(self.width, exact_ratio)
+    target_height = ImagePack.scale_int(self.height, exact_ratio)
     resultpack = ImagePack(target_width, target_height)
 
     # composites 可以直接搬
@@ -860,31 +1704,41 @@ class ImagePack(NamedAssetClassBase):
       resultpack.opaque_metadata["original_size"] = (self.width, self.height)
     if "diff_croprect" in self.opaque_metadata:
       x1, y1, x2, y2 = self.opaque_metadata["diff_croprect"]
-      resultpack.opaque_metadata["diff_croprect"] = (int(x1 * ratio), int(y1 * ratio), int(x2 * ratio), int(y2 * ratio))
+      resultpack.opaque_metadata["diff_croprect"] = tuple(ImagePack.scale_int(v, exact_ratio) for v in (x1, y1, x2, y2))
     if "overview_scale" in self.opaque_metadata:
       # resultpack.opaque_metadata["overview_scale"] = self.opaque_metadata["overview_scale"] / ratio
       # 现在我们直接把这个值改成 1.0，因为原值只是为了在生成预览图时用，一般图片包整个缩小之后会以其他方式生成预览，不再需要这个值
       resultpack.opaque_metadata["overview_scale"] = decimal.Decimal(1.0)
 
+    # 从金字塔中不小于目标大小的最小一层开始缩小
+    level = 0
+    if ImagePack._use_shrink_pyramid:
+      while exact_ratio * (1 << (level + 1)) <= 1 and (self.width >> (level + 1)) > 0 and (self.height >> (level + 1)) > 0:
+        level += 1
+    level_layers = self.get_pyramid_level(level, enable_parallelization) if level > 0 else None
+
     newlayers = []
-    def shrink_layer(l : ImagePack.LayerInfo, ratio : decimal.Decimal) -> ImagePack.LayerInfo:
-      return l.get_shrinked(ratio)
+    def shrink_layer(index : int) -> ImagePack.LayerInfo:
+      l = self.layers[index]
+      if level_layers is not None and (level_layer := level_layers[index]) is not None:
+        return l.get_shrinked(exact_ratio, level, level_layer)
+      return l.get_shrinked(exact_ratio)
     if len(self.layers) > 1 and enable_parallelization:
       futures = []
       with concurrent.futures.ThreadPoolExecutor() as executor:
-        for l in self.layers:
-          futureobj = executor.submit(shrink_layer, l, ratio)
+        for index in range(len(self.layers)):
+          futureobj = executor.submit(shrink_layer, index)
           futures.append(futureobj)
       for f in futures:
         newlayers.append(f.result())
     else:
-      for l in self.layers:
-        newlayers.append(shrink_layer(l, ratio))
+      for index in range(len(self.layers)):
+        newlayers.append(shrink_layer(index))
     resultpack.layers = newlayers
     if len(self.masks) > 0:
       resultpack.masks = []
       for m in self.masks:
-        resultpack.masks.append(m.get_shrinked(ratio))
+        resultpack.masks.append(m.get_shrinked(exact_ratio))
     return resultpack
 
   def shrink_for_overview(self):
@@ -892,9 +1746,30 @@ class ImagePack(NamedAssetClassBase):
       return self.fork_and_shrink(overview_scale)
     return self
 
+  @staticmethod
+  def _get_difference_region(base_array : np.ndarray, result_array : np.ndarray) -> tuple[tuple[slice, slice], np.ndarray] | None:
+    # 返回 (有差异的像素的外接矩形, 矩形中的差异掩码)，没有差异时返回 None
+    diff_mask = np.any(base_array != result_array, axis=-1)
+    rows = np.flatnonzero(np.any(diff_mask, axis=1))
+    if len(rows) == 0:
+      return None
+    cols = np.flatnonzero(np.any(diff_mask, axis=0))
+    region = (slice(int(rows[0]), int(rows[-1]) + 1), slice(int(cols[0]), int(cols[-1]) + 1))
+    return (region, diff_mask[region])
+
   @staticmethod
   def inverse_pasting(base : PIL.Image.Image, result : PIL.Image.Image) -> np.ndarray | None:
     # 假设图片将以 paste 的方式进行叠层，计算使用的 patch
+    if ImagePack._use_cropped_mask_optimization:
+      base_array = np.asarray(base)
+      result_array = np.asarray(result)
+      patch_image = np.zeros_like(base_array)
+      if (diff := ImagePack._get_difference_region(base_array, result_array)) is None:
+        return None
+      region, diff_mask = diff
+      patch_image[region][diff_mask] = result_array[region][diff_mask]
+      return patch_image
+
     base_array = np.array(base)
     result_array = np.array(result)
 
@@ -917,6 +1792,19 @@ class ImagePack(NamedAssetClassBase):
     # C_b, C_r, C_a 是颜色值，则：(所有值都在 [0-1] 区间)
     # a_r = a_p + a_b(1-a_p)
     # C_r*a_r = C_p*a_p + C_b*a_b*(1-a_p)
+    if ImagePack._use_cropped_mask_optimization:
+      # 只在有差异的像素的外接矩形中取像素，每个像素的计算与下面完全相同
+      base_array = np.asarray(base)
+      result_array = np.asarray(result)
+      patch_image = np.zeros_like(base_array)
+      if (diff := ImagePack._get_difference_region(base_array, result_array)) is None:
+        return None
+      region, diff_mask = diff
+      indices = np.nonzero(diff_mask)
+      patch_region = patch_image[region]
+      patch_region[indices] = ImagePack._inverse_alpha_composite_pixels(base_array[region][indices], result_array[region][indices])
+      return patch_image
+
     base_array = np.array(base)
     result_array = np.array(result)
 
@@ -929,8 +1817,15 @@ class ImagePack(NamedAssetClassBase):
       return None
 
     indices = np.nonzero(diff_mask)
-    rraw = result_array[indices]
-    braw = base_array[indices]
+    # Update the patch image with non-matching pixels
+    patch_image[indices] = ImagePack._inverse_alpha_composite_pixels(base_array[indices], result_array[indices])
+
+    # Return the patch image
+    return patch_image
+
+  @staticmethod
+  def _inverse_alpha_composite_pixels(braw : np.ndarray, rraw : np.ndarray) -> np.ndarray:
+    # inverse_alpha_composite() 中对有差异的像素的计算，输入输出都是 (像素数, 4) 的 uint8 数组
     r = rraw.astype(np.float32) / 255.0
     b = braw.astype(np.float32) / 255.0
     a_r = r[:,3:4]
@@ -978,52 +1873,119 @@ class ImagePack(NamedAssetClassBase):
 
     #C_p = np.nan_to_num(np.where(a_p < 1.0, (C_r*a_r - C_b*(a_b*(1.0-a_p)))/a_p, C_r))
     results = np.hstack([C_p, a_p]) * 255.0
-    # Update the patch image with non-matching pixels
-    patch_image[indices] = results.astype(np.uint8)
+    return results.astype(np.uint8)
 
-    # Return the patch image
-    return patch_image
-
-  def optimize_masks(self):
+  def optimize_masks(self, enable_parallelization : bool = False):
     # 对任意一个选区，如果它现在有图片，但是它所覆盖的范围可以近似为全图，则把这个图片去掉以减小文件大小
-    # 对于选区和基底图的操作的代码都是从 fork_applying_mask() 中复制过来的
-    for m in self.masks:
+    for m, is_fully_covers in zip(self.masks, self.get_fully_covering_masks(enable_parallelization)):
+      if is_fully_covers:
+        m.mask = None
+        m.basename = None
+
+  def get_fully_covering_masks(self, enable_parallelization : bool = False) -> list[bool]:
+    # 对每个选区返回 optimize_masks() 是否会去掉它的图片，不修改图片包
+    # 选区“覆盖全图”指选区在整张画布上都非零，或是所有适用的基底图层的不透明部分都在选区内
+    # enable_parallelization 为 True 时各个图层的检查在线程池中进行
+    if not ImagePack._use_cropped_mask_optimization:
+      return [m.mask is not None and self._is_mask_fully_covering_canvas(m) for m in self.masks]
+    result : list[bool] = []
+    # (选区序号, 选区数组, 需要检查的图层)
+    pending_checks : list[tuple[int, np.ndarray, list[ImagePack.LayerInfo]]] = []
+    for i, m in enumerate(self.masks):
       if m.mask is None:
+        result.append(False)
         continue
-      isFullyCovers = True
-      mask_img = PIL.Image.new("L", (self.width, self.height), color=0)
-      mask_img.paste(m.mask.get().convert("L"), (m.offset_x, m.offset_y))
-      mask_data = np.array(mask_img)
-      # 如果 mask_data 全是非零值，那么就是全图，我们已经可以确定了
-      if not np.all(mask_data > 0):
-        # 在不全是非零值的情况下继续检查
-        def check_base_cover(l : ImagePack.LayerInfo) -> bool:
-          nonlocal isFullyCovers
-          # 如果当前基底图没有 alpha 通道，那么就不可能覆盖全图
-          if l.patch.get().mode != "RGBA":
-            isFullyCovers = False
-            return True
-          patch_array = np.array(l.patch)
-          base_data = np.zeros((self.height, self.width, patch_array.shape[2]), dtype=np.uint8)
-          base_data[l.offset_y:l.offset_y+l.height, l.offset_x:l.offset_x+l.width] = patch_array
-          reference_non_zero_indices = np.where((mask_data > 0) & (base_data[:,:,3] > 0))
-          new_non_zero_indices = np.where(base_data[:,:,3] > 0)
-          if not np.equal(reference_non_zero_indices, new_non_zero_indices).all():
-            isFullyCovers = False
-            return True
-          return False
-        if m.applyon is None or len(m.applyon) == 0:
-          for layer in self.layers:
-            if layer.base:
-              if check_base_cover(layer):
-                break
-        else:
-          for layerindex in m.applyon:
-            if check_base_cover(self.layers[layerindex]):
+      mask_array = np.asarray(m.mask.get().convert("L"))
+      if self._is_mask_array_covering_canvas(m, mask_array):
+        result.append(True)
+        continue
+      result.append(True) # 由下面对各图层的检查决定
+      if m.applyon is None or len(m.applyon) == 0:
+        layers = [layer for layer in self.layers if layer.base]
+      else:
+        layers = [self.layers[layerindex] for layerindex in m.applyon]
+      pending_checks.append((i, mask_array, layers))
+    if len(pending_checks) == 0:
+      return result
+    num_layer_checks = sum(len(layers) for _, _, layers in pending_checks)
+    if num_layer_checks <= 1 or not enable_parallelization:
+      for i, mask_array, layers in pending_checks:
+        result[i] = all(self._is_layer_covered_by_mask(self.masks[i], mask_array, layer) for layer in layers)
+      return result
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+      futures = [(i, [executor.submit(self._is_layer_covered_by_mask, self.masks[i], mask_array, layer) for layer in layers]) for i, mask_array, layers in pending_checks]
+      for i, layer_futures in futures:
+        result[i] = all(f.result() for f in layer_futures)
+    return result
+
+  def _is_mask_array_covering_canvas(self, m : MaskInfo, mask_array : np.ndarray) -> bool:
+    # 选区是否在整张画布上都非零；只需要看选区中与画布重叠的部分
+    mask_height, mask_width = mask_array.shape
+    if m.offset_x > 0 or m.offset_y > 0 or m.offset_x + mask_width < self.width or m.offset_y + mask_height < self.height:
+      return False
+    return bool(np.all(mask_array[-m.offset_y:self.height-m.offset_y, -m.offset_x:self.width-m.offset_x] > 0))
+
+  def _is_layer_covered_by_mask(self, m : MaskInfo, mask_array : np.ndarray, l : LayerInfo) -> bool:
+    # 图层在画布上的不透明部分是否都在选区内（选区非零）；只在图层与选区重叠的范围内计算
+    image = l.patch.get()
+    # 如果当前基底图没有 alpha 通道，那么就不可能覆盖全图
+    if image.mode != "RGBA":
+      return False
+    alpha = np.asarray(image)[:, :, 3]
+    regions = get_clipped_regions(self.width, self.height, l.offset_x, l.offset_y, alpha.shape[1], alpha.shape[0])
+    if regions is None:
+      return True
+    (canvas_rows, canvas_cols), layer_region = regions
+    num_opaque = np.count_nonzero(alpha[layer_region])
+    if num_opaque == 0:
+      return True
+    # 画布上同时在图层与选区内的范围
+    xmin = max(canvas_cols.start, m.offset_x)
+    ymin = max(canvas_rows.start, m.offset_y)
+    xmax = min(canvas_cols.stop, m.offset_x + mask_array.shape[1])
+    ymax = min(canvas_rows.stop, m.offset_y + mask_array.shape[0])
+    if xmin >= xmax or ymin >= ymax:
+      return False
+    alpha_overlap = alpha[ymin-l.offset_y:ymax-l.offset_y, xmin-l.offset_x:xmax-l.offset_x]
+    mask_overlap = mask_array[ymin-m.offset_y:ymax-m.offset_y, xmin-m.offset_x:xmax-m.offset_x]
+    return np.count_nonzero((alpha_overlap > 0) & (mask_overlap > 0)) == num_opaque
+
+  def _is_mask_fully_covering_canvas(self, m : MaskInfo) -> bool:
+    # 在整张画布上计算的原始实现，_use_cropped_mask_optimization 为 False 时使用
+    # 对于选区和基底图的操作的代码都是从 fork_applying_mask() 中复制过来的
+    assert m.mask is not None
+    isFullyCovers = True
+    mask_img = PIL.Image.new("L", (self.width, self.height), color=0)
+    mask_img.paste(m.mask.get().convert("L"), (m.offset_x, m.offset_y))
+    mask_data = np.array(mask_img)
+    # 如果 mask_data 全是非零值，那么就是全图，我们已经可以确定了
+    if not np.all(mask_data > 0):
+      # 在不全是非零值的情况下继续检查
+      def check_base_cover(l : ImagePack.LayerInfo) -> bool:
+        nonlocal isFullyCovers
+        # 如果当前基底图没有 alpha 通道，那么就不可能覆盖全图
+        if l.patch.get().mode != "RGBA":
+          isFullyCovers = False
+          return True
+        patch_array = np.array(l.patch.get())
+        base_data = np.zeros((self.height, self.width, patch_array.shape[2]), dtype=np.uint8)
+        base_data[l.offset_y:l.offset_y+l.height, l.offset_x:l.offset_x+l.width] = patch_array
+        reference_non_zero_indices = np.where((mask_data > 0) & (base_data[:,:,3] > 0))
+        new_non_zero_indices = np.where(base_data[:,:,3] > 0)
+        if not np.array_equal(reference_non_zero_indices, new_non_zero_indices):
+          isFullyCovers = False
+          return True
+        return False
+      if m.applyon is None or len(m.applyon) == 0:
+        for layer in self.layers:
+          if layer.base:
+            if check_base_cover(layer):
               break
-      if isFullyCovers:
-        m.mask = None
-        m.basename = None
+      else:
+        for layerindex in m.applyon:
+          if check_base_cover(self.layers[layerindex]):
+            break
+    return isFullyCovers
 
   def get_summary_no_variations(self, descriptor : 'ImagePackDescriptor') -> 'ImagePackSummary':
     # 在该图片组没有使用基底图变体时生成 ImagePackSummary
@@ -1069,13 +2031,11 @@ class ImagePack(NamedAssetClassBase):
     if overview_scale is not None:
       if not isinstance(overview_scale, decimal.Decimal) or overview_scale <= 0 or overview_scale > 1:
         raise PPInternalError("Invalid overview_scale")
+    # 缩小由 ImagePackSummary.write() 在排版前进行
+    result.imagescale = overview_scale
     for image, name in zip(bases, basenames):
-      if overview_scale is not None:
-        image = image.resize((int(image.width * overview_scale), int(image.height * overview_scale)), PIL.Image.Resampling.LANCZOS)
       result.add_base(image, name)
     for image, name in zip(diffs, diffnames):
-      if overview_scale is not None:
-        image = image.resize((int(image.width * overview_scale), int(image.height * overview_scale)), PIL.Image.Resampling.LANCZOS)
       result.add_diff(image, name)
     return result
 
@@ -1120,8 +2080,9 @@ class ImagePack(NamedAssetClassBase):
     zh_hk="本圖片包以 CC0 1.0 通用 (CC0 1.0) 公共領域貢獻方式分發。",
   )
 
-  def write_overview_image(self, path : str, descriptor : "ImagePackDescriptor", interactive_html_path : str | None = None):
+  def write_overview_image(self, path : str, descriptor : "ImagePackDescriptor", interactive_html_path : str | None = None, interactive_html_image_format : str | None = None):
     # 生成一个预览图
+    # interactive_html_image_format: 见 _ImagePackHTMLExport.write_html() 的 image_format
     # 先使用辅助函数生成 ImagePackSummary
     summary = self.get_summary_no_variations(descriptor)
     # 再把元数据加上
@@ -1173,7 +2134,8 @@ class ImagePack(NamedAssetClassBase):
         interactive_html_path, self, descriptor,
         html_title=imgpack_name,
         html_author=Translatable.tr_program_name.get(),
-        html_description="\n".join(summary.comments))
+        html_description="\n".join(summary.comments),
+        image_format=interactive_html_image_format)
 
 
   TR_imagepack_yamlparse_layers = TR_imagepack.tr("layers",
@@ -1546,7 +2508,7 @@ class ImagePack(NamedAssetClassBase):
         raise PPInternalError("Invalid metadata in " + yamlpath + ": expecting a dict but got " + str(metadata))
       result.opaque_metadata.update(metadata)
 
-    result.optimize_masks()
+    result.optimize_masks(enable_parallelization=True)
     result.sanity_check()
     return result, unpack_directory
 
@@ -2082,7 +3044,13 @@ class ImagePack(NamedAssetClassBase):
   )
 
   @staticmethod
-  def _get_psd_composite_image_from_layers(psd : psd_tools.PSDImage, converted_layers : list[list[str]]) -> PIL.Image.Image:
+  def _get_psd_composite_image_from_layers(psd : psd_tools.PSDImage, converted_layers : list[list[str]], layer_cache : _PSDLayerCache | None = None) -> PIL.Image.Image:
+    if layer_cache is not None:
+      composite = layer_cache.composite(converted_layers)
+      if composite is not None:
+        layer_cache.num_cached_composites += 1
+        return composite
+      layer_cache.num_fallback_composites += 1
     converted_layers_used : list[bool] = [False] * len(converted_layers)
     actual_layers : list[tuple[str, typing.Any]] = [] # <名字，图层对象>
     debug_layerlog : list[str] = []
@@ -2188,7 +3156,7 @@ class ImagePack(NamedAssetClassBase):
     return patch_img
 
   @staticmethod
-  def _get_psd_composite_image_from_diff(psd : psd_tools.PSDImage, info : dict) -> PIL.Image.Image:
+  def _get_psd_composite_image_from_diff(psd : psd_tools.PSDImage, info : dict, layer_cache : _PSDLayerCache | None = None) -> PIL.Image.Image:
     base_layers_str = None
     target_layers_str = None
     if not isinstance(info, dict):
@@ -2206,8 +3174,8 @@ class ImagePack(NamedAssetClassBase):
       raise PPInternalError("Missing base or target in diff info in PSD exports: " + str(info))
     base_layers = ImagePack._convert_psd_layername_expr(base_layers_str)
     target_layers = ImagePack._convert_psd_layername_expr(target_layers_str)
-    base_image = ImagePack._get_psd_composite_image_from_layers(psd, base_layers)
-    target_image = ImagePack._get_psd_composite_image_from_layers(psd, target_layers)
+    base_image = ImagePack._get_psd_composite_image_from_layers(psd, base_layers, layer_cache)
+    target_image = ImagePack._get_psd_composite_image_from_layers(psd, target_layers, layer_cache)
     return ImagePack._get_diff_image_patch(base_image, target_image)
 
   @staticmethod
@@ -2244,6 +3212,7 @@ class ImagePack(NamedAssetClassBase):
   @staticmethod
   def _unpack_psd_to_directory(psdpath : str, destdir : str, exports : dict) -> None:
     psd = psd_tools.PSDImage.open(psdpath)
+    layer_cache = _PSDLayerCache(psd) if ImagePack._use_psd_layer_cache else None
     for filename, info in exports.items():
       print(f"Extracting: {filename}")
       if isinstance(info, dict):
@@ -2251,15 +3220,17 @@ class ImagePack(NamedAssetClassBase):
           raise PPInternalError("Invalid export info in PSD exports: expecting a dict with exactly one key but got " + str(info))
         algo, info = next(iter(info.items()))
         if algo in ImagePack.TR_imagepack_fileunpack_diff.get_all_candidates():
-          composite = ImagePack._get_psd_composite_image_from_diff(psd, info)
+          composite = ImagePack._get_psd_composite_image_from_diff(psd, info, layer_cache)
         else:
           raise PPInternalError("Unknown export algorithm in PSD exports: " + algo + "(supported algorithms: "
                                 + str(ImagePack.TR_imagepack_fileunpack_diff.get_all_candidates()) + ")")
       else:
         converted_layers = ImagePack._convert_psd_layername_expr(info)
-        composite = ImagePack._get_psd_composite_image_from_layers(psd, converted_layers)
+        composite = ImagePack._get_psd_composite_image_from_layers(psd, converted_layers, layer_cache)
       savename = os.path.join(destdir, filename + ".png")
       composite.save(savename)
+    if layer_cache is not None:
+      ImagePack.printstatus(f"{psdpath}: {layer_cache.num_cached_composites} composites assembled from {len(layer_cache.patches)} rendered layers; {layer_cache.num_fallback_composites} composites rendered with the full layer tree")
 
   @staticmethod
   def yaml_generation_file_expand(basepath : str, data : dict, metadata : dict | None) -> tempfile.TemporaryDirectory | str:
@@ -2344,6 +3315,63 @@ class ImagePack(NamedAssetClassBase):
       unpack_directory.cleanup()
     return descriptor
 
+  @staticmethod
+  def get_asset_build_inputs(yamlpath : str, references_filename : str = "references.yml") -> tuple[typing.Any, list[str]]:
+    # 给 AssetManager 判断素材是否需要重新构建用的
+    # 配置部分是展开 include 后的 yaml 内容，这样被 include 的文件改动后也会重新构建
+    # 图片等素材文件一般都在 yaml 所在的目录下，这里把该目录下除 yaml 以外的所有文件都视作输入
+    # 配置中引用的文件也可以在该目录之外（比如 "../共用/xxx" 或者绝对路径），这些文件按 build_image_pack_from_yaml() 的方式解析后也加入输入
+    basepath = os.path.dirname(os.path.abspath(yamlpath))
+    references_path = os.path.join(basepath, references_filename)
+    yamlobj = ImagePack.load_yaml(yamlpath)
+    config = {
+      "config": yamlobj,
+      "references": ImagePack.load_yaml(references_path),
+    }
+    inputs : list[str] = []
+    for root, _, filenames in os.walk(basepath):
+      for filename in filenames:
+        if os.path.splitext(filename)[1].lower() in (".yml", ".yaml"):
+          continue
+        inputs.append(os.path.join(root, filename))
+    inputs.extend(ImagePack._get_yaml_referenced_paths(basepath, copy.deepcopy(yamlobj)))
+    return (config, inputs)
+
+  @staticmethod
+  def _get_yaml_referenced_paths(basepath : str, yamlobj : dict[str, typing.Any]) -> list[str]:
+    # 返回 build_image_pack_from_yaml() 会读取的文件（解析后的路径，包括不存在的）；生成算法会修改参数，所以调用者需要传入副本
+    layers = None
+    masks = None
+    composites = None
+    metadata = None
+    generation = None
+    for k, v in yamlobj.items():
+      if k in ImagePack.TR_imagepack_yamlparse_layers.get_all_candidates():
+        layers = v
+      elif k in ImagePack.TR_imagepack_yamlparse_masks.get_all_candidates():
+        masks = v
+      elif k in ImagePack.TR_imagepack_yamlparse_composites.get_all_candidates():
+        composites = v
+      elif k in ImagePack.TR_imagepack_yamlparse_metadata.get_all_candidates():
+        metadata = v
+      elif k in ImagePack.TR_imagepack_yamlparse_generation.get_all_candidates():
+        generation = v
+    result : list[str] = []
+    if isinstance(generation, dict):
+      for k, data in generation.items():
+        if k in ImagePack.TR_imagepack_yamlgen_charactersprite_parts_based.get_all_candidates():
+          layers, masks, composites, metadata = ImagePack.yaml_generation_charactersprite_parts_based(data, layers, masks, composites, metadata)
+        elif k in ImagePack.TR_imagepack_yamlgen_fileunpack.get_all_candidates() and isinstance(data, dict):
+          for fk, fv in data.items():
+            if fk in ImagePack.TR_imagepack_fileunpack_file.get_all_candidates() and isinstance(fv, str):
+              result.append(os.path.join(basepath, fv))
+    # 从压缩包等文件中解包得到的图片不在这里，它们的来源已经在上面加入了
+    for d in (layers, masks):
+      if isinstance(d, dict):
+        for imgpathbase in d.keys():
+          result.append(os.path.join(basepath, imgpathbase + ".png"))
+    return [os.path.normpath(p) for p in result]
+
   @classmethod
   def get_candidate_id(cls, descriptor : "ImagePackDescriptor") -> str:
     if not isinstance(descriptor, ImagePackDescriptor):
@@ -2387,6 +3415,26 @@ class ImagePack(NamedAssetClassBase):
       result["descriptor"] = descriptor.dump_asset_info_json()
     return result
 
+  def get_asset_data_size(self) -> int:
+    # 给 AssetManager.prefetch() 用的，估算 prefetch_asset_data() 读取的图片解码后的大小（图层按 RGBA，选区按单通道计算）
+    result = 0
+    for l in self.layers:
+      if l.patch.image is None:
+        result += l.width * l.height * 4
+    for m in self.masks:
+      if m.mask is not None and m.mask.image is None:
+        result += m.width * m.height
+    return result
+
+  def prefetch_asset_data(self) -> None:
+    # 把所有图层和选区读取到 DecodedImageCache 中
+    for l in self.layers:
+      if l.patch.image is None:
+        l.patch.prefetch()
+    for m in self.masks:
+      if m.mask is not None and m.mask.image is None:
+        m.mask.prefetch()
+
   @staticmethod
   def _util_command_create_diff_image(base : str, target : str, output : str) -> int:
     base_image = PIL.Image.open(base)
@@ -2395,6 +3443,76 @@ class ImagePack(NamedAssetClassBase):
     diff_image.save(output)
     return 0
 
+  @staticmethod
+  def benchmark_compose(pack : "ImagePack", name : str) -> None:
+    # 分别用 PIL 与 NumPy 的实现合成所有组合，比较耗时与结果差异
+    if not pack.is_imagedata_loaded():
+      raise PPInternalError("Cannot compose images without loading the data")
+    saved_setting = ImagePack._use_numpy_compositing
+    time_pil = 0.0
+    time_numpy = 0.0
+    max_error = 0
+    num_mismatched_pixels = 0
+    start = time.time()
+    for layer in pack.layers:
+      layer.get_patch_array()
+    time_convert = time.time() - start
+    try:
+      for i in range(len(pack.composites)):
+        ImagePack._use_numpy_compositing = False
+        start = time.time()
+        image_pil = np.asarray(pack.get_composed_image(i).get().convert("RGBA"))
+        time_pil += time.time() - start
+        ImagePack._use_numpy_compositing = True
+        start = time.time()
+        image_numpy = np.asarray(pack.get_composed_image(i).get().convert("RGBA"))
+        time_numpy += time.time() - start
+        diff = np.abs(image_pil.astype(np.int16) - image_numpy.astype(np.int16))
+        max_error = max(max_error, int(diff.max()))
+        num_mismatched_pixels += int(np.count_nonzero(diff.max(axis=2)))
+    finally:
+      ImagePack._use_numpy_compositing = saved_setting
+    MessageHandler.info("{}: {} composites, PIL {:.3f}s, NumPy {:.3f}s (+{:.3f}s layer conversion), max error {}, {} mismatched pixels".format(
+      name, len(pack.composites), time_pil, time_numpy, time_convert, max_error, num_mismatched_pixels))
+
+  @staticmethod
+  def benchmark_mask_optimization(pack : "ImagePack", name : str) -> None:
+    # 分别用整张画布与只处理有效区域的实现执行 optimize_masks() 的检查，以及对每个组合（去掉最上面一层 -> 完整组合）执行 inverse_pasting() 与 inverse_alpha_composite()，比较耗时并检查结果是否完全相同
+    if not pack.is_imagedata_loaded():
+      raise PPInternalError("Cannot check masks without loading the data")
+    saved_setting = ImagePack._use_cropped_mask_optimization
+    times = {False: 0.0, True: 0.0}
+    num_mismatches = 0
+    try:
+      results = {}
+      for use_cropped in (False, True):
+        ImagePack._use_cropped_mask_optimization = use_cropped
+        start = time.time()
+        results[use_cropped] = pack.get_fully_covering_masks(enable_parallelization=use_cropped)
+        times[use_cropped] += time.time() - start
+      if results[False] != results[True]:
+        num_mismatches += 1
+      for info in pack.composites:
+        if len(info.layers) < 2:
+          continue
+        base = pack.get_composed_image_lower(list(info.layers[:-1])).get().convert("RGBA")
+        result = pack.get_composed_image_lower(list(info.layers)).get().convert("RGBA")
+        for func in (ImagePack.inverse_pasting, ImagePack.inverse_alpha_composite):
+          patches = {}
+          for use_cropped in (False, True):
+            ImagePack._use_cropped_mask_optimization = use_cropped
+            start = time.time()
+            patches[use_cropped] = func(base, result)
+            times[use_cropped] += time.time() - start
+          if (patches[False] is None) != (patches[True] is None):
+            num_mismatches += 1
+          elif patches[False] is not None and not np.array_equal(patches[False], patches[True]):
+            num_mismatches += 1
+    finally:
+      ImagePack._use_cropped_mask_optimization = saved_setting
+    MessageHandler.info("{}: {} masks, {} composites, full canvas {:.3f}s, cropped {:.3f}s, {} mismatched results".format(
+      name, len(pack.masks), len(pack.composites), times[False], times[True], num_mismatches))
+
   @staticmethod
   def tool_main(args : list[str] | None = None):
     # 创建一个有以下参数的 argument parser: [--debug] [--create <yml> | --load <zip> | --asset <name>] [--save <zip>] [--fork [args]] [--export <dir>]
@@ -2404,11 +3522,15 @@ class ImagePack(NamedAssetClassBase):
     parser.add_argument("--load", metavar="<zip>", help="Load an existing image pack from a zip file")
     parser.add_argument("--asset", metavar="<name>", help="Load an existing image pack from embedded assets")
     parser.add_argument("--save", metavar="<zip>", help="Save the image pack to a zip file")
+    parser.add_argument("--save-format", choices=["png"] + list(LAYER_STORE_CODECS), default="png", help="Storage of images for --save: one PNG per image (default), or a single layer store file (raw: memory-mapped without decoding, zlib: compressed)")
     parser.add_argument("--shrink", metavar="<ratio>", help="Shrink the image pack by the specified ratio (0-1)")
     parser.add_argument("--fork", nargs="*", metavar="[args]", help="Fork the image pack with the given arguments")
     parser.add_argument("--export", metavar="<dir>", help="Export the image pack to a directory")
     parser.add_argument("--export-overview", metavar="<path>", help="Export a single overview image to the specified path")
     parser.add_argument("--export-overview-html", metavar="<path>", help="Export an interactive HTML to the specified path; require --asset and --export-overview")
+    parser.add_argument("--export-overview-html-images", choices=["inline"] + list(_ImagePackHTMLExport.IMAGE_FILE_FORMATS), default="inline", help="How --export-overview-html stores layer images: base64 inside the HTML (default), or as separate files in a <name>_files directory next to it (much faster to generate and open; saving the view may need the page served over HTTP)")
+    parser.add_argument("--benchmark-compose", action="store_true", help="Compare PIL and NumPy layer compositing on all composites (of all embedded image packs if no input is specified)")
+    parser.add_argument("--benchmark-mask-optimization", action="store_true", help="Compare the full-canvas and cropped implementations of mask optimization and inverse compositing, and check that their results are identical (on all embedded image packs if no input is specified)")
     subparsers = parser.add_subparsers(dest="subparser")
     util_subparser = subparsers.add_parser("util", help="Util commands that does not use image pack")
     util_subparser.add_argument("--create-diff-image", nargs=2, metavar="<path>", help="Create a diff image from two image files")
@@ -2437,6 +3559,17 @@ class ImagePack(NamedAssetClassBase):
       num_input_spec += 1
     if num_input_spec > 1:
       raise PPInternalError("Cannot specify more than one input")
+    if num_input_spec == 0 and (parsed_args.benchmark_compose or parsed_args.benchmark_mask_optimization):
+      manager = AssetManager.get_instance()
+      ImagePack.load_pending_descriptors()
+      for name in list(ImagePack.MANIFEST.keys()):
+        pack = manager.get_asset(name)
+        if isinstance(pack, ImagePack):
+          if parsed_args.benchmark_compose:
+            ImagePack.benchmark_compose(pack, name)
+          if parsed_args.benchmark_mask_optimization:
+            ImagePack.benchmark_mask_optimization(pack, name)
+      return 0
     if num_input_spec == 0:
       raise PPInternalError("No input specified")
     if parsed_args.export_overview_html and (parsed_args.export_overview is None or parsed_args.asset is None):
@@ -2472,7 +3605,7 @@ class ImagePack(NamedAssetClassBase):
       ImagePack.print_executing_command("--save")
       if current_pack is None:
         raise PPInternalError("Cannot save without input")
-      current_pack.write_to_path(parsed_args.save)
+      current_pack.write_to_path(parsed_args.save, store_codec=None if parsed_args.save_format == "png" else parsed_args.save_format)
 
     if parsed_args.shrink is not None:
       # 缩小 imagepack
@@ -2518,20 +3651,38 @@ class ImagePack(NamedAssetClassBase):
       if current_pack is None:
         raise PPInternalError("Cannot export without input")
       pathlib.Path(parsed_args.export).mkdir(parents=True, exist_ok=True)
-      for i, comp in enumerate(current_pack.composites):
-        outputname = comp.basename + '.png'
-        img = current_pack.get_composed_image(i)
+      stats = ImageCompositionBatchStats()
+      for i, img in current_pack.compose_many(stats=stats):
+        outputname = current_pack.composites[i].basename + '.png'
         img.save_png(os.path.join(parsed_args.export, outputname))
+      ImagePack.printstatus("{} composites exported; {} of {} layer compositions saved".format(stats.num_composites, stats.num_ops_saved, stats.num_ops + stats.num_ops_saved))
+
+    if parsed_args.benchmark_compose:
+      ImagePack.print_executing_command("--benchmark-compose")
+      if current_pack is None:
+        raise PPInternalError("Cannot benchmark without input")
+      ImagePack.benchmark_compose(current_pack, parsed_args.create or parsed_args.load or parsed_args.asset)
+
+    if parsed_args.benchmark_mask_optimization:
+      ImagePack.print_executing_command("--benchmark-mask-optimization")
+      if current_pack is None:
+        raise PPInternalError("Cannot benchmark without input")
+      ImagePack.benchmark_mask_optimization(current_pack, parsed_args.create or parsed_args.load or parsed_args.asset)
 
     if parsed_args.export_overview is not None:
       ImagePack.print_executing_command("--export-overview")
       if current_pack is None:
         raise PPInternalError("Cannot export overview without input")
-      current_pack.write_overview_image(parsed_args.export_overview, current_pack_descriptor, parsed_args.export_overview_html)
+      html_image_format = None if parsed_args.export_overview_html_images == "inline" else parsed_args.export_overview_html_images
+      current_pack.write_overview_image(parsed_args.export_overview, current_pack_descriptor, parsed_args.export_overview_html, html_image_format)
 
     if unpack_directory is not None and isinstance(unpack_directory, tempfile.TemporaryDirectory):
       unpack_directory.cleanup()
 
+    cache_stats = DecodedImageCache.get_instance().stats
+    ImagePack.printstatus("Decoded image cache: {} hits, {} misses, {} evictions, peak {:.1f} MiB".format(
+      cache_stats.num_hits, cache_stats.num_misses, cache_stats.num_evictions, cache_stats.peak_bytes / (1024 * 1024)))
+
   _debug = False
 
   @staticmethod
@@ -2574,10 +3725,16 @@ class ImagePackSummary:
   commentfontsize : int # 注释文本的字号（一般会比名称小一点）
   columnsep : int # 图像之间的横向间隔，既包括中间基底图与局部差分图之间的间隔，也包括右侧局部差分图之间的间隔
   rowsep : int # 图像之间的纵向间隔
-  imagescale : float | None # 如果非空的话，所有的图片需要按照这个比例缩小 （应该是一个小于1的值）
+  imagescale : float | decimal.Decimal | None # 如果非空的话，所有的图片需要按照这个比例缩小 （应该是一个小于1的值），在排版前进行
   layout_base_transpose : bool # 基底图是否先横向填充（先行后列）
   layout_diff_transpose : bool # 局部差分图是否先纵向填充（先列后行）
+  pngcompresslevel : int # 保存 PNG 时的 zlib 压缩等级；概览图一般只用来看，默认用最快的等级
   fontcache : typing.ClassVar[dict[int, PIL.ImageFont.ImageFont | PIL.ImageFont.FreeTypeFont]] = {} # 字体缓存
+  # 文字图片缓存，键为 (文本, 字号)；同样的名称（比如差分编号）在不同的图片包中会反复出现，缩小字号时也会对同一段文字重复绘制
+  # 缓存的图片不应被修改
+  textimagecache : typing.ClassVar[collections.OrderedDict[tuple[str, int], PIL.Image.Image]] = collections.OrderedDict()
+  textimagecache_lock : typing.ClassVar[threading.Lock] = threading.Lock()
+  TEXT_IMAGE_CACHE_SIZE : typing.ClassVar[int] = 4096
 
   def __init__(self):
     self.title = "ImagePackSummary"
@@ -2594,6 +3751,7 @@ class ImagePackSummary:
     self.imagescale = None
     self.layout_base_transpose = False
     self.layout_diff_transpose = False
+    self.pngcompresslevel = 1
 
   def add_base(self, img : PIL.Image.Image, name : str):
     self.bases.append(img)
@@ -2612,6 +3770,19 @@ class ImagePackSummary:
     return font
 
   def get_text_image(self, text : str, fontsize : int) -> PIL.Image.Image:
+    key = (text, fontsize)
+    with self.textimagecache_lock:
+      if (image := self.textimagecache.get(key)) is not None:
+        self.textimagecache.move_to_end(key)
+        return image
+    image = self.draw_text_image(text, fontsize)
+    with self.textimagecache_lock:
+      self.textimagecache[key] = image
+      while len(self.textimagecache) > self.TEXT_IMAGE_CACHE_SIZE:
+        self.textimagecache.popitem(last=False)
+    return image
+
+  def draw_text_image(self, text : str, fontsize : int) -> PIL.Image.Image:
     # 首先估算大概需要多大的画布，然后画上去，最后把多算的部分去掉
     font = self.get_font_for_imagedrawing(fontsize)
     textheight = fontsize * 4 // 3
@@ -2650,19 +3821,37 @@ class ImagePackSummary:
       image = self.get_text_image(text, preferred_font_size)
     return image
 
+  def get_scaled_images(self, images : list[PIL.Image.Image]) -> list[PIL.Image.Image]:
+    # 按 imagescale 缩小图片，同时都转为 RGBA；图片之间没有依赖，在线程池中进行
+    def scale_single(img : PIL.Image.Image) -> PIL.Image.Image:
+      if self.imagescale is not None:
+        img = img.resize((int(img.width * self.imagescale), int(img.height * self.imagescale)), PIL.Image.Resampling.LANCZOS)
+      if img.mode != "RGBA":
+        img = img.convert("RGBA")
+      return img
+    if self.imagescale is None and all(img.mode == "RGBA" for img in images):
+      return images
+    if len(images) <= 1:
+      return [scale_single(img) for img in images]
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+      return list(executor.map(scale_single, images))
+
   def write(self, pngpath : str):
     # 绘制概览图
+    # 先把图片缩小到最终的大小，之后的排版与绘制都在缩小后的图片上进行
+    bases = self.get_scaled_images(self.bases)
+    diffs = self.get_scaled_images(self.diffs)
     # 首先取基底图和局部差分图的高度和宽度
     # 决定布局时我们都按最大值来
     # 为了避免在没有基底图或是没有局部差分图的情况下出现除以0的情况，我们先初始化为1
     base_height = 1
     base_width = 1
-    for img in self.bases:
+    for img in bases:
       base_height = max(base_height, img.height)
       base_width = max(base_width, img.width)
     diff_height = 1
     diff_width = 1
-    for img in self.diffs:
+    for img in diffs:
       diff_height = max(diff_height, img.height)
       diff_width = max(diff_width, img.width)
     # 然后把所有的文本全都转换为图片，便于计算整个概览图的大小
@@ -2840,7 +4029,7 @@ class ImagePackSummary:
         for j, index in enumerate(row):
           if index is not None:
             # 如果基底图的大小不到 <base_width, base_height>，我们把它放在中间
-            img = self.bases[index].convert("RGBA")
+            img = bases[index]
             imgwidth = img.width
             imgheight = img.height
             xoffset = 0
@@ -2869,7 +4058,7 @@ class ImagePackSummary:
         x = xstart
         for j, index in enumerate(row):
           if index is not None:
-            img = self.diffs[index].convert("RGBA")
+            img = diffs[index]
             overview.alpha_composite(img, (x, y))
             # 如果名称的大小不到 <diff_width, diffname_maxheight>，我们使他顶部居中（即调整 x 但不调整 y）
             img = diffname_images[index]
@@ -2892,7 +4081,7 @@ class ImagePackSummary:
       pnginfo = PIL.PngImagePlugin.PngInfo()
       for k, v in self.pngmetadata.items():
         pnginfo.add_itxt(k, v)
-    overview.save(pngpath, format="PNG", pnginfo=pnginfo)
+    overview.save(pngpath, format="PNG", pnginfo=pnginfo, compress_level=self.pngcompresslevel)
 
 class _ImagePackHTMLExport:
   @staticmethod
@@ -2918,6 +4107,53 @@ class _ImagePackHTMLExport:
     encoded = base64.b64encode(bytes_out)
     return encoded
 
+  # 图层图片另存为单独文件时支持的格式；都是无损的，并且选用编码最快的参数（文件大一些也无所谓）
+  IMAGE_FILE_FORMATS : typing.ClassVar[tuple[str, ...]] = ("png", "webp")
+
+  # 同时提交的图片编码任务（包括已经完成但还没写入的）的上限；内嵌的 base64 数据很大，不能让所有图层的结果同时留在内存中
+  MAX_PENDING_IMAGES : typing.ClassVar[int] = 2 * (os.cpu_count() or 1)
+
+  @staticmethod
+  def submit_in_order_bounded(executor : concurrent.futures.Executor, fn : typing.Callable[..., str], args_list : typing.Iterable[tuple], max_pending : int) -> typing.Iterator[str]:
+    # 按 args_list 的顺序返回 fn 的结果，同时最多只有 max_pending 个任务在进行中或者等待取走
+    # 前 max_pending 个任务在调用时就提交，这样写入模板中前面的内容时编码已经开始
+    args_iter = iter(args_list)
+    pending : collections.deque[concurrent.futures.Future] = collections.deque()
+    for args in itertools.islice(args_iter, max(max_pending, 1)):
+      pending.append(executor.submit(fn, *args))
+    def results() -> typing.Iterator[str]:
+      while len(pending) > 0:
+        result = pending.popleft().result()
+        if (args := next(args_iter, None)) is not None:
+          pending.append(executor.submit(fn, *args))
+        yield result
+    return results()
+
+  @staticmethod
+  def get_image_dir_name(html_path : str) -> str:
+    # 图层图片另存为单独文件时放在 HTML 旁边的这个目录中（与浏览器“保存网页”的做法相同）
+    return os.path.splitext(os.path.basename(html_path))[0] + "_files"
+
+  @staticmethod
+  def getInlineImageElement(index : int, image : ImageWrapper) -> str:
+    b64encoded = _ImagePackHTMLExport.getBase64(image).decode('utf-8')
+    return f'<img id="img_l{index}" src="data:image/png;base64, {b64encoded}" style="position: absolute; left: 0px; top: 0px;" />'
+
+  @staticmethod
+  def getFileImageElement(index : int, image : ImageWrapper, basedir : str, image_dir_name : str, image_format : str) -> str:
+    filename = "l" + str(index) + "." + image_format
+    destpath = os.path.join(basedir, image_dir_name, filename)
+    if image_format == "png" and image.path is not None:
+      shutil.copyfile(image.path, destpath)
+    elif image_format == "png":
+      image.get().save(destpath, format="PNG", compress_level=1)
+    elif image_format == "webp":
+      image.get().save(destpath, format="WEBP", lossless=True, quality=0, method=0)
+    else:
+      raise PPInternalError("Unsupported image format for HTML export: " + image_format)
+    src = urllib.parse.quote(image_dir_name + "/" + filename)
+    return f'<img id="img_l{index}" src="{src}" style="position: absolute; left: 0px; top: 0px;" />'
+
   @staticmethod
   def convertToJSVariable(data : typing.Any, variable_name : str) -> str:
     def getValueRecursive(data):
@@ -2986,13 +4222,17 @@ class _ImagePackHTMLExport:
   def write_html(html_path : str, imgpack : ImagePack, descriptor : 'ImagePackDescriptor',
                  html_title : str = "Interactive Imagepack viewer",
                  html_author : str = "PrepPipe Compiler",
-                 html_description : str = "Interactive Imagepack viewer") -> None:
+                 html_description : str = "Interactive Imagepack viewer",
+                 image_format : str | None = None) -> None:
+    # image_format 为 None 时所有图层图片都以 base64 嵌入 HTML 中，只需要一个文件
+    # 否则图层图片以该格式（IMAGE_FILE_FORMATS 中的一项）另存到 get_image_dir_name() 的目录中，HTML 只引用路径，生成和打开都快很多
+    # 注意以 file:// 打开时浏览器可能不允许“保存图片”（画布读取了其他文件的内容），需要时可以用本地 HTTP 服务器打开
+    # 不管哪种方式，图片都在线程池中编码，HTML 边生成边写入
     if not isinstance(descriptor, ImagePackDescriptor):
       raise PPInternalError("HTML export requires descriptor (cannot be used on temporarily created imagepack)")
 
     # 注：以下代码在 ImagePack.opaque_metadata["charactersprite_gen"] 引入之前就已经存在
     # 该信息引入之后部分操作（比如推导部件类型间的关系）已经不再需要
-    imgdata : list[str] = [] # html img elements
     layer_pos_size_info : list[tuple[int,int,int,int]] = [] # x, y, w, h
     layer_codenames : list[str] = [] # 应该都是代码名 (L0, ...)
     layer_rawnames : list[str] = [] # 应该是代码名+描述（L0-白天）
@@ -3003,9 +4243,6 @@ class _ImagePackHTMLExport:
       codename = rawname.split("-")[0]
       layer_codenames.append(codename)
       layer_rawnames.append(rawname)
-      # 最后生成图片元素。这些图片都是塞在一个不可见的 div 中，不会被直接显示，我们只是把内容放在这
-      b64encoded = _ImagePackHTMLExport.getBase64(layer.patch).decode('utf-8')
-      imgdata.append(f'<img id="img_l{i}" src="data:image/png;base64, {b64encoded}" style="position: absolute; left: 0px; top: 0px;" />')
     composites_descriptive_names : dict[str, str] = {}
     for k, v in descriptor.composites_references.items():
       composites_descriptive_names[k] = v.get()
@@ -3122,26 +4359,49 @@ class _ImagePackHTMLExport:
     for k, v in _ImagePackHTMLExport.HTML_UI_LABELS.items():
       ui_translations[k] = v.get()
 
-    parameter_dict : dict[bytes, str] = {}
+    parameter_dict : dict[bytes, str | typing.Iterable[str]] = {}
     parameter_dict[b"pp_imgpack_title"] = _ImagePackHTMLExport.escape(html_title)
     parameter_dict[b"pp_imgpack_author"] = _ImagePackHTMLExport.escape(html_author)
     parameter_dict[b"pp_imgpack_description"] = _ImagePackHTMLExport.escape(html_description)
     parameter_dict[b"pp_imgpack_script_datadecl"] = "\n".join(datadecl)
-    parameter_dict[b"pp_imgpack_imgdata"] = "\n".join(imgdata)
     parameter_dict[b"pp_imgpack_ui_translations"] = _ImagePackHTMLExport.convertToJSVariable(ui_translations, "ui_translations")
 
+    if image_format is not None:
+      if image_format not in _ImagePackHTMLExport.IMAGE_FILE_FORMATS:
+        raise PPInternalError("Unsupported image format for HTML export: " + image_format)
+      image_dir_name = _ImagePackHTMLExport.get_image_dir_name(html_path)
+      basedir = os.path.dirname(os.path.abspath(html_path))
+      os.makedirs(os.path.join(basedir, image_dir_name), exist_ok=True)
+
     template_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "imagepackhelper", "overview_html_template.html")
-    with open(html_path, "wb") as dst:
-      with open(template_path, "rb") as f:
-        while line := f.readline():
-          if line.startswith(b"$$"):
-            varname = line[2:].strip()
-            if varname not in parameter_dict:
-              raise PPInternalError(f"Template variable {varname} not found in parameter_dict")
-            dst.write(parameter_dict[varname].encode("utf-8"))
-            dst.write(b"\n")
-          else:
-            dst.write(line)
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+      # 图片元素（这些图片都是塞在一个不可见的 div 中，不会被直接显示，我们只是把内容放在这）
+      # 图片在这里就开始编码，写入时按顺序取结果；进行中的编码数量有上限，取走一个结果才提交下一个图层
+      if image_format is None:
+        imgdata = _ImagePackHTMLExport.submit_in_order_bounded(executor, _ImagePackHTMLExport.getInlineImageElement,
+                                                               ((i, layer.patch) for i, layer in enumerate(imgpack.layers)),
+                                                               _ImagePackHTMLExport.MAX_PENDING_IMAGES)
+      else:
+        imgdata = _ImagePackHTMLExport.submit_in_order_bounded(executor, _ImagePackHTMLExport.getFileImageElement,
+                                                               ((i, layer.patch, basedir, image_dir_name, image_format) for i, layer in enumerate(imgpack.layers)),
+                                                               _ImagePackHTMLExport.MAX_PENDING_IMAGES)
+      parameter_dict[b"pp_imgpack_imgdata"] = (element + "\n" for element in imgdata)
+      with open(html_path, "wb") as dst:
+        with open(template_path, "rb") as f:
+          while line := f.readline():
+            if line.startswith(b"$$"):
+              varname = line[2:].strip()
+              if varname not in parameter_dict:
+                raise PPInternalError(f"Template variable {varname} not found in parameter_dict")
+              value = parameter_dict[varname]
+              if isinstance(value, str):
+                dst.write(value.encode("utf-8"))
+                dst.write(b"\n")
+              else:
+                for chunk in value:
+                  dst.write(chunk.encode("utf-8"))
+            else:
+              dst.write(line)
 
 @ImagePack._descriptor
 class ImagePackDescriptor:
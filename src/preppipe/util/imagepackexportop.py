@@ -10,6 +10,16 @@ from ..imageexpr import *
 from .message import MessageHandler
 from ..commontypes import *
 import concurrent.futures
+import threading
+import dataclasses
+
+@dataclasses.dataclass
+class ForkedImagePackEntry:
+  # 同一个图片包、同样的 fork 参数的 fork 结果
+  # refcount 为还未完成的使用者数量，在 instance_prepare_export() 中增加，在 run_export() 完成后减少
+  # future 在第一个使用者开始 fork 时创建，其他使用者等待同一个结果
+  refcount : int = 0
+  future : concurrent.futures.Future | None = None
 
 @IRObjectJsonTypeName("imagepack_export_op_symbol")
 class ImagePackExportOpSymbol(CacheableOperationSymbol):
@@ -23,7 +33,11 @@ class ImagePackExportOpSymbol(CacheableOperationSymbol):
   _composites_export_indices : OpOperand[IntLiteral] # 导出的图层组合的下标
   _composites_export_paths : OpOperand[StringLiteral] # 导出的路径
   _composites_target_sizes : OpOperand[IntTuple2DLiteral] # 如果要缩放大小的话，这里存放目标大小（如果不缩放的话应该和原图大小一致）
-  _fully_loaded_imagepacks : typing.ClassVar[dict[str, list[concurrent.futures.Future]] | None] = None # 用于记录已经加载过的图片包，避免重复加载
+  _fully_loaded_imagepacks : typing.ClassVar[dict[str, list[concurrent.futures.Future]] | None] = None # 用于记录已经开始预读的图片包，避免重复预读（图片本身在 DecodedImageCache 中，这里不持有）
+  # 不同的操作可能对同一个图片包使用同样的 fork 参数（比如同一套换色立绘在多处以不同的差分或大小导出），这里记录 fork 的结果以便共用
+  # 键为 _get_fork_key() 的返回值（图片包 ID 加上规范化后的 fork 参数）
+  _forked_imagepacks : typing.ClassVar[dict[tuple, "ForkedImagePackEntry"] | None] = None
+  _forked_imagepacks_lock : typing.ClassVar[threading.Lock] = threading.Lock()
 
   _tr_imagepack_not_found = ImagePack.TR_imagepack.tr("export_op_imagepack_not_found",
     en="Image pack not found: {imagepack}",
@@ -100,8 +114,11 @@ class ImagePackExportOpSymbol(CacheableOperationSymbol):
     if cls._fully_loaded_imagepacks is not None:
       raise PPInternalError("ImagePackExportOpSymbol.cls_prepare_export() called twice")
     cls._fully_loaded_imagepacks = {}
+    cls._forked_imagepacks = {}
     # 不管怎样都尝试载入一下字体，可能会用到
     AssetManager.get_font()
+    # 每次导出时重新计算预读图片的用量
+    AssetManager.get_instance().reset_prefetch_data_budget()
 
   def instance_prepare_export(self, tp : concurrent.futures.ThreadPoolExecutor) -> bool:
     if self._fully_loaded_imagepacks is None:
@@ -130,19 +147,114 @@ class ImagePackExportOpSymbol(CacheableOperationSymbol):
         self._fully_loaded_imagepacks[imagepack_id] = future_list
         for l in imagepack.layers:
           if l.patch.image is None:
-            tp.submit(l.patch.get)
+            future_list.append(tp.submit(l.patch.prefetch))
         for m in imagepack.masks:
           if m.mask is not None:
             if m.mask.image is None:
-              tp.submit(m.mask.get)
+              future_list.append(tp.submit(m.mask.prefetch))
         descriptor = ImagePack.get_descriptor_by_id(imagepack_id)
         name_tr = descriptor.get_name()
         if not isinstance(name_tr, (Translatable, str)):
           raise PPInternalError("Unexpected type for ImagePack name: " + str(type(name_tr)))
         name_str = name_tr.get() if isinstance(name_tr, Translatable) else name_tr
         MessageHandler.get().info(self._tr_loading_imagepack.format(imagepack=name_str))
+      else:
+        # 不需要全部载入时导出的图层和组合也要读取图片，在预算内先让 AssetManager 在后台读取
+        AssetManager.get_instance().prefetch([imagepack_id], load_data=True)
+    # 记录 fork 结果的使用者数量，所有使用者都完成后才释放
+    if self._fork_params.get_num_operands() > 0:
+      if self._forked_imagepacks is None:
+        raise PPInternalError("ImagePackExportOpSymbol.cls_prepare_export() not called")
+      with self._forked_imagepacks_lock:
+        fork_key = self._get_fork_key()
+        if (entry := self._forked_imagepacks.get(fork_key)) is None:
+          entry = ForkedImagePackEntry()
+          self._forked_imagepacks[fork_key] = entry
+        entry.refcount += 1
     return True
 
+  def _get_fork_args(self, is_load_images : bool) -> list[typing.Any]:
+    # 把 fork 参数转换为 ImagePack.fork_applying_mask() 的参数（不含末尾补齐的 None）
+    # is_load_images 为 False 时不读取图片，图片参数直接使用对应的 ImageAssetData，用于比较参数是否相同
+    args : list[typing.Any] = []
+    for use in self._fork_params.operanduses():
+      value = use.value
+      if isinstance(value, NullLiteral):
+        args.append(None)
+      elif isinstance(value, StringLiteral):
+        text = value.get_string()
+        if len(text) == 0:
+          args.append(None)
+        else:
+          args.append(text)
+      elif isinstance(value, TextFragmentLiteral):
+        text = value.get_string()
+        color = value.style.get_color()
+        if len(text) == 0:
+          args.append(None)
+        elif color is None:
+          args.append(text)
+        else:
+          args.append((text, color))
+      elif isinstance(value, ColorLiteral):
+        args.append(value.value)
+      elif isinstance(value, ImageAssetData):
+        args.append(value.load() if is_load_images else value)
+      elif isinstance(value, ImageAssetLiteralExpr):
+        # 应该不会出现
+        args.append(value.image.load() if is_load_images else value.image)
+      elif isinstance(value, ColorImageLiteralExpr):
+        color = value.color.value
+        args.append(color)
+      else:
+        raise PPInternalError("Unsupported fork parameter type: " + str(value))
+    return args
+
+  def _get_fork_key(self) -> tuple:
+    # 用于在 _forked_imagepacks 中查找 fork 结果的键
+    # 末尾的 None 与不提供参数等价，所以去掉，这样只是参数个数不同的操作也能共用结果
+    args = self._get_fork_args(is_load_images=False)
+    while len(args) > 0 and args[-1] is None:
+      args.pop()
+    return (self._imagepack.get().get_string(), tuple(args))
+
+  def _acquire_forked_imagepack(self, imagepack : ImagePack) -> ImagePack:
+    # 同一个图片包、同样的 fork 参数只 fork 一次，第一个执行到这里的操作负责 fork，其他的等待结果
+    if self._forked_imagepacks is None:
+      raise PPInternalError("ImagePackExportOpSymbol.cls_prepare_export() not called")
+    fork_key = self._get_fork_key()
+    with self._forked_imagepacks_lock:
+      entry = self._forked_imagepacks.get(fork_key)
+      if entry is None:
+        raise PPInternalError("Fork result not registered in instance_prepare_export(): " + self.name)
+      is_owner = entry.future is None
+      if entry.future is None:
+        entry.future = concurrent.futures.Future()
+      future = entry.future
+    if not is_owner:
+      return future.result()
+    try:
+      args = self._get_fork_args(is_load_images=True)
+      if len(args) < len(imagepack.masks):
+        args += [None] * (len(imagepack.masks) - len(args))
+      result = imagepack.fork_applying_mask(args, enable_parallelization=True)
+    except BaseException as e:
+      future.set_exception(e)
+      raise
+    future.set_result(result)
+    return result
+
+  def _release_forked_imagepack(self) -> None:
+    # 最后一个使用者完成后把 fork 结果从表中去掉，以便释放内存
+    if self._forked_imagepacks is None:
+      raise PPInternalError("ImagePackExportOpSymbol.cls_prepare_export() not called")
+    fork_key = self._get_fork_key()
+    with self._forked_imagepacks_lock:
+      entry = self._forked_imagepacks[fork_key]
+      entry.refcount -= 1
+      if entry.refcount == 0:
+        del self._forked_imagepacks[fork_key]
+
   def run_export(self, output_rootdir : str) -> None:
     # 执行这个操作的导出，output_rootdir 是输出根目录
     # 一般会在一个新的线程中执行这个操作
@@ -154,54 +266,30 @@ class ImagePackExportOpSymbol(CacheableOperationSymbol):
     imagepack = AssetManager.get_instance().get_asset(imagepack_id)
     if not isinstance(imagepack, ImagePack):
       raise PPInternalError("Asset is not an image pack: " + self._imagepack.get().get_string())
-    # 如果需要 fork 操作，我们就执行 fork 操作
+    # 如果需要 fork 操作，我们就执行 fork 操作（或是使用其他操作的 fork 结果）
     if self._fork_params.get_num_operands() > 0:
-      args : list[Color | PIL.Image.Image | str | tuple[str, Color] | None] = []
-      for use in self._fork_params.operanduses():
-        value = use.value
-        if isinstance(value, NullLiteral):
-          args.append(None)
-        elif isinstance(value, StringLiteral):
-          text = value.get_string()
-          if len(text) == 0:
-            args.append(None)
-          else:
-            args.append(text)
-        elif isinstance(value, TextFragmentLiteral):
-          text = value.get_string()
-          color = value.style.get_color()
-          if len(text) == 0:
-            args.append(None)
-          elif color is None:
-            args.append(text)
-          else:
-            args.append((text, color))
-        elif isinstance(value, ColorLiteral):
-          args.append(value.value)
-        elif isinstance(value, ImageAssetData):
-          image = value.load()
-          args.append(image)
-        elif isinstance(value, ImageAssetLiteralExpr):
-          # 应该不会出现
-          image = value.image.load()
-          args.append(image)
-        elif isinstance(value, ColorImageLiteralExpr):
-          color = value.color.value
-          args.append(color)
-        else:
-          raise PPInternalError("Unsupported fork parameter type: " + str(value))
-      if len(args) < len(imagepack.masks):
-        args += [None] * (len(imagepack.masks) - len(args))
-      imagepack = imagepack.fork_applying_mask(args, enable_parallelization=True)
+      try:
+        imagepack = self._acquire_forked_imagepack(imagepack)
+        self._export_from_imagepack(output_rootdir, imagepack)
+      finally:
+        self._release_forked_imagepack()
+    else:
+      self._export_from_imagepack(output_rootdir, imagepack)
+
+  def _export_from_imagepack(self, output_rootdir : str, imagepack : ImagePack) -> None:
     with concurrent.futures.ThreadPoolExecutor() as executor:
       num_composites_export = min(self._composites_export_indices.get_num_operands(), self._composites_export_paths.get_num_operands())
+      # 同一个组合可能要导出到多个路径（比如不同大小），我们只合成一次
+      composite_exports : dict[int, list[tuple[str, tuple[int, int] | None]]] = {}
       for i in range(0, num_composites_export):
         index = self._composites_export_indices.get_operand(i).value
         path = self._composites_export_paths.get_operand(i).get_string()
         x, y = self._composites_target_sizes.get_operand(i).value
-        image = imagepack.get_composed_image(index)
         resizeTo = (x, y) if (imagepack.width != x or imagepack.height != y) else None
-        executor.submit(self._export_image_helper, output_rootdir, path, image, resizeTo)
+        composite_exports.setdefault(index, []).append((path, resizeTo))
+      for index, image in imagepack.compose_many(composite_exports.keys()):
+        for path, resizeTo in composite_exports[index]:
+          executor.submit(self._export_image_helper, output_rootdir, path, image, resizeTo)
       num_layers_export = min(self._layers_export_indices.get_num_operands(), self._layers_export_paths.get_num_operands())
       for i in range(0, num_layers_export):
         index = self._layers_export_indices.get_operand(i).value
@@ -0,0 +1,156 @@
+# SPDX-FileCopyrightText: 2025 PrepPipe's Contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# 图片包的单文件图层存储
+# 默认情况下图片包的每个图层、选区都是单独的 PNG 文件，每次读取都需要做一次 zlib 解码
+# 使用该格式时所有图片都存放在同一个文件中，未压缩的图片可以直接用 np.memmap 映射，读取时不需要解码
+#
+# 文件结构：
+#   8 字节魔数 LAYER_STORE_MAGIC
+#   8 字节小端无符号整数：索引的长度
+#   索引（UTF-8 JSON）: {名称: [偏移, 长度, 宽, 高, 模式, 编码]}
+#     偏移是相对于文件开头的字节数，模式为 PIL 的图像模式，编码为 LAYER_STORE_CODECS 中的一项
+#   各图片的数据，每块的起始位置按 LAYER_STORE_ALIGNMENT 对齐
+
+import json
+import os
+import struct
+import threading
+import typing
+import zlib
+
+import numpy as np
+import PIL.Image
+
+from ..exceptions import *
+
+LAYER_STORE_FILENAME = "layers.bin"
+LAYER_STORE_MAGIC = b"PPLSTOR1"
+LAYER_STORE_ALIGNMENT = 64
+
+# raw: 不压缩，可以直接映射
+# zlib: 用 zlib 压缩（等级 1），比 PNG 小不了多少但解码时不需要做 PNG 的逐行反滤波
+LAYER_STORE_CODECS : tuple[str, ...] = ("raw", "zlib")
+
+# 可以直接保存的图像模式以及对应的通道数；其他模式的图片会先转换为 RGBA
+_MODE_CHANNELS : dict[str, int] = {
+  "RGBA" : 4,
+  "RGB" : 3,
+  "LA" : 2,
+  "L" : 1,
+}
+
+_HEADER_STRUCT = struct.Struct("<8sQ")
+
+# 写入时为索引预留空间所用的最大值（只用到位数）
+_MAX_OFFSET = 2 ** 64 - 1
+_MAX_DIMENSION = 2 ** 31 - 1
+
+class LayerStore:
+  path : str
+  index : dict[str, tuple[int, int, int, int, str, str]]
+  file_version : tuple[int, int] # 打开时文件的 (st_mtime_ns, st_size)，用于区分同一路径上重新写入的文件
+  _mapped : np.ndarray | None
+  _lock : threading.Lock
+
+  def __init__(self, path : str) -> None:
+    self.path = path
+    self._mapped = None
+    self._lock = threading.Lock()
+    with open(path, "rb") as f:
+      st = os.fstat(f.fileno())
+      self.file_version = (st.st_mtime_ns, st.st_size)
+      header = f.read(_HEADER_STRUCT.size)
+      if len(header) != _HEADER_STRUCT.size:
+        raise PPInternalError("Invalid layer store (file too short): " + path)
+      magic, index_size = _HEADER_STRUCT.unpack(header)
+      if magic != LAYER_STORE_MAGIC:
+        raise PPInternalError("Invalid layer store (unknown magic " + str(magic) + "): " + path)
+      index = json.loads(f.read(index_size).decode("utf-8"))
+    if not isinstance(index, dict):
+      raise PPInternalError("Invalid layer store index: " + path)
+    self.index = {}
+    for name, entry in index.items():
+      offset, length, width, height, mode, codec = entry
+      if mode not in _MODE_CHANNELS:
+        raise PPInternalError("Unsupported image mode in layer store: " + mode)
+      if codec not in LAYER_STORE_CODECS:
+        raise PPInternalError("Unsupported codec in layer store: " + codec)
+      self.index[name] = (offset, length, width, height, mode, codec)
+
+  def __contains__(self, name : str) -> bool:
+    return name in self.index
+
+  def _get_mapped(self) -> np.ndarray:
+    # 整个文件只映射一次，所有图片共用
+    # 映射前检查文件是否还是打开时的那个，如果已经被重新写入，索引就对不上了
+    with self._lock:
+      if self._mapped is None:
+        with open(self.path, "rb") as f:
+          st = os.fstat(f.fileno())
+          if (st.st_mtime_ns, st.st_size) != self.file_version:
+            raise PPInternalError("Layer store changed after it was opened: " + self.path)
+          self._mapped = np.memmap(f, dtype=np.uint8, mode="r")
+      return self._mapped
+
+  def get_mode(self, name : str) -> str:
+    return self.index[name][4]
+
+  def get_array(self, name : str) -> np.ndarray:
+    # 返回 (高, 宽, 通道数) 的 uint8 数组（单通道时为 (高, 宽)），只读
+    # raw 编码时返回的是文件映射的一部分，不会读取或复制数据
+    offset, length, width, height, mode, codec = self.index[name]
+    channels = _MODE_CHANNELS[mode]
+    shape = (height, width, channels) if channels > 1 else (height, width)
+    match codec:
+      case "raw":
+        return self._get_mapped()[offset:offset+length].reshape(shape)
+      case "zlib":
+        data = zlib.decompress(self._get_mapped()[offset:offset+length])
+        array = np.frombuffer(data, dtype=np.uint8).reshape(shape)
+        return array
+      case _:
+        raise PPInternalError("Unexpected codec: " + codec)
+
+  def get_image(self, name : str) -> PIL.Image.Image:
+    return PIL.Image.fromarray(self.get_array(name), self.get_mode(name))
+
+  @staticmethod
+  def write(path : str, images : typing.Iterable[tuple[str, PIL.Image.Image | typing.Callable[[], PIL.Image.Image]]], codec : str = "raw") -> None:
+    # 把所有图片写入一个文件；images 中的名称不能重复
+    # 图片也可以是返回图片的函数，这样的图片在写入时才读取，写完就不再引用，不需要所有图片同时在内存中
+    if codec not in LAYER_STORE_CODECS:
+      raise PPInternalError("Unsupported layer store codec: " + codec)
+    entries = list(images)
+    used_names : set[str] = set()
+    for name, _ in entries:
+      if name in used_names:
+        raise PPInternalError("Duplicated name in layer store: " + name)
+      used_names.add(name)
+    def align(offset : int) -> int:
+      return (offset + LAYER_STORE_ALIGNMENT - 1) // LAYER_STORE_ALIGNMENT * LAYER_STORE_ALIGNMENT
+    # 索引在数据之前，但各块的长度要编码后才知道，所以索引按每一项最长的情况预留空间，写完数据后再填入，多出来的部分用空格填充
+    index_size = len(json.dumps({name : [_MAX_OFFSET, _MAX_OFFSET, _MAX_DIMENSION, _MAX_DIMENSION, "RGBA", codec] for name, _ in entries},
+                                ensure_ascii=False, separators=(',', ':')).encode("utf-8"))
+    index : dict[str, list] = {}
+    offset = align(_HEADER_STRUCT.size + index_size)
+    with open(path, "wb") as f:
+      for name, image in entries:
+        if callable(image):
+          image = image()
+        if image.mode not in _MODE_CHANNELS:
+          image = image.convert("RGBA")
+        data : bytes | memoryview = memoryview(np.ascontiguousarray(np.asarray(image))).cast("B")
+        if codec == "zlib":
+          data = zlib.compress(data, 1)
+        f.seek(offset)
+        f.write(data)
+        index[name] = [offset, len(data), image.width, image.height, image.mode, codec]
+        offset = align(offset + len(data))
+      index_bytes = json.dumps(index, ensure_ascii=False, separators=(',', ':')).encode("utf-8")
+      if len(index_bytes) > index_size:
+        raise PPInternalError("Layer store index larger than reserved: " + path)
+      index_bytes += b" " * (index_size - len(index_bytes))
+      f.seek(0)
+      f.write(_HEADER_STRUCT.pack(LAYER_STORE_MAGIC, index_size))
+      f.write(index_bytes)
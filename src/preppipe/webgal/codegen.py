@@ -680,6 +680,7 @@ class _WebGalCodeGenHelper(BackendCodeGenHelperBase[WebGalNode]):
       assert isinstance(n, VNNamespace)
       self.cur_ns = n
       self.collect_named_assets(n)
+      self.prefetch_imagepacks(n)
       self._assign_function_labels(n)
     for k in sorted(self.model.namespace.keys()):
       n = self.model.namespace.get(k)
@@ -7,6 +7,7 @@ from .ast import *
 
 from .codegen import codegen_webgal
 from .export import export_webgal
+from ..enginecommon.export import ASSET_PLACEMENT_MODES
 from ..vnmodel import VNModel
 import shutil
 
@@ -23,10 +24,18 @@ class _WebGalCodeGen(TransformBase):
 @BackendDecl('webgal-export', input_decl=WebGalModel, output_decl=IODecl(description='<output directory>', nargs=1))
 class _WebGalExport(TransformBase):
   _template_dir : typing.ClassVar[str] = ""
+  _asset_jobs : typing.ClassVar[int] = 0
+  _asset_placement : typing.ClassVar[str] = "copy"
+  _script_jobs : typing.ClassVar[int] = 0
+  _script_processes : typing.ClassVar[bool] = False
 
   @staticmethod
   def install_arguments(argument_group : argparse._ArgumentGroup):
     argument_group.add_argument("--webgal-export-templatedir", nargs=1, type=str, default='')
+    argument_group.add_argument("--webgal-export-asset-jobs", type=int, default=0, help="Number of threads for exporting assets (0: default, 1: no threading)")
+    argument_group.add_argument("--webgal-export-asset-placement", choices=ASSET_PLACEMENT_MODES, default="copy", help="How to place unconverted asset files in the output directory (hardlink/reflink fall back to copy if unsupported)")
+    argument_group.add_argument("--webgal-export-script-jobs", type=int, default=0, help="Number of workers for generating script files (0: default, 1: one by one)")
+    argument_group.add_argument("--webgal-export-script-processes", action="store_true", help="Generate script files in forked processes instead of threads (only on platforms supporting fork and when no other thread is running)")
 
   @staticmethod
   def handle_arguments(args : argparse.Namespace):
@@ -37,6 +46,10 @@ class _WebGalExport(TransformBase):
     assert isinstance(_WebGalExport._template_dir, str)
     if len(_WebGalExport._template_dir) > 0 and not os.path.isdir(_WebGalExport._template_dir):
       raise RuntimeError('--webgal-export-templatedir: input "' + _WebGalExport._template_dir + '" is not a valid path')
+    _WebGalExport._asset_jobs = args.webgal_export_asset_jobs
+    _WebGalExport._asset_placement = args.webgal_export_asset_placement
+    _WebGalExport._script_jobs = args.webgal_export_script_jobs
+    _WebGalExport._script_processes = args.webgal_export_script_processes
 
   def run(self) -> None:
     if len(self._inputs) == 0:
@@ -47,4 +60,4 @@ class _WebGalExport(TransformBase):
     if os.path.exists(out_path):
       if not os.path.isdir(out_path):
         raise RuntimeError("webgal-export: exporting to non-directory path: " + out_path)
-    return export_webgal(self.inputs[0], out_path, _WebGalExport._template_dir)
+    return export_webgal(self.inputs[0], out_path, _WebGalExport._template_dir, asset_jobs=_WebGalExport._asset_jobs, asset_placement=_WebGalExport._asset_placement, script_jobs=_WebGalExport._script_jobs, script_processes=_WebGalExport._script_processes)
@@ -53,6 +53,7 @@ class ImagePackWidget(QWidget, ToolWidgetInterface):
     if packid is not None:
       return None
     result = []
+    ImagePack.load_pending_descriptors()
     for descriptor in ImagePack.MANIFEST.values():
       if not isinstance(descriptor, ImagePackDescriptor):
         raise PPInternalError(f"Unexpected descriptor type {type(descriptor)}")